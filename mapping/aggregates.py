@@ -0,0 +1,657 @@
+# To work with arrays and to save them to disk
+import numpy as np
+
+# To check the modification time of the files
+import os
+
+# To cache the aggregate cubes
+from functools import lru_cache
+
+# To align the buckets to local time and to count half-open intervals
+from datetime import datetime, timedelta
+import time
+
+# Import local libraries
+from . import mapping as mp
+from . import districts as distr
+from . import constants as co
+
+# Import the default list of categories
+from meetup.categories import categories as local_categories
+
+# To count the events that belong to several categories once
+from meetup.event_store import unique_event_mask
+
+# Default location of the aggregate cubes, next to the event stores. It is
+# defined with them, so meetup can write the cubes without importing mapping.
+from meetup.event_store import CUBE_FILENAME
+
+# Length of the time buckets in milliseconds
+BUCKET_SIZES = {"hour": 3600 * 1000,
+                "day": 24 * 3600 * 1000,
+                "week": 7 * 24 * 3600 * 1000}
+
+# Start of the first bucket after the epoch, in local time (see
+# get_local_times()). Weeks start on Monday and the epoch (1970-01-01) was a
+# Thursday.
+BUCKET_ORIGINS = {"hour": 0,
+                  "day": 0,
+                  "week": 4 * 24 * 3600 * 1000}
+
+# Extra rows of the district axis of the cubes
+NOT_LOCATED = "Not Located"
+NO_LOCATION = "No Location"
+
+
+def get_event_columns(events):
+    """
+    It arranges the latitudes, longitudes and dates of some events in arrays.
+
+    Parameters
+    ----------
+    events : either a list of dictionaries or columns of arrays
+        Events as returned by mapping.load_city_events().
+
+    Returns
+    -------
+    latitude : array of floats
+        Latitude of each event, NaN when it is unknown.
+    longitude : array of floats
+        Longitude of each event, NaN when it is unknown.
+    date : array of integers
+        Epoch in milliseconds of each event, -1 when it is unknown.
+    """
+    if type(events) is not list:
+        return (np.asarray(events["latitude"], dtype=np.float64),
+                np.asarray(events["longitude"], dtype=np.float64),
+                np.asarray(events["date"], dtype=np.int64))
+
+    latitude = np.array([np.nan if event["latitude"] == "None"
+                         else float(event["latitude"]) for event in events],
+                        dtype=np.float64)
+    longitude = np.array([np.nan if event["longitude"] == "None"
+                          else float(event["longitude"]) for event in events],
+                         dtype=np.float64)
+    date = np.array([-1 if event["date"] == "None" else int(event["date"])
+                     for event in events], dtype=np.int64)
+
+    return latitude, longitude, date
+
+
+def get_event_ids(events):
+    """
+    It gets a key for the id of each event, so the events that belong to
+    several categories can be told apart.
+
+    Parameters
+    ----------
+    events : either a list of dictionaries or columns of arrays
+        Events as returned by mapping.load_city_events().
+
+    Returns
+    -------
+    keys : array
+        Id of each event, or the position of its id in the strings of the
+        memory-mapped event files.
+    known : array of booleans
+        True for the events with an id.
+    """
+    if type(events) is list:
+        keys = np.array([event["event_id"].strip() for event in events],
+                        dtype=str)
+        return keys, keys != "None"
+
+    if type(events) is dict:
+        keys = np.asarray(events["id"], dtype=str)
+        return keys, keys != ""
+
+    return (np.asarray(events["id_start"], dtype=np.int64),
+            np.asarray(events["id_end"]) > np.asarray(events["id_start"]))
+
+
+def get_local_times(dates):
+    """
+    It converts event dates to local wall-clock time, i.e. milliseconds since
+    1970-01-01 00:00 in the local time zone, so days and weeks start at local
+    midnights all year round. Time intervals are given as naive local
+    datetime objects, like the ones of mapping.datetime_parser(), and are
+    converted by get_local_time().
+
+    Parameters
+    ----------
+    dates : array of integers
+        Dates of the events in epoch milliseconds.
+
+    Returns
+    -------
+    local_dates : array of integers
+        Dates of the events in local wall-clock milliseconds.
+    """
+    # The offset from UTC only changes at whole hours, so it is computed once
+    # for each hour with events
+    hours, hour_index = np.unique(dates // BUCKET_SIZES["hour"],
+                                  return_inverse=True)
+    offsets = np.array([get_local_time(datetime.fromtimestamp(
+        hour * BUCKET_SIZES["hour"] / 1000)) - hour * BUCKET_SIZES["hour"]
+        for hour in hours.tolist()], dtype=np.int64)
+
+    return dates + offsets[hour_index.ravel()]
+
+
+def get_time_zone():
+    """
+    It names the local time zone, so cubes built in another time zone are
+    not used.
+
+    Returns
+    -------
+    time_zone : string
+        Standard and daylight saving names of the local time zone.
+    """
+    return ",".join(time.tzname)
+
+
+def get_local_time(limit):
+    """
+    It converts a datetime object to local wall-clock time (see
+    get_local_times()).
+
+    Parameters
+    ----------
+    limit : datetime object
+        A naive datetime is taken as local time.
+
+    Returns
+    -------
+    local_time : integer
+        Milliseconds since 1970-01-01 00:00 in the local time zone.
+    """
+    if limit.tzinfo is not None:
+        limit = limit.astimezone().replace(tzinfo=None)
+    return (limit - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+
+
+def build_district_cube(city, categories=None, bucket="day",
+                        geojson_filename="./geojson/{}.geojson",
+                        csv_filename="./csv/{}.csv"):
+    """
+    It counts the events of a city per district, category and time bucket.
+    Every event is localized only once, so later queries just sum parts of
+    the cube. The district axis has one row per district of the geojson file
+    plus two extra rows: NOT_LOCATED, for the events outside of all the
+    districts, and NO_LOCATION, for the events without valid coordinates.
+    The time axis has an extra last bucket for the events without date.
+    An event that belongs to several categories is counted in each of them,
+    so the cube also keeps the counts of the distinct events and the number
+    of events shared by each pair of categories.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    bucket : string
+        Length of the time buckets: "hour", "day" or "week".
+    geojson_filename : string
+        It tells the directory where to search for the geojson file with the
+        districts of the city. If it does not exist, all the events with
+        coordinates are counted as NOT_LOCATED.
+    csv_filename : string
+        It tells the directory where to search for the custom csv file, which
+        is used to read the total number of activities of the city.
+
+    Returns
+    -------
+    cube : dictionary of arrays
+        It contains the following arrays:
+            counts:             int32 array with shape (districts + 2,
+                                categories, buckets + 1)
+            unique_counts:      int32 array with shape (districts + 2,
+                                buckets + 1), each event counted once
+            shared_events:      int32 array with shape (categories,
+                                categories), number of events of both
+                                categories
+            district_names:     names of the rows of the district axis
+            category_ids:       int16 ids of the categories
+            bucket_size:        length of the time buckets in milliseconds
+            bucket_origin:      local wall-clock milliseconds of the first
+                                bucket (see get_local_times())
+            time_zone:          names of the local time zone of the buckets
+            num_activities:     total number of activities of the city
+    """
+    if categories is None:
+        categories = local_categories
+
+    geojson_filename = geojson_filename.format(city)
+    if os.path.isfile(geojson_filename):
+        district_names = distr.load_district_geometry(
+            geojson_filename)["names"]
+    else:
+        district_names = []
+
+    not_located = len(district_names)
+    no_location = not_located + 1
+    category_ids = sorted(categories)
+
+    districts = []
+    category_positions = []
+    dates = []
+    keys = []
+    known = []
+
+    for position, category_id in enumerate(category_ids):
+        events = mp.load_city_events(city, [category_id, ])
+        latitude, longitude, date = get_event_columns(events)
+        event_keys, event_known = get_event_ids(events)
+        keys.append(event_keys)
+        known.append(event_known)
+
+        valid = ~(np.isnan(latitude) | np.isnan(longitude) |
+                  ((latitude == 0) & (longitude == 0)))
+
+        located = np.full(len(date), no_location, dtype=np.intp)
+        if len(district_names) > 0:
+            locations = distr.classify_points(
+                np.column_stack((latitude[valid], longitude[valid])),
+                geojson_filename)
+            located[valid] = np.where(locations >= 0, locations, not_located)
+        else:
+            located[valid] = not_located
+
+        districts.append(located)
+        category_positions.append(np.full(len(date), position,
+                                          dtype=np.intp))
+        dates.append(date)
+
+    districts = np.concatenate(districts or [np.zeros(0, dtype=np.intp)])
+    category_positions = np.concatenate(category_positions or
+                                        [np.zeros(0, dtype=np.intp)])
+    dates = np.concatenate(dates or [np.zeros(0, dtype=np.int64)])
+    keys = np.concatenate(keys or [np.zeros(0, dtype=str)])
+    known = np.concatenate(known or [np.zeros(0, dtype=bool)])
+
+    # Buckets are aligned to BUCKET_ORIGINS in local time, so cubes of
+    # different cities can be compared bucket by bucket and local days and
+    # weeks are whole buckets
+    bucket_size = BUCKET_SIZES[bucket]
+    dated = dates >= 0
+    local_dates = get_local_times(dates[dated])
+    if np.any(dated):
+        offset = BUCKET_ORIGINS[bucket]
+        bucket_origin = offset + (local_dates.min() - offset) // \
+            bucket_size * bucket_size
+        num_buckets = int((local_dates.max() - bucket_origin) //
+                          bucket_size) + 1
+    else:
+        bucket_origin = 0
+        num_buckets = 0
+
+    buckets = np.full(len(dates), num_buckets, dtype=np.intp)
+    buckets[dated] = (local_dates - bucket_origin) // bucket_size
+
+    shape = (len(district_names) + 2, len(category_ids), num_buckets + 1)
+    counts = np.bincount(
+        np.ravel_multi_index((districts, category_positions, buckets), shape),
+        minlength=int(np.prod(shape))).reshape(shape).astype(np.int32)
+
+    # Each event is counted once, in its first category
+    unique = unique_event_mask(keys, known)
+    unique_counts = np.bincount(
+        np.ravel_multi_index((districts[unique], buckets[unique]),
+                             (shape[0], shape[2])),
+        minlength=shape[0] * shape[2]).reshape(
+            (shape[0], shape[2])).astype(np.int32)
+
+    # Membership of the events with id in each category
+    _, event_index = np.unique(keys[known], return_inverse=True)
+    event_index = event_index.ravel()
+    num_events = int(event_index.max()) + 1 if event_index.size else 0
+    membership = np.zeros((num_events, len(category_ids)), dtype=np.int32)
+    membership[event_index, category_positions[known]] = 1
+    shared_events = membership.T @ membership
+
+    num_activities = None
+    if os.path.isfile(csv_filename.format(city)):
+        num_activities = mp.load_custom_csv(csv_filename.format(city))[1]
+
+    return {"counts": counts,
+            "unique_counts": unique_counts,
+            "shared_events": shared_events,
+            "district_names": np.array(list(district_names) +
+                                       [NOT_LOCATED, NO_LOCATION], dtype=str),
+            "category_ids": np.array(category_ids, dtype=np.int16),
+            "bucket_size": np.int64(bucket_size),
+            "bucket_origin": np.int64(bucket_origin),
+            "time_zone": np.array(get_time_zone()),
+            "num_activities": np.int64(num_activities or 0)}
+
+
+def write_city_cube(city, categories=None, bucket="day",
+                    filename=CUBE_FILENAME,
+                    geojson_filename="./geojson/{}.geojson",
+                    csv_filename="./csv/{}.csv"):
+    """
+    It builds the aggregate cube of a city (see build_district_cube()) and
+    writes it down to a binary file (.npz). It should be called every time
+    that the events of the city are fetched or refreshed.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    bucket : string
+        Length of the time buckets: "hour", "day" or "week".
+    filename : string
+        Directory and filename of the file that is going to be written.
+    geojson_filename : string
+        It tells the directory where to search for the geojson file.
+    csv_filename : string
+        It tells the directory where to search for the custom csv file.
+
+    Returns
+    -------
+    cube : dictionary of arrays
+        It contains all the arrays that were saved.
+    """
+    cube = build_district_cube(city, categories, bucket, geojson_filename,
+                               csv_filename)
+
+    filename = filename.format(city)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, **cube)
+
+    print("Saved an aggregate cube in \'{}\'".format(filename))
+
+    return cube
+
+
+def load_city_cube(city, filename=CUBE_FILENAME,
+                   geojson_filename="./geojson/{}.geojson",
+                   csv_filename="./csv/{}.csv"):
+    """
+    It reads the aggregate cube of a city. The result is kept in memory until
+    the modification time of the file changes. A cube older than the csv or
+    the geojson file of the city is out of date and is not used.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    filename : string
+        It tells the directory where to search for the aggregate cube.
+    geojson_filename : string
+        It tells the directory where to search for the geojson file.
+    csv_filename : string
+        It tells the directory where to search for the custom csv file.
+
+    Returns
+    -------
+    cube : dictionary
+        It contains the arrays of build_district_cube() plus a
+        "category_index" dictionary, which has category ids as keys and their
+        position in the category axis as items. It is shared between callers,
+        so it must not be modified. None is returned if there is no cube for
+        the city or it is out of date, including cubes written before the
+        distinct events were counted and cubes whose buckets are in another
+        time zone.
+    """
+    filename = os.path.abspath(filename.format(city))
+    if not os.path.isfile(filename):
+        return None
+
+    mtime = os.path.getmtime(filename)
+    for source in (geojson_filename.format(city), csv_filename.format(city)):
+        if os.path.isfile(source) and os.path.getmtime(source) > mtime:
+            return None
+
+    cube = _load_city_cube(filename, mtime)
+    if "unique_counts" not in cube:
+        return None
+    if "time_zone" not in cube or str(cube["time_zone"]) != get_time_zone():
+        return None
+
+    return cube
+
+
+@lru_cache(maxsize=co.EVENTS_CACHE_SIZE)
+def _load_city_cube(filename, mtime):
+    """
+    Cached implementation of load_city_cube(). The modification time is only
+    used as part of the cache key.
+    """
+    with np.load(filename) as data:
+        cube = {key: data[key] for key in data.files}
+
+    cube["category_index"] = {int(category_id): position for position,
+                              category_id in enumerate(cube["category_ids"])}
+    cube["bucket_size"] = int(cube["bucket_size"])
+    cube["bucket_origin"] = int(cube["bucket_origin"])
+    cube["num_activities"] = int(cube["num_activities"])
+
+    return cube
+
+
+def get_bucket_slice(cube, time_interval=None):
+    """
+    It finds the time buckets of a cube that overlap with a half-open time
+    interval [start, end). The limits of the interval are rounded outwards
+    to whole buckets, unless they are aligned (see is_bucket_aligned()).
+
+    Parameters
+    ----------
+    cube : dictionary
+        Aggregate cube as returned by load_city_cube().
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval, as datetime objects. Its end
+        is not included. If it is None, all the buckets are selected,
+        including the one with the events without date.
+
+    Returns
+    -------
+    buckets : slice
+        Slice of the time axis of the cube.
+    """
+    num_buckets = cube["counts"].shape[2] - 1
+
+    if time_interval is None:
+        return slice(0, num_buckets + 1)
+
+    start, end = (get_local_time(limit) for limit in time_interval)
+
+    first = (start - cube["bucket_origin"]) // cube["bucket_size"]
+    last = -((cube["bucket_origin"] - end) // cube["bucket_size"])
+
+    first = min(max(first, 0), num_buckets)
+    last = min(max(last, 0), num_buckets)
+
+    return slice(first, max(first, last))
+
+
+def is_bucket_aligned(cube, time_interval=None):
+    """
+    It tells whether both limits of a half-open time interval [start, end)
+    fall on the limits of the time buckets of a cube, so the buckets
+    selected by get_bucket_slice() hold exactly the events inside of the
+    interval. For instance, with day or week buckets, the interval from a
+    Monday at 00:00 to the next Monday at 00:00 is aligned.
+
+    Parameters
+    ----------
+    cube : dictionary
+        Aggregate cube as returned by load_city_cube().
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval, as datetime objects. Its end
+        is not included.
+
+    Returns
+    -------
+    aligned : boolean
+        True if the interval starts and ends at the beginning of a bucket, or
+        if it is None.
+    """
+    if time_interval is None:
+        return True
+
+    start, end = (get_local_time(limit) for limit in time_interval)
+
+    return ((start - cube["bucket_origin"]) % cube["bucket_size"] == 0 and
+            (end - cube["bucket_origin"]) % cube["bucket_size"] == 0)
+
+
+def count_events(cube, category_list=None, time_interval=None):
+    """
+    It sums the events of some categories in a time interval for each row of
+    the district axis of a cube.
+
+    Parameters
+    ----------
+    cube : dictionary
+        Aggregate cube as returned by load_city_cube().
+    category_list : list of integers
+        These describe all the category ids whose events we want to count.
+        By default, all the categories of the cube.
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval where we want to count
+        events (see get_bucket_slice()).
+
+    Returns
+    -------
+    counts : array of integers
+        Number of events of each row of cube["district_names"]. An event
+        that belongs to several of the categories is counted once. None is
+        returned if some of the categories share events but not all the
+        categories of the cube are counted, as the shared events can not be
+        told apart in the cube.
+    """
+    buckets = get_bucket_slice(cube, time_interval)
+
+    if category_list is None:
+        positions = list(range(len(cube["category_ids"])))
+    else:
+        positions = sorted(set(cube["category_index"][category_id]
+                               for category_id in category_list
+                               if category_id in cube["category_index"]))
+
+    if len(positions) == len(cube["category_ids"]):
+        return cube["unique_counts"][:, buckets].sum(axis=1, dtype=np.int64)
+
+    shared_events = cube["shared_events"][np.ix_(positions, positions)]
+    if np.any(shared_events[~np.eye(len(positions), dtype=bool)]):
+        return None
+
+    counts = cube["counts"][:, positions, buckets]
+
+    return counts.sum(axis=(1, 2), dtype=np.int64)
+
+
+def get_district_counts(cube, category_list=None, time_interval=None):
+    """
+    It counts the events of each district of a city from its aggregate cube.
+
+    Parameters
+    ----------
+    cube : dictionary
+        Aggregate cube as returned by load_city_cube().
+    category_list : list of integers
+        These describe all the category ids whose events we want to count.
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval where we want to count
+        events (see get_bucket_slice()).
+
+    Returns
+    -------
+    counter : dictionary
+        The same dictionary as districts.events_per_district(): districts as
+        keys, plus "Not Located", and their number of events as items. None
+        if the cube can not count the categories (see count_events()).
+    """
+    counts = count_events(cube, category_list, time_interval)
+    if counts is None:
+        return None
+
+    # Events without coordinates are not part of the districts counter
+    return {str(name): int(number) for name, number in
+            zip(cube["district_names"][:-1], counts[:-1])}
+
+
+def get_category_counts(cube, category_list=None, time_interval=None):
+    """
+    It counts all the events of each category of a city from its aggregate
+    cube, whether they have been located or not.
+
+    Parameters
+    ----------
+    cube : dictionary
+        Aggregate cube as returned by load_city_cube().
+    category_list : list of integers
+        These describe all the category ids whose events we want to count.
+        By default, all the categories of the cube.
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval where we want to count
+        events (see get_bucket_slice()).
+
+    Returns
+    -------
+    counter : dictionary
+        It has category ids as keys and their number of events as items.
+    """
+    if category_list is None:
+        category_list = [int(category_id) for category_id in
+                         cube["category_ids"]]
+
+    buckets = get_bucket_slice(cube, time_interval)
+    totals = cube["counts"][:, :, buckets].sum(axis=(0, 2), dtype=np.int64)
+
+    return {category_id: int(totals[cube["category_index"][category_id]])
+            if category_id in cube["category_index"] else 0
+            for category_id in category_list}
+
+
+def city_district_counts(city, category_list, time_interval=None):
+    """
+    It counts the events of each district of a city. The aggregate cube of
+    the city is used if it is up to date, it can count the categories and
+    the time interval matches whole buckets (see is_bucket_aligned()).
+    Otherwise, the events are read and localized (see
+    districts.events_per_district()). Either way, the counts are exact and
+    an event that belongs to several of the categories is counted once.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_list : list of integers
+        These describe all the category ids whose events we want to count.
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval where we want to count
+        events. Its end is not included, so a week goes from a Monday at
+        00:00 to the next Monday at 00:00.
+
+    Returns
+    -------
+    counter : dictionary
+        It has districts as keys, plus "Not Located", and their number of
+        events as items.
+    """
+    cube = load_city_cube(city)
+
+    if cube is not None and is_bucket_aligned(cube, time_interval):
+        counter = get_district_counts(cube, category_list, time_interval)
+        if counter is not None:
+            return counter
+
+    # The end of the interval is not included, as in the cube
+    if time_interval is not None:
+        time_interval = (time_interval[0],
+                         time_interval[1] - timedelta(milliseconds=1))
+
+    events_data = mp.load_city_events(city, category_list)
+
+    return distr.events_per_district(events_data,
+                                     './geojson/{}.geojson'.format(city),
+                                     time_interval)
@@ -2,6 +2,38 @@
 MAX_INTENSITY = 1
 POINT_RADIUS = 10
 
+# Maximum number of geojson files whose district geometry is kept in memory
+DISTRICT_CACHE_SIZE = 8
+
+# Maximum number of custom csv files whose events are kept in memory
+EVENTS_CACHE_SIZE = 16
+
+# Maximum number of district layer styles that are kept in memory
+STYLE_CACHE_SIZE = 32
+
+# Tolerances, in degrees, of the simplified variants of the district layers.
+# They are about 10, 50 and 200 meters.
+SIMPLIFY_TOLERANCES = (0.0001, 0.0005, 0.002)
+
+# Decimals of the coordinates of the simplified variants (about 1 meter)
+QUANTIZE_DECIMALS = 5
+
+# Location of the simplified variants, next to the geojson files
+SIMPLIFIED_DIRECTORY = "./geojson/simplified"
+
+# Maximum number of simplified variants that are kept in memory
+VARIANT_CACHE_SIZE = 16
+
+# Images rendered by render.py: width in inches, resolution, size of the
+# points and location of the files
+RENDER_WIDTH = 8
+RENDER_DPI = 150
+RENDER_POINT_SIZE = 4
+RENDER_FILENAME = "./renders/{kind}/{category}/{city}.{format}"
+
+# Location of the embedded database used by database.py
+DATABASE_FILENAME = "./csv/meetup.sqlite"
+
 # Color constants
 POINT_TRANSPARENCY = 0.8
 LAYER_TRANSPARENCY = 0.3
@@ -33,6 +65,19 @@ COLOR_GRADIENTS_LIST = [BLUE_GRADIENT, YELLOW_GRADIENT, RED_GRADIENT,
                         GREEN_GRADIENT, GRAY_GRADIENT, ORANGE_GRADIENT,
                         PURPLE_GRADIENT, CYAN_GRADIENT, MAGENTA_GRADIENT]
 
+# Pixels of the longest side of the heatmaps rendered by heatmap.py
+HEATMAP_RESOLUTION = 512
+
+# Size, in degrees, of the cells whose locations are merged into a weighted
+# centroid (about 50 meters)
+CENTROID_CELL_SIZE = 0.0005
+
+# Gradient of the rendered heatmaps when no color pattern is chosen, similar
+# to the default one of Google Maps
+HEATMAP_GRADIENT = [(0, 0, 0, 0), (0, 255, 0, POINT_TRANSPARENCY),
+                    (255, 255, 0, POINT_TRANSPARENCY),
+                    (255, 0, 0, POINT_TRANSPARENCY)]
+
 # CSV file keys-columns translator
 CSV_FORMAT_TRANSLATOR = {"Population": 1,
                          "Density": 2,
@@ -0,0 +1,446 @@
+# To work with the embedded database
+import sqlite3
+
+# To read the district csv files
+import csv
+
+# To check the modification time of the files
+import os
+
+# To work with arrays
+import numpy as np
+
+# Import local libraries
+from . import mapping as mp
+from . import districts as distr
+from . import aggregates as aggr
+from . import constants as co
+
+# Tables of the database. Each distinct event of a city is stored once in
+# events, with the district where it is located: its position in districts,
+# -1 if it is outside of all of them or NULL if it has no valid coordinates.
+# memberships tells to which categories each event belongs, in the order of
+# the custom csv file, and keeps a copy of its date so categories and time
+# ranges are found with the same index. Coordinates are kept as they are
+# written in the custom csv file, so the events read back are the same.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    city TEXT, kind TEXT, mtime REAL,
+    PRIMARY KEY (city, kind));
+CREATE TABLE IF NOT EXISTS cities (
+    city TEXT PRIMARY KEY, num_activities INTEGER);
+CREATE TABLE IF NOT EXISTS districts (
+    city TEXT, position INTEGER, name TEXT,
+    PRIMARY KEY (city, position));
+CREATE TABLE IF NOT EXISTS district_attributes (
+    city TEXT, position INTEGER, name TEXT,
+    population REAL, density REAL, area REAL,
+    PRIMARY KEY (city, position));
+CREATE TABLE IF NOT EXISTS events (
+    city TEXT, event INTEGER, event_id TEXT,
+    latitude TEXT, longitude TEXT, date INTEGER, name TEXT,
+    district INTEGER,
+    PRIMARY KEY (city, event));
+CREATE TABLE IF NOT EXISTS memberships (
+    city TEXT, category INTEGER, date INTEGER, event INTEGER,
+    position INTEGER);
+CREATE INDEX IF NOT EXISTS memberships_city_category_date
+    ON memberships (city, category, date);
+CREATE INDEX IF NOT EXISTS events_city_district
+    ON events (city, district);
+"""
+
+# Columns of the district_attributes table for each key of the district
+# csv files. The density is computed when it is missing, as in
+# districts.read_district_csv()
+ATTRIBUTE_COLUMNS = {"Population": "population",
+                     "Density": "COALESCE(density, population / area)",
+                     "Area": "area"}
+
+# Default location of the files of each city
+SOURCE_FILENAMES = {"csv": "./csv/{}.csv",
+                    "districts": "./districts/{}.csv",
+                    "geojson": "./geojson/{}.geojson"}
+
+
+def connect_database(filename=co.DATABASE_FILENAME):
+    """
+    It opens the database and creates its tables if they do not exist.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the database.
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the database.
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    connection = sqlite3.connect(filename)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_source_mtimes(city, source_filenames=None):
+    """
+    It reads the modification time of the files of a city.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    source_filenames : dictionary
+        It has the kinds of file ("csv", "districts" and "geojson") as keys
+        and their directory and filename as items. By default,
+        SOURCE_FILENAMES.
+
+    Returns
+    -------
+    mtimes : dictionary
+        It has the kinds of file as keys and their modification time as
+        items, or None if the file does not exist.
+    """
+    if source_filenames is None:
+        source_filenames = SOURCE_FILENAMES
+
+    mtimes = {}
+    for kind, filename in source_filenames.items():
+        filename = filename.format(city)
+        mtimes[kind] = (os.path.getmtime(filename) if os.path.isfile(filename)
+                        else None)
+    return mtimes
+
+
+def parse_float(value):
+    """
+    It converts a field of a file to a float.
+
+    Parameters
+    ----------
+    value : string
+        Field of the file.
+
+    Returns
+    -------
+    number : float
+        The value of the field, or None if it is not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_city_database(city, connection=None, source_filenames=None):
+    """
+    It loads the custom csv file, the district csv file and the geojson file
+    of a city into the database, replacing the rows that it had. Every event
+    is localized once, so later queries only filter and count rows.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    connection : sqlite3.Connection
+        Connection to the database. By default, the one of
+        connect_database().
+    source_filenames : dictionary
+        Files of the city (see get_source_mtimes()).
+    """
+    if connection is None:
+        connection = connect_database()
+    if source_filenames is None:
+        source_filenames = SOURCE_FILENAMES
+
+    mtimes = get_source_mtimes(city, source_filenames)
+
+    events_by_category, num_activities = {}, None
+    if mtimes["csv"] is not None:
+        events_by_category, num_activities = mp.load_custom_csv(
+            source_filenames["csv"].format(city))
+
+    district_names = []
+    if mtimes["geojson"] is not None:
+        district_names = distr.load_district_geometry(
+            source_filenames["geojson"].format(city))["names"]
+
+    attributes = []
+    if mtimes["districts"] is not None:
+        with open(source_filenames["districts"].format(city), 'r') as f:
+            for position, row in enumerate(csv.reader(f, delimiter=';')):
+                row = row + [None] * (4 - len(row))
+                attributes.append((city, position, row[0],
+                                   parse_float(row[1]), parse_float(row[2]),
+                                   parse_float(row[3])))
+
+    # Each distinct event gets a number. Events without id can not be told
+    # apart, so each of them is a different event
+    events = []
+    memberships = []
+    numbers = {}
+    for category_id, category_events in events_by_category.items():
+        for event in category_events:
+            event_id = event["event_id"].strip()
+            key = event_id if event_id != "None" else len(events)
+            if key not in numbers:
+                numbers[key] = len(events)
+                events.append(event)
+            date = None if event["date"] == "None" else int(event["date"])
+            memberships.append((city, category_id, date, numbers[key],
+                                len(memberships)))
+
+    latitude, longitude, date = aggr.get_event_columns(events)
+    valid = ~(np.isnan(latitude) | np.isnan(longitude) |
+              ((latitude == 0) & (longitude == 0)))
+
+    located = np.full(len(events), -1, dtype=np.int64)
+    if len(district_names) > 0 and np.any(valid):
+        located[valid] = distr.classify_points(
+            np.column_stack((latitude[valid], longitude[valid])),
+            source_filenames["geojson"].format(city))
+
+    event_rows = [(city, number, event["event_id"].strip(),
+                   None if event["latitude"] == "None"
+                   else event["latitude"],
+                   None if event["longitude"] == "None"
+                   else event["longitude"],
+                   None if date[number] < 0 else int(date[number]),
+                   event["name"],
+                   int(located[number]) if valid[number] else None)
+                  for number, event in enumerate(events)]
+
+    with connection:
+        for table in ("sources", "cities", "districts",
+                      "district_attributes", "events", "memberships"):
+            connection.execute("DELETE FROM {} WHERE city = ?".format(table),
+                               (city, ))
+        connection.execute("INSERT INTO cities VALUES (?, ?)",
+                           (city, num_activities))
+        connection.executemany("INSERT INTO districts VALUES (?, ?, ?)",
+                               [(city, position, name) for position, name
+                                in enumerate(district_names)])
+        connection.executemany("INSERT INTO district_attributes VALUES " +
+                               "(?, ?, ?, ?, ?, ?)", attributes)
+        connection.executemany("INSERT INTO events VALUES " +
+                               "(?, ?, ?, ?, ?, ?, ?, ?)", event_rows)
+        connection.executemany("INSERT INTO memberships VALUES " +
+                               "(?, ?, ?, ?, ?)", memberships)
+        connection.executemany("INSERT INTO sources VALUES (?, ?, ?)",
+                               [(city, kind, mtime) for kind, mtime
+                                in mtimes.items()])
+
+
+def open_city_database(city, filename=co.DATABASE_FILENAME,
+                       source_filenames=None):
+    """
+    It opens the database and makes sure that the rows of a city are up to
+    date: they are written again if any file of the city changed since they
+    were loaded.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    filename : string
+        Directory and filename of the database.
+    source_filenames : dictionary
+        Files of the city (see get_source_mtimes()).
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the database. It must be closed by the caller.
+    """
+    connection = connect_database(filename)
+
+    stored = dict(connection.execute(
+        "SELECT kind, mtime FROM sources WHERE city = ?", (city, )))
+    mtimes = get_source_mtimes(city, source_filenames)
+
+    if stored != mtimes:
+        write_city_database(city, connection, source_filenames)
+
+    return connection
+
+
+def get_filters(city, category_list=None, time_interval=None):
+    """
+    It builds the conditions of a query on the memberships table.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_list : list of integers
+        These describe all the category ids whose events we want. By default,
+        all the categories.
+    time_interval : 2-dimensional tuple
+        If given, only the events inside of this time interval are selected.
+
+    Returns
+    -------
+    conditions : string
+        Conditions of the WHERE clause.
+    parameters : list
+        Values of the placeholders of the conditions.
+    """
+    conditions = ["m.city = ?"]
+    parameters = [city]
+
+    if category_list is not None:
+        category_list = list(category_list)
+        conditions.append("m.category IN ({})".format(
+            ", ".join("?" * len(category_list))))
+        parameters.extend(category_list)
+
+    if time_interval is not None:
+        conditions.append("m.date BETWEEN ? AND ?")
+        parameters.extend(mp.get_time_range(time_interval))
+
+    return " AND ".join(conditions), parameters
+
+
+def query_custom_csv(city, category_list, time_interval=None,
+                     filename=co.DATABASE_FILENAME, source_filenames=None):
+    """
+    It does the same as mapping.read_custom_csv() but the events are
+    selected by the database, with the index on (city, category, date).
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_list : list of integers
+        These describe all the category ids whose activities we want to search
+        for.
+    time_interval : 2-dimensional tuple
+        If given, only the events inside of this time interval are retrieved.
+    filename : string
+        Directory and filename of the database.
+    source_filenames : dictionary
+        Files of the city (see get_source_mtimes()).
+
+    Returns
+    -------
+    parsed_events : list of dictionaries
+        Events in the same order and with the same format as
+        mapping.read_custom_csv(). An event that belongs to several of the
+        categories is returned once.
+    num_activities : integer
+        Total number of activities that have been found in a specific city.
+    """
+    conditions, parameters = get_filters(city, category_list, time_interval)
+
+    connection = open_city_database(city, filename, source_filenames)
+    try:
+        rows = connection.execute(
+            "SELECT e.latitude, e.longitude, e.date, e.name, e.event_id " +
+            "FROM memberships m JOIN events e " +
+            "ON e.city = m.city AND e.event = m.event " +
+            "WHERE {} GROUP BY m.event ORDER BY MIN(m.position)".format(
+                conditions), parameters).fetchall()
+        num_activities = connection.execute(
+            "SELECT num_activities FROM cities WHERE city = ?",
+            (city, )).fetchone()
+    finally:
+        connection.close()
+
+    # The values are strings, as in the custom csv file, and the id keeps
+    # its line break
+    keys = ["latitude", "longitude", "date", "name", "event_id"]
+    parsed_events = [dict(zip(keys, (str(row[0]), str(row[1]), str(row[2]),
+                                     row[3], row[4] + "\n")))
+                     for row in rows]
+
+    return parsed_events, num_activities[0] if num_activities else None
+
+
+def query_district_csv(city, key="Density", filename=co.DATABASE_FILENAME,
+                       source_filenames=None):
+    """
+    It does the same as districts.read_district_csv() but the data is read
+    from the database.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    key : string
+        It tells which data to retrieve: "Population", "Density" or "Area".
+    filename : string
+        Directory and filename of the database.
+    source_filenames : dictionary
+        Files of the city (see get_source_mtimes()).
+
+    Returns
+    -------
+    districts : dict
+        Dictionary with districts as a key and its corresponding data as a
+        value. Districts without this data are left out.
+    """
+    connection = open_city_database(city, filename, source_filenames)
+    try:
+        rows = connection.execute(
+            "SELECT name, {} AS value FROM district_attributes ".format(
+                ATTRIBUTE_COLUMNS[key]) +
+            "WHERE city = ? AND value IS NOT NULL ORDER BY position",
+            (city, )).fetchall()
+    finally:
+        connection.close()
+
+    return dict(rows)
+
+
+def query_events_per_district(city, category_list=None, time_interval=None,
+                              filename=co.DATABASE_FILENAME,
+                              source_filenames=None):
+    """
+    It does the same as districts.events_per_district() for the events of
+    some categories of a city, but the events are filtered and counted by the
+    database, using the districts where they were localized when the city
+    was loaded.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_list : list of integers
+        These describe all the category ids whose events we want to count. By
+        default, all the categories.
+    time_interval : 2-dimensional tuple
+        If given, only the events inside of this time interval are counted.
+    filename : string
+        Directory and filename of the database.
+    source_filenames : dictionary
+        Files of the city (see get_source_mtimes()).
+
+    Returns
+    -------
+    counter : dictionary
+        It has districts as keys, plus "Not Located", and their number of
+        events as items. An event that belongs to several of the categories
+        is counted once.
+    """
+    conditions, parameters = get_filters(city, category_list, time_interval)
+
+    connection = open_city_database(city, filename, source_filenames)
+    try:
+        district_names = [name for name, in connection.execute(
+            "SELECT name FROM districts WHERE city = ? ORDER BY position",
+            (city, ))]
+        counts = dict(connection.execute(
+            "SELECT e.district, COUNT(DISTINCT e.event) " +
+            "FROM memberships m JOIN events e " +
+            "ON e.city = m.city AND e.event = m.event " +
+            "WHERE {} AND e.district IS NOT NULL ".format(conditions) +
+            "GROUP BY e.district", parameters))
+    finally:
+        connection.close()
+
+    counter = {name: counts.get(position, 0) for position, name in
+               enumerate(district_names)}
+    counter["Not Located"] = counts.get(-1, 0)
+
+    return counter
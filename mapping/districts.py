@@ -3,19 +3,32 @@ import csv
 
 # To handle colors
 from matplotlib.cm import plasma, inferno, Greys, viridis
-from matplotlib.colors import to_hex
 
 # To work with json formatted files
 import json
 
+# To check the modification time of the geojson files
+import os
+
+# To cache the district geometries
+from functools import lru_cache
+
+# To work with arrays
+import numpy as np
+
 # To work with polygons
-from shapely.geometry import Point
 from shapely.geometry.polygon import Polygon
+from shapely.strtree import STRtree
+from shapely import bounds, contains, points as make_points, prepare
 
 # Import local libraries
 from . import mapping as mp
 from . import constants as co
 
+# Colorschemes supported to paint the districts
+COLORSCHEMES = {"Greys": Greys, "viridis": viridis, "inferno": inferno,
+                "plasma": plasma}
+
 
 def read_district_csv(city, key="Density"):
     """
@@ -40,9 +53,20 @@ def read_district_csv(city, key="Density"):
         Dictionary with districts as a key and its corresponding data as a
         value.
     """
+    filename = os.path.abspath('districts/{}.csv'.format(city))
+    mtime = os.path.getmtime(filename)
+    return dict(_read_district_csv(filename, key, mtime))
+
+
+@lru_cache(maxsize=co.DISTRICT_CACHE_SIZE)
+def _read_district_csv(filename, key, mtime):
+    """
+    Cached implementation of read_district_csv(). The modification time is
+    only used as part of the cache key. Callers get a copy of the result.
+    """
     districts = {}
 
-    with open('districts/{}.csv'.format(city), 'r') as f:
+    with open(filename, 'r') as f:
         reader = csv.reader(f, delimiter=';')
 
         index = co.CSV_FORMAT_TRANSLATOR[key]
@@ -58,10 +82,93 @@ def read_district_csv(city, key="Density"):
     return districts
 
 
+def get_colormap(colorscheme=None):
+    """
+    It returns the matplotlib colormap of a colorscheme.
+
+    Parameters
+    ----------
+    colorscheme : string
+        It supports: 'Greys','viridis','inferno and 'plasma'. Any other value
+        gives 'Greys'.
+
+    Returns
+    -------
+    colormap : matplotlib colormap
+        It maps arrays of values in the range of [0,1] to RGBA colors.
+    """
+    return COLORSCHEMES.get(colorscheme, Greys)
+
+
+def normalize_values(values, mode="linear"):
+    """
+    It normalizes an array of values to the range of [0,1].
+
+    Parameters
+    ----------
+    values : array of floats
+        Values to normalize.
+    mode : string
+        It defines how the values are normalized:
+            "linear":   divided by the maximum value
+            "log":      log(1 + value) divided by log(1 + maximum value)
+            "quantile": rank of each value, 0 for the lowest and 1 for the
+                        highest. Equal values share the mean of their ranks.
+
+    Returns
+    -------
+    normalized_values : array of floats
+        Normalized values, in the same order.
+    """
+    values = np.asarray(values, dtype=np.float64)
+
+    if len(values) == 0:
+        return values
+
+    if mode == "quantile":
+        if len(values) == 1:
+            return np.ones(1)
+        sorted_values = np.sort(values)
+        first = np.searchsorted(sorted_values, values, side='left')
+        last = np.searchsorted(sorted_values, values, side='right') - 1
+        return (first + last) / (2 * (len(values) - 1))
+
+    if mode == "log":
+        values = np.log1p(np.maximum(values, 0))
+    elif mode != "linear":
+        raise ValueError("Unknown normalization mode: {}".format(mode))
+
+    biggest_value = values.max()
+    if biggest_value == 0:
+        return np.zeros(len(values))
+
+    return values / biggest_value
+
+
+def to_hex_colors(rgba_colors):
+    """
+    It transforms an array of matplotlib colors to valid CSS colors, as
+    matplotlib.colors.to_hex() does, without alpha.
+
+    Parameters
+    ----------
+    rgba_colors : N x 4 array of floats
+        RGBA colors in the range of [0,1].
+
+    Returns
+    -------
+    hex_colors : list of strings
+        CSS colors with the format "#rrggbb".
+    """
+    channels = np.round(np.asarray(rgba_colors)[:, :3] * 255).astype(int)
+    return ["#{:02x}{:02x}{:02x}".format(*rgb) for rgb in channels.tolist()]
+
+
 def calculate_color(density_dict, colorscheme=None, counter_data=None,
-                    invert=False):
+                    invert=False, mode="linear"):
     """
-    Transforms the population densities to a gmap color for mapping
+    Transforms the population densities to a gmap color for mapping. All the
+    values are normalized and mapped through the colorscheme at once.
 
     Parameters
     ----------
@@ -72,103 +179,102 @@ def calculate_color(density_dict, colorscheme=None, counter_data=None,
         It defines the colorscheme that will be used in the painting of the
         districts. It supports: 'Greys','viridis','inferno and 'plasma'.
     counter_data : dictionary
-        If supplied, it will help to paint the districts according to the
-        number of activities that each one has.
+        Unused, the number of activities must be given as density_dict.
     invert : boolean
         If true, it inverts the colors of the colorscheme.
+    mode : string
+        It defines how the values are normalized: "linear", "log" or
+        "quantile" (see normalize_values()).
 
     Returns
     -------
     gmaps_color : dict
         Dictionary with districts as a key and its gmap color
     """
-    # get the biggest population density in the set
-    biggest_density = max([x for _, x in density_dict.items()])
-
-    # normalize the density according to the maximum
-    normalized_values = {key: val / biggest_density for key, val in
-                         density_dict.items()}
+    normalized_values = normalize_values(list(density_dict.values()), mode)
 
     if invert:
         # invert values v-> (1-v)
-        normalized_values = {key: 1 - val for key, val in
-                             normalized_values.items()}
+        normalized_values = 1 - normalized_values
 
-    """
-        if counter_data is None:
-        # get the biggest population density in the set
-        biggest_density = max([x for _, x in density_dict.items()])
+    # transform the normalized values to matplotlib colors and then to valid
+    # CSS colors
+    colorscheme_func = get_colormap(colorscheme)
+    gmaps_color = to_hex_colors(colorscheme_func(normalized_values))
 
-        # normalize the density according to the maximum
-        normalized_values = {key: val / biggest_density for key, val in
-                             density_dict.items()}
+    return dict(zip(density_dict.keys(), gmaps_color))
 
-        if invert:
-            # invert values v-> (1-v)
-            normalized_values = {key: 1 - val for key, val in
-                                 normalized_values.items()}
-    else:
-        for district_name in counter_data.items():
-            # get the biggest number of activities per district in the set
-            biggest_density = max([x for _, x in density_dict.items()])
 
+def get_district_style(geojson_filename, density_dict, colorscheme=None,
+                       invert=False, mode="linear"):
     """
+    It returns the color of every feature of a geojson file, in the order of
+    the file. The colors are cached by the geojson file, the values, the
+    colorscheme, the inversion and the normalization mode, so maps that only
+    change other options, like the opacity, do not compute them again.
 
-    # define matplotlib colorscheme
-    if colorscheme == 'Greys':
-        colorscheme_func = Greys
-    elif colorscheme == 'plasma':
-        colorscheme_func = plasma
-    elif colorscheme == 'inferno':
-        colorscheme_func = inferno
-    elif colorscheme == 'viridis':
-        colorscheme_func = viridis
-    else:
-        colorscheme_func = Greys
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to a file that contains the information about the
+        districts of a city.
+    density_dict : dict
+        Dictionary with districts as a key and the value to paint as a value.
+        It must contain all the districts of the geojson file.
+    colorscheme : string
+        It defines the colorscheme that will be used in the painting of the
+        districts. It supports: 'Greys','viridis','inferno and 'plasma'.
+    invert : boolean
+        If true, it inverts the colors of the colorscheme.
+    mode : string
+        It defines how the values are normalized: "linear", "log" or
+        "quantile" (see normalize_values()).
 
-    # transform the normalized density to a matplotlib color
-    mpl_color = {key: colorscheme_func(val) for key, val in
-                 normalized_values.items()}
+    Returns
+    -------
+    colors : tuple of strings
+        CSS color of each feature of the geojson file.
+    """
+    geojson_filename = os.path.abspath(geojson_filename)
+    mtime = os.path.getmtime(geojson_filename)
+    return _get_district_style(geojson_filename, mtime,
+                               tuple(density_dict.items()), colorscheme,
+                               invert, mode)
+
+
+@lru_cache(maxsize=co.STYLE_CACHE_SIZE)
+def _get_district_style(geojson_filename, mtime, density_items, colorscheme,
+                        invert, mode):
+    """
+    Cached implementation of get_district_style(). The modification time is
+    only used as part of the cache key.
+    """
+    district_colors = calculate_color(dict(density_items), colorscheme,
+                                      invert=invert, mode=mode)
 
-    # transform from a matplotlib color to a valid CSS color
-    gmaps_color = {key: to_hex(val, keep_alpha=False) for key, val in
-                   mpl_color.items()}
+    districts_geometry = load_district_geometry(geojson_filename)["geometry"]
 
-    return gmaps_color
+    return tuple(district_colors[feature['properties'].get('name')]
+                 for feature in districts_geometry['features'])
 
 
-def events_per_district(events, geojson_filename):
+def get_district_polygons(districts_geometry):
     """
-    This function tries to localize all the event of a city on its districts.
+    It builds the shapely polygons of every district described in a geojson
+    FeatureCollection.
 
     Parameters
     ----------
-    events : list of dictionaries
-        These are the event we want to localize. Parent list contains different
-        events. Dictionaries contain the parsed data with the following format:
-            keys:   ["latitude", "longitude", "date", "name", "event_id"]
-            values: [string, string, integer, string, string]
-    geojson_filename : string
-        It is the direction to a file that contains the information about the
-        districts where we expect to find the events from above.
+    districts_geometry : dictionary
+        It is the parsed content of a geojson file with the districts of a
+        city.
 
     Returns
     -------
-    counter : dictionary
-        It is a dictionary whose keys are all the districts where we have been
-        found events. Their items are the number of matches that have been
-        produced for each district.
+    district_polygons : dictionary
+        Dictionary with districts as a key and the list of polygons that
+        define each district as a value.
     """
-    event_locations = mp.locations_parser(events)
-
-    event_points = []
-
-    for event_location in event_locations:
-        event_points.append(Point(event_location[1], event_location[0]))
-
-    with open(geojson_filename, 'r') as f:
-        districts_geometry = json.load(f)
-
     districts = districts_geometry['features']
     district_polygons = {}
 
@@ -185,26 +291,182 @@ def events_per_district(events, geojson_filename):
 
         district_polygons[name] = polygons
 
-    counter = {}
+    return district_polygons
+
+
+def load_district_geometry(geojson_filename):
+    """
+    It loads the districts of a city from a geojson file. The result is cached
+    by the path and the modification time of the file, so the file is only
+    parsed again when it changes. The number of cached files is bounded by
+    DISTRICT_CACHE_SIZE, dropping the least recently used ones.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to a file that contains the information about the
+        districts of a city.
+
+    Returns
+    -------
+    district_geometry : dictionary
+        Dictionary with the following keys:
+            "geometry":   parsed geojson FeatureCollection
+            "names":      list of district names
+            "name_index": dictionary with district names as keys and their
+                          position in "names" as values
+            "polygons":   array of prepared shapely polygons
+            "bounds":     N x 4 array with the bounding box of each polygon
+            "owners":     array with the position in "names" of the district
+                          that each polygon belongs to
+            "tree":       STRtree spatial index built over "polygons"
+        It is shared between callers, so it must not be modified.
+    """
+    geojson_filename = os.path.abspath(geojson_filename)
+    mtime = os.path.getmtime(geojson_filename)
+    return _load_district_geometry(geojson_filename, mtime)
+
+
+@lru_cache(maxsize=co.DISTRICT_CACHE_SIZE)
+def _load_district_geometry(geojson_filename, mtime):
+    """
+    Cached implementation of load_district_geometry(). The modification time
+    is only used as part of the cache key.
+    """
+    with open(geojson_filename, 'r') as f:
+        districts_geometry = json.load(f)
+
+    district_polygons = get_district_polygons(districts_geometry)
+
+    names = list(district_polygons.keys())
+    polygons = []
+    owners = []
+    for position, polygons_list in enumerate(district_polygons.values()):
+        polygons.extend(polygons_list)
+        owners.extend([position] * len(polygons_list))
+
+    polygons = np.array(polygons, dtype=object)
+    prepare(polygons)
+
+    return {"geometry": districts_geometry,
+            "names": names,
+            "name_index": {name: i for i, name in enumerate(names)},
+            "polygons": polygons,
+            "bounds": bounds(polygons).reshape(-1, 4),
+            "owners": np.array(owners, dtype=np.intp),
+            "tree": STRtree(polygons)}
+
+
+def locate_points(points, district_index):
+    """
+    It finds the district that contains each one of the points supplied. First
+    the bounding boxes of the spatial index are used to get the candidate
+    polygons and then the exact containment test is performed only on them.
+
+    Parameters
+    ----------
+    points : array of shapely points
+        Points that we want to localize. Their coordinates must be given as
+        (longitude, latitude), as in the geojson files.
+    district_index : dictionary
+        Geometry of the districts, as returned by load_district_geometry().
+
+    Returns
+    -------
+    locations : array of integers
+        Position in district_index["names"] of the district where each point
+        is located, or -1 when the point is not inside of any district. When
+        districts overlap, the first one of the geojson file is chosen.
+    """
+    polygons = district_index["polygons"]
+    owners = district_index["owners"]
+
+    # Bounding box prefilter
+    point_ids, polygon_ids = district_index["tree"].query(points)
+
+    # Exact test on the candidate pairs only
+    matches = contains(polygons[polygon_ids], points[point_ids])
+    point_ids = point_ids[matches]
+    polygon_ids = polygon_ids[matches]
+
+    # Keep the first polygon of the file that contains each point
+    first_polygon = np.full(len(points), len(polygons), dtype=np.intp)
+    np.minimum.at(first_polygon, point_ids, polygon_ids)
 
-    for district_name, polygons_list in district_polygons.items():
-        for district_polygon in polygons_list:
-            for event_point in event_points:
-                if district_polygon.contains(event_point):
-                    event_points.remove(event_point)
-                    if district_name not in counter:
-                        counter[district_name] = 1
-                    else:
-                        counter[district_name] += 1
+    return np.append(owners, -1)[first_polygon]
+
+
+def classify_points(coordinates, geojson_filename):
+    """
+    It localizes a whole set of coordinates on the districts of a city in a
+    single call. Points are created and tested in bulk instead of one by one.
+
+    Parameters
+    ----------
+    coordinates : N x 2 array of floats
+        Each row contains the latitude and the longitude of a point.
+    geojson_filename : string
+        It is the direction to a file that contains the information about the
+        districts where we expect to find the points from above.
+
+    Returns
+    -------
+    locations : array of integers
+        Position in the district names list of load_district_geometry() of the
+        district where each point is located, or -1 when the point is not
+        inside of any district.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+
+    # geojson files define their coordinates as (longitude, latitude)
+    event_points = make_points(coordinates[:, 1], coordinates[:, 0])
+
+    district_index = load_district_geometry(geojson_filename)
+
+    return locate_points(event_points, district_index)
+
+
+def events_per_district(events, geojson_filename, time_interval=None):
+    """
+    This function tries to localize all the event of a city on its districts.
+
+    Parameters
+    ----------
+    events : list of dictionaries
+        These are the event we want to localize. Parent list contains different
+        events. Dictionaries contain the parsed data with the following format:
+            keys:   ["latitude", "longitude", "date", "name", "event_id"]
+            values: [string, string, integer, string, string]
+        They can also be given as event columns, e.g. the memory-mapped
+        records returned by mapping.load_city_events().
+    geojson_filename : string
+        It is the direction to a file that contains the information about the
+        districts where we expect to find the events from above.
+    time_interval : 2-dimensional tuple
+        If given, only the events inside of this time interval are counted.
+
+    Returns
+    -------
+    counter : dictionary
+        It is a dictionary whose keys are all the districts where we have been
+        found events. Their items are the number of matches that have been
+        produced for each district.
+    """
+    if type(events) is list:
+        event_locations = mp.locations_parser(events, time_interval)
+    else:
+        event_locations = mp.store_locations_parser(events, time_interval)
 
-    notlocated = len(event_points)
+    locations = classify_points(event_locations, geojson_filename)
+    district_index = load_district_geometry(geojson_filename)
 
-    # If there is any empty district, added it to get a dictionary consistent
-    # with the districts of the city
-    for district_name in district_polygons.keys():
-        if district_name not in counter.keys():
-            counter[district_name] = 0
+    # Districts without events are also included, to get a dictionary
+    # consistent with the districts of the city
+    located = np.bincount(locations[locations >= 0],
+                          minlength=len(district_index["names"]))
+    counter = {district_name: int(number) for district_name, number in
+               zip(district_index["names"], located)}
 
-    counter["Not Located"] = notlocated
+    counter["Not Located"] = int(np.count_nonzero(locations < 0))
 
     return counter
@@ -0,0 +1,361 @@
+# To work with arrays
+import numpy as np
+
+# To create file directories
+import os
+
+# To write png images without a display
+from matplotlib.image import imsave
+
+# Import local libraries
+from . import mapping as mp
+from . import constants as co
+
+# Import the default list of categories
+from meetup.categories import categories as local_categories
+
+
+def get_grid_bounds(locations, padding=0.):
+    """
+    It finds the bounding box of a set of locations.
+
+    Parameters
+    ----------
+    locations : N x 2 array of floats
+        Each row contains the latitude and the longitude of a location.
+    padding : float
+        Margin, in degrees, added to each side of the box.
+
+    Returns
+    -------
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the box.
+    """
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+    south, west = locations.min(axis=0) - padding
+    north, east = locations.max(axis=0) + padding
+    return float(south), float(west), float(north), float(east)
+
+
+def get_grid_shape(bounds, resolution=co.HEATMAP_RESOLUTION):
+    """
+    It computes the number of rows and columns of a grid whose cells are
+    square on the map, i.e. the longitude is shrunk by the cosine of the
+    latitude, as in the Mercator projection.
+
+    Parameters
+    ----------
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the grid.
+    resolution : integer
+        Number of cells of the longest side of the grid.
+
+    Returns
+    -------
+    shape : 2-dimensional tuple of integers
+        Number of rows and columns of the grid.
+    """
+    south, west, north, east = bounds
+    height = max(north - south, 1e-9)
+    width = max((east - west) * np.cos(np.radians((north + south) / 2)),
+                1e-9)
+    scale = resolution / max(height, width)
+    return (max(1, int(round(height * scale))),
+            max(1, int(round(width * scale))))
+
+
+def gaussian_kernel(point_radius=co.POINT_RADIUS):
+    """
+    It builds a one dimensional gaussian kernel that fades out at the radius
+    of the points. It is 1 at its center, so an isolated point has an
+    intensity of 1.
+
+    Parameters
+    ----------
+    point_radius : float
+        Radius of influence of each point, in grid cells.
+
+    Returns
+    -------
+    kernel : array of floats
+        Weights of the cells from -radius to +radius.
+    """
+    radius = max(1, int(np.ceil(point_radius)))
+    sigma = max(point_radius, 1) / 3
+    distances = np.arange(-radius, radius + 1)
+    return np.exp(-distances ** 2 / (2 * sigma ** 2))
+
+
+def smooth_grid(grid, point_radius=co.POINT_RADIUS):
+    """
+    It spreads the counts of a grid with a gaussian kernel. The kernel is
+    separable, so it is applied first to the rows and then to the columns.
+
+    Parameters
+    ----------
+    grid : 2-dimensional array of floats
+        Number of points of each cell.
+    point_radius : float
+        Radius of influence of each point, in grid cells.
+
+    Returns
+    -------
+    smoothed_grid : 2-dimensional array of floats
+        Intensity of each cell, with the same shape as the grid.
+    """
+    kernel = gaussian_kernel(point_radius)
+    radius = len(kernel) // 2
+
+    for axis in (0, 1):
+        padding = [(0, 0), (0, 0)]
+        padding[axis] = (radius, radius)
+        windows = np.lib.stride_tricks.sliding_window_view(
+            np.pad(grid, padding), len(kernel), axis=axis)
+        grid = windows @ kernel
+
+    return grid
+
+
+def density_grid(locations, bounds=None, resolution=co.HEATMAP_RESOLUTION,
+                 point_radius=co.POINT_RADIUS, weights=None):
+    """
+    It bins a set of locations into a 2D histogram and smooths it, giving
+    the same kind of intensities as a heatmap layer.
+
+    Parameters
+    ----------
+    locations : N x 2 array of floats
+        Each row contains the latitude and the longitude of a location.
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the grid. By default, the
+        bounding box of the locations plus the radius of the points.
+    resolution : integer
+        Number of cells of the longest side of the grid.
+    point_radius : float
+        Radius of influence of each point, in grid cells.
+    weights : array of floats
+        Weight of each location. By default, 1.
+
+    Returns
+    -------
+    grid : 2-dimensional array of floats
+        Intensity of each cell. The first row is the northernmost one, as in
+        an image.
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the grid.
+    """
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+
+    if bounds is None:
+        bounds = get_grid_bounds(locations)
+        south, west, north, east = bounds
+        # Leave room for the points at the borders to fade out
+        margin = max(north - south, east - west) * point_radius / resolution
+        bounds = get_grid_bounds(locations, margin)
+
+    south, west, north, east = bounds
+    rows, columns = get_grid_shape(bounds, resolution)
+
+    grid, _, _ = np.histogram2d(locations[:, 0], locations[:, 1],
+                                bins=(rows, columns),
+                                range=((south, north), (west, east)),
+                                weights=weights)
+
+    return smooth_grid(grid[::-1], point_radius), bounds
+
+
+def weighted_centroids(locations, cell_size=co.CENTROID_CELL_SIZE):
+    """
+    It groups a set of locations by the cells of a grid and returns the
+    centroid of each cell that has locations, weighted by their number. They
+    can be given to a weighted heatmap layer instead of all the locations.
+
+    Parameters
+    ----------
+    locations : N x 2 array of floats
+        Each row contains the latitude and the longitude of a location.
+    cell_size : float
+        Size of the cells, in degrees.
+
+    Returns
+    -------
+    centroids : M x 2 array of floats
+        Latitude and longitude of the centroid of each cell.
+    weights : array of integers
+        Number of locations of each cell.
+    """
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+
+    if len(locations) == 0:
+        return locations, np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(locations / cell_size).astype(np.int64)
+    _, cell_index = np.unique(cells, axis=0, return_inverse=True)
+    cell_index = cell_index.ravel()
+
+    weights = np.bincount(cell_index)
+    centroids = np.column_stack(
+        (np.bincount(cell_index, locations[:, 0]) / weights,
+         np.bincount(cell_index, locations[:, 1]) / weights))
+
+    return centroids, weights
+
+
+def colorize_grid(grid, gradient=None, max_intensity=co.MAX_INTENSITY):
+    """
+    It paints the intensities of a grid with a color gradient, as the
+    heatmap layers do.
+
+    Parameters
+    ----------
+    grid : 2-dimensional array of floats
+        Intensity of each cell.
+    gradient : list of 4-dimensional tuples
+        Colors of the gradient, from the lowest to the highest intensity, as
+        (red, green, blue, alpha) with colors in the range of [0,255] and alpha
+        in the range of [0,1]. See the gradients of constants.py. By default,
+        HEATMAP_GRADIENT.
+    max_intensity : float
+        Intensity from which cells get the last color of the gradient.
+
+    Returns
+    -------
+    image : 3-dimensional array of integers
+        RGBA image, with 8 bits per channel.
+    """
+    if gradient is None:
+        gradient = co.HEATMAP_GRADIENT
+
+    colors = np.array(gradient, dtype=np.float64)
+    colors[:, 3] *= 255
+
+    intensity = np.clip(grid / max_intensity, 0, 1)
+    stops = np.linspace(0, 1, len(colors))
+
+    image = np.stack([np.interp(intensity, stops, colors[:, channel])
+                      for channel in range(4)], axis=-1)
+
+    return np.round(image).astype(np.uint8)
+
+
+def render_heatmap(locations, filename, bounds=None, gradient=None,
+                   max_intensity=co.MAX_INTENSITY,
+                   point_radius=co.POINT_RADIUS,
+                   resolution=co.HEATMAP_RESOLUTION):
+    """
+    It renders the heatmap of a set of locations to a png image, which can be
+    laid over a map of the same bounds. No browser is needed.
+
+    Parameters
+    ----------
+    locations : N x 2 array of floats
+        Each row contains the latitude and the longitude of a location.
+    filename : string
+        Directory and filename of the image that is going to be written.
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the image (see density_grid()).
+    gradient : list of 4-dimensional tuples
+        Colors of the gradient (see colorize_grid()).
+    max_intensity : float
+        Intensity from which cells get the last color of the gradient.
+    point_radius : float
+        Radius of influence of each point, in pixels.
+    resolution : integer
+        Number of pixels of the longest side of the image.
+
+    Returns
+    -------
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the image.
+    """
+    grid, bounds = density_grid(locations, bounds, resolution, point_radius)
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    imsave(filename, colorize_grid(grid, gradient, max_intensity))
+
+    return bounds
+
+
+def render_activities(city, categories=None, time_intervals=None,
+                      color_patterns=None, max_intensity=co.MAX_INTENSITY,
+                      filename="./heatmaps/{}/{}.png", bounds=None,
+                      resolution=co.HEATMAP_RESOLUTION):
+    """
+    It does the same as mapping.map_activities() but renders each heatmap to
+    a png image instead of sending the locations to the browser. One image
+    is written per category or, if time_intervals is given, per time
+    interval.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city whose activities we want to render.
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    time_intervals : either a datetime object or a list of datetime objects
+        Time intervals, as in mapping.map_activities().
+    color_patterns : either a string or a list of strings
+        Color patterns of the images, as in mapping.map_activities().
+    max_intensity : float
+        A value that sets the maximum intensity for the heat map.
+    filename : string
+        Directory and filename of the images. It is formatted with the city
+        and the category id or the number of the time interval.
+    bounds : 4-dimensional tuple of floats
+        (south, west, north, east) limits of the images. By default, the same
+        for all the images: the bounding box of all the locations.
+    resolution : integer
+        Number of pixels of the longest side of the images.
+
+    Returns
+    -------
+    images : list of 2-dimensional tuples
+        Filename and (south, west, north, east) bounds of each image.
+    """
+    if categories is None:
+        categories = local_categories
+
+    parsed_color_patterns = mp.color_patterns_parser(color_patterns)
+
+    if time_intervals is not None:
+        time_intervals = mp.datetime_parser(time_intervals)
+        queries = [(index, [i for i in categories], time_interval)
+                   for index, time_interval in enumerate(time_intervals)]
+    else:
+        queries = [(category_id, [category_id, ], None)
+                   for category_id in categories]
+
+    layers = []
+    for key, category_list, time_interval in queries:
+        events_data = mp.load_city_events(city, category_list, time_interval)
+        if type(events_data) is list:
+            locations = np.array(mp.locations_parser(events_data),
+                                 dtype=np.float64).reshape(-1, 2)
+        else:
+            locations = mp.store_locations_parser(events_data)
+        if len(locations) > 0:
+            layers.append((key, locations))
+
+    if len(layers) == 0:
+        return []
+
+    # All the images share the same bounds, so they can be stacked
+    if bounds is None:
+        all_locations = np.concatenate([locations for _, locations in layers])
+        south, west, north, east = get_grid_bounds(all_locations)
+        margin = max(north - south, east - west) * co.POINT_RADIUS / \
+            resolution
+        bounds = get_grid_bounds(all_locations, margin)
+
+    images = []
+    counter = 0
+    for key, locations in layers:
+        image_filename = filename.format(city, key)
+        render_heatmap(locations, image_filename, bounds,
+                       parsed_color_patterns[counter], max_intensity,
+                       co.POINT_RADIUS, resolution)
+        images.append((image_filename, bounds))
+        counter = mp.cyclic_iteration(counter,
+                                      len(parsed_color_patterns) - 1)
+
+    return images
@@ -4,13 +4,26 @@ from . import constants as co
 # Import custom district functions
 from . import districts as distr
 
+# Import the aggregate cubes of events per district
+from . import aggregates as aggr
+
+# Import the simplified variants of the district layers
+from . import simplify as smpl
+
+# Import the density grids of the heatmaps
+from . import heatmap as hm
+
 # Import GMaps Package
 import gmaps
 
+# Import NumPy to work with the event store columns
+import numpy as np
+
 # Import default libraries
 import sys
+import os
 from datetime import datetime
-import json
+from functools import lru_cache
 
 # Import mu_requests functions and MeetUp Key from local files
 """
@@ -19,6 +32,11 @@ need to add './..' directory to the system path. This is done in the
 __init__.py file.
 """
 from meetup.categories import categories as local_categories
+from meetup.event_store import (STORE_FILENAME, MEMMAP_DIRECTORY,
+                                read_event_store, write_event_store,
+                                get_category_events, write_event_memmap,
+                                open_event_memmap, get_memmap_category_events,
+                                get_memmap_filenames)
 
 
 def line_parser(line):
@@ -68,8 +86,14 @@ def read_custom_csv(filename, category_list):
         #0          this zero does not belong to any category id. It tells us
                     that the information that comes after it is the total
                     number of activities of that city.
-        00000       total number of activities
+        00000       total number of activities. An event that belongs to
+                    several categories is counted once.
         !#          end of the section
+    An event that belongs to several categories is written only under the
+    first one. The other categories contain a reference to its id instead:
+        @id         the event with this id also belongs to this category.
+    Events found under several of the categories of category_list are only
+    returned once.
 
     Parameters
     ----------
@@ -90,7 +114,90 @@ def read_custom_csv(filename, category_list):
         Total number of activities that have been found in a specific city.
 
     """
+    events_by_category, num_activities = load_custom_csv(filename)
+
     parsed_events = []
+    found_categories = 0
+    for category_id, events in events_by_category.items():
+        if category_id in category_list:
+            parsed_events.extend(events)
+            found_categories += 1
+
+    if found_categories > 1:
+        parsed_events = unique_events(parsed_events)
+
+    return parsed_events, num_activities
+
+
+def unique_events(events):
+    """
+    It drops the events of a list that are repeated, e.g. the events that
+    belong to several categories. Events are told apart by their id, so all
+    the events without id are kept.
+
+    Parameters
+    ----------
+    events : list of dictionaries
+        Events as returned by read_custom_csv().
+
+    Returns
+    -------
+    unique_events : list of dictionaries
+        The first occurrence of each event, in the same order.
+    """
+    seen_ids = set()
+    kept_events = []
+    for event in events:
+        event_id = event["event_id"].strip()
+        if event_id != "None":
+            if event_id in seen_ids:
+                continue
+            seen_ids.add(event_id)
+        kept_events.append(event)
+    return kept_events
+
+
+def load_custom_csv(filename):
+    """
+    It reads a whole custom csv file in a single pass and arranges its events
+    by category (see read_custom_csv() for the format of the file). References
+    to events of other categories are resolved, so an event that belongs to
+    several categories is the same dictionary in all of them, and events
+    repeated inside of a category are dropped. References to events that are
+    not written earlier in the file are skipped. The result is kept in memory
+    until the modification time of the file changes, so reading several
+    categories of the same city parses the file only once.
+
+    Parameters
+    ----------
+    filename : string
+        It tells the directory where to search for the custom csv file.
+
+    Returns
+    -------
+    events_by_category : dictionary of lists of dictionaries
+        It has category ids as keys, in the order they appear in the file, and
+        the list of events of each category as items. Dictionaries contain the
+        parsed data with the following format:
+            keys:   ["latitude", "longitude", "date", "name", "event_id"]
+            values: [float, float, integer, string, string]
+        It is shared between callers, so it must not be modified.
+    num_activities : integer
+        Total number of activities that have been found in a specific city.
+    """
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    return _load_custom_csv(filename, mtime)
+
+
+@lru_cache(maxsize=co.EVENTS_CACHE_SIZE)
+def _load_custom_csv(filename, mtime):
+    """
+    Cached implementation of load_custom_csv(). The modification time is only
+    used as part of the cache key.
+    """
+    events_by_category = {}
+    events_by_id = {}
     num_activities = None
 
     with open(filename, 'r') as f:
@@ -101,14 +208,228 @@ def read_custom_csv(filename, category_list):
                     line = next(f)
                     num_activities = int(line)
                     line = next(f)
-                if (category_id in category_list):
+                    continue
+                events = events_by_category.setdefault(category_id, [])
+                category_event_ids = set()
+                line = next(f)
+                while (not line.startswith("!#")):
+                    if line.startswith("@"):
+                        event = events_by_id.get(line[1:].strip())
+                        # A reference to an event that is not written
+                        # earlier in the file can not be resolved
+                        if event is None:
+                            print("Skipped the unknown event " +
+                                  "\'{}\' in ".format(line[1:].strip()) +
+                                  "\'{}\'".format(filename))
+                            line = next(f)
+                            continue
+                    else:
+                        event = line_parser(line)
+                    event_id = event["event_id"].strip()
+                    if event_id == "None":
+                        events.append(event)
+                    elif event_id not in category_event_ids:
+                        category_event_ids.add(event_id)
+                        events_by_id.setdefault(event_id, event)
+                        events.append(event)
                     line = next(f)
-                    while (not line.startswith("!#")):
-                        parsed_event = line_parser(line)
-                        parsed_events.append(parsed_event)
-                        line = next(f)
 
-    return parsed_events, num_activities
+    return events_by_category, num_activities
+
+
+def write_city_event_store(city, categories=None,
+                           filename="./csv/{}.csv",
+                           store_filename=STORE_FILENAME,
+                           memmap_directory=MEMMAP_DIRECTORY,
+                           cube_filename=aggr.CUBE_FILENAME):
+    """
+    It creates the binary columnar event store of a city from its custom csv
+    file, so cities that were fetched before the event stores existed can also
+    use them. The aggregate cube of the city is built from it as well.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    filename : string
+        It tells the directory where to search for the custom csv file.
+    store_filename : string
+        Directory and filename of the event store that is going to be written.
+    memmap_directory : string
+        If given, the memory-mapped event files are also written to this
+        directory (see event_store.write_event_memmap()).
+    cube_filename : string
+        If given, the aggregate cube of the city is also written to this file
+        (see aggregates.write_city_cube()).
+    """
+    if categories is None:
+        categories = local_categories
+
+    events_by_category = {}
+    num_activities = None
+
+    for category_id in categories:
+        events_data, num_activities = read_custom_csv(filename.format(city),
+                                                      [category_id, ])
+        events_by_category[category_id] = [
+            {"coordinates": (None if event["latitude"] == "None"
+                             else float(event["latitude"]),
+                             None if event["longitude"] == "None"
+                             else float(event["longitude"])),
+             "date": (None if event["date"] == "None"
+                      else int(event["date"])),
+             "name": event["name"],
+             # Events without id are written as "None" in the csv file
+             "id": (None if event["event_id"].strip() == "None"
+                    else event["event_id"].strip())}
+            for event in events_data]
+
+    columns = write_event_store(store_filename.format(city),
+                                events_by_category, num_activities or 0)
+
+    if memmap_directory is not None:
+        write_event_memmap(memmap_directory.format(city), columns)
+
+    if cube_filename is not None:
+        aggr.write_city_cube(city, categories, filename=cube_filename,
+                             csv_filename=filename)
+
+
+def load_event_store(filename):
+    """
+    It reads an event store (see event_store.read_event_store()). The result
+    is kept in memory until the modification time of the file changes.
+
+    Parameters
+    ----------
+    filename : string
+        It tells the directory where to search for the event store.
+
+    Returns
+    -------
+    store : dictionary
+        Event store as returned by event_store.read_event_store(). It is
+        shared between callers, so it must not be modified.
+    """
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    return _load_event_store(filename, mtime)
+
+
+@lru_cache(maxsize=co.EVENTS_CACHE_SIZE)
+def _load_event_store(filename, mtime):
+    """
+    Cached implementation of load_event_store(). The modification time is
+    only used as part of the cache key.
+    """
+    return read_event_store(filename)
+
+
+def get_time_range(time_interval):
+    """
+    It converts the limits of a time interval to epoch milliseconds, the
+    format of the event dates, so they can be compared as plain integers.
+
+    Parameters
+    ----------
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval as datetime objects.
+
+    Returns
+    -------
+    time_range : 2-dimensional tuple of integers
+        First and last epoch in milliseconds of the time interval.
+    """
+    # Whole seconds and milliseconds are converted apart, so no precision is
+    # lost in the floating point timestamp
+    return tuple(int(limit.replace(microsecond=0).timestamp()) * 1000 +
+                 limit.microsecond // 1000 for limit in time_interval)
+
+
+def is_up_to_date(filename, source_filename):
+    """
+    It tells whether a file built from another one is still valid, i.e. it
+    exists and it is not older than its source.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the built file.
+    source_filename : string
+        Directory and filename of its source. If it does not exist, the built
+        file is the only copy of the data and it is considered valid.
+
+    Returns
+    -------
+    up_to_date : boolean
+        True if the built file can be used.
+    """
+    if not os.path.isfile(filename):
+        return False
+    if not os.path.isfile(source_filename):
+        return True
+    return os.path.getmtime(filename) >= os.path.getmtime(source_filename)
+
+
+def load_city_events(city, category_list, time_interval=None):
+    """
+    It retrieves the events of some categories of a city from the fastest
+    source available: first the memory-mapped event files, then the event
+    store and finally the custom csv file. Event stores older than the custom
+    csv file, e.g. after a refresh or a manual edit, are out of date and are
+    skipped. Event stores are sorted by date, so a time interval is found by
+    binary search.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_list : list of integers
+        These describe all the category ids whose activities we want to get.
+    time_interval : 2-dimensional tuple
+        If given, only the events inside of this time interval are retrieved.
+
+    Returns
+    -------
+    events : either a list of dictionaries or columns of arrays
+        Events as returned by read_custom_csv() when they come from the csv
+        file. Otherwise, an object whose "latitude", "longitude" and "date"
+        items are arrays with one value per event.
+    """
+    time_range = None
+    if time_interval is not None:
+        time_range = get_time_range(time_interval)
+
+    csv_filename = './csv/{}.csv'.format(city)
+
+    # The memory-mapped files are only used if all of them are newer than the
+    # csv file and the last one written is newer than the others
+    memmap_directory = MEMMAP_DIRECTORY.format(city)
+    memmap_filenames = get_memmap_filenames(memmap_directory)
+    if (all(is_up_to_date(filename, csv_filename)
+            for filename in memmap_filenames) and
+            all(is_up_to_date(memmap_filenames[-1], filename)
+                for filename in memmap_filenames[:-1])):
+        return get_memmap_category_events(open_event_memmap(memmap_directory),
+                                          category_list, time_range)
+
+    store_filename = STORE_FILENAME.format(city)
+    if is_up_to_date(store_filename, csv_filename):
+        return get_category_events(load_event_store(store_filename),
+                                   category_list, time_range)
+
+    events_data, num_activities = read_custom_csv(csv_filename,
+                                                  category_list)
+
+    # Events without date are never inside of a time range
+    if time_range is not None:
+        events_data = [event for event in events_data
+                       if event["date"] != "None" and
+                       time_range[0] <= int(event["date"]) <= time_range[1]]
+
+    return events_data
 
 
 def cyclic_iteration(current_position, top):
@@ -264,7 +585,8 @@ def datetime_parser(datetime_list):
 def locations_parser(data, time_interval=None):
     """
     It retrieves the right locations from events data, according to the filters
-    supplied, and parses them.
+    supplied, and parses them. Dates are compared as epoch milliseconds, so no
+    datetime object is built for each event.
 
     Parameters
     ----------
@@ -285,11 +607,13 @@ def locations_parser(data, time_interval=None):
     """
     parsed_locations = []
 
+    if time_interval is not None:
+        start, end = get_time_range(time_interval)
+
     for event in data:
-        event_date = datetime.fromtimestamp(int(event.get("date")) / 1000)
         if time_interval is not None:
-            if ((time_interval[0] > event_date) or
-                    (event_date > time_interval[1])):
+            event_date = int(event.get("date"))
+            if (start > event_date) or (event_date > end):
                 continue
 
         latitude = event.get("latitude")
@@ -306,9 +630,44 @@ def locations_parser(data, time_interval=None):
     return parsed_locations
 
 
+def store_locations_parser(events, time_interval=None):
+    """
+    It does the same as locations_parser() but for the event columns of an
+    event store. Dates are compared as epoch milliseconds, so no datetime
+    object is built for each event.
+
+    Parameters
+    ----------
+    events : dictionary of arrays or array of records
+        Event columns as returned by event_store.get_category_events() or
+        memory-mapped records as returned by
+        event_store.get_memmap_category_events().
+    time_interval : 2-dimensional tuple
+        Contain the limits of the time interval where we want to search for
+        events.
+
+    Returns
+    -------
+    parsed_locations : N x 2 array of floats
+        Each row contains the latitude and the longitude of the location for
+        each event.
+    """
+    latitude = events["latitude"]
+    longitude = events["longitude"]
+
+    valid = ~(np.isnan(latitude) | np.isnan(longitude) |
+              ((latitude == 0) & (longitude == 0)))
+
+    if time_interval is not None:
+        start, end = get_time_range(time_interval)
+        valid &= (events["date"] >= start) & (events["date"] <= end)
+
+    return np.column_stack((latitude[valid], longitude[valid]))
+
+
 def map_activities(city, categories=None, time_intervals=None,
                    color_patterns=None, max_intensity=1, geojson=False,
-                   geojson_options={}, verbose=False):
+                   geojson_options={}, verbose=False, heatmap="points"):
     """
     It creates a gmaps object which is going to be used to plot all the
     activity locations on a map.
@@ -337,10 +696,21 @@ def map_activities(city, categories=None, time_intervals=None,
         Dictionary containing geojson options like
             colorscheme = 'Greys','viridis','inferno','plasma'
             invert = True or False for inverting the colorscheme
+            mode = 'linear', 'log' or 'quantile' normalization
+            zoom = zoom level used to choose a simplified geometry
+            max_bytes = size budget used to choose a simplified geometry
             opacity = int in the range of [0,1]
     verbose : boolean
         If true, it will display the numeric results of the total number of
         events that were found in each district.
+    heatmap : string
+        It defines what is sent to the heatmap layers:
+            "points":    the location of every activity
+            "centroids": the weighted centroids of the activities of each
+                         cell of CENTROID_CELL_SIZE degrees, which are much
+                         fewer in big cities (see heatmap.weighted_centroids())
+        To render the heatmaps without a browser, see
+        heatmap.render_activities().
 
     Returns
     -------
@@ -355,9 +725,11 @@ def map_activities(city, categories=None, time_intervals=None,
         colorscheme = geojson_options.get('colorscheme')
         opacity = geojson_options.get('opacity')
         invert = geojson_options.get('invert', False)
+        mode = geojson_options.get('mode', "linear")
         districts_layer = load_districts_layer(
             city, colorscheme=colorscheme, opacity=opacity, invert=invert,
-            verbose=verbose)
+            verbose=verbose, mode=mode, zoom=geojson_options.get('zoom'),
+            max_bytes=geojson_options.get('max_bytes'))
 
         my_map.add_layer(districts_layer)
 
@@ -385,23 +757,33 @@ def map_activities(city, categories=None, time_intervals=None,
 
     for index, value in iterator:
         if iterator_type == "category":
-            events_data, num_activities = read_custom_csv(
-                './csv/{}.csv'.format(city), [index, ])
-            # Filter those events with wrong or unknown locations
-            locations = locations_parser(events_data)
+            events_data = load_city_events(city, [index, ])
 
         elif iterator_type == "time interval":
-            events_data, num_activities = read_custom_csv(
-                './csv/{}.csv'.format(city), [i for i in categories])
-            # Filter those events with wrong or unknown locations
-            locations = locations_parser(events_data, value)
+            # Only the events inside of the time interval are retrieved, so
+            # they do not need to be filtered again below
+            events_data = load_city_events(city, [i for i in categories],
+                                           value)
+
+        # Filter those events with wrong or unknown locations
+        if type(events_data) is list:
+            locations = locations_parser(events_data)
+        else:
+            locations = [tuple(location) for location in
+                         store_locations_parser(events_data).tolist()]
 
         if (len(locations) == 0):
             print("No local activities were found in " +
                   "{} matching {}: {}".format(city, iterator_type, value))
             continue
 
-        layer = gmaps.heatmap_layer(locations)
+        if heatmap == "centroids":
+            centroids, weights = hm.weighted_centroids(locations)
+            layer = gmaps.heatmap_layer(
+                [tuple(centroid) for centroid in centroids.tolist()],
+                weights=weights.tolist())
+        else:
+            layer = gmaps.heatmap_layer(locations)
 
         layer.gradient = parsed_color_patterns[counter]
 
@@ -416,7 +798,8 @@ def map_activities(city, categories=None, time_intervals=None,
 
 def paint_districts(city, categories=None, time_intervals=None,
                     colorscheme='Grays', opacity=None,
-                    per_capita=False, verbose=False):
+                    per_capita=False, verbose=False, mode="linear",
+                    zoom=None, max_bytes=None):
     """
     It creates a gmaps object which is going to be used to paint all the
     districts in a city according to the number of MeetUp activities that they
@@ -445,6 +828,15 @@ def paint_districts(city, categories=None, time_intervals=None,
     verbose : boolean
         If true, it will display the numeric results of the total number of
         events that were found in each district.
+    mode : string
+        It defines how the number of activities is normalized before painting
+        it: "linear", "log" or "quantile" (see districts.normalize_values()).
+    zoom : integer
+        If supplied, the districts are drawn with a simplified geometry
+        suitable for this zoom level (see simplify.choose_geometry()).
+    max_bytes : integer
+        If supplied instead of zoom, the districts are drawn with the most
+        detailed geometry whose size is within this budget.
 
     Returns
     -------
@@ -458,17 +850,14 @@ def paint_districts(city, categories=None, time_intervals=None,
     if categories is None:
         categories = local_categories
 
-    events_data, num_activities = read_custom_csv(
-        './csv/{}.csv'.format(city), [i for i in categories])
-
-    counter = distr.events_per_district(events_data,
-                                        './geojson/{}.geojson'.format(city))
+    counter = aggr.city_district_counts(city, [i for i in categories])
 
     districts_layer = load_districts_layer(city, colorscheme=colorscheme,
                                            counter_data=counter,
                                            opacity=opacity,
                                            per_capita=per_capita,
-                                           verbose=verbose)
+                                           verbose=verbose, mode=mode,
+                                           zoom=zoom, max_bytes=max_bytes)
     my_map.add_layer(districts_layer)
 
     return my_map
@@ -520,9 +909,53 @@ def get_categories_subset(labels=(), categories=None):
     return categories_subset
 
 
+def get_district_values(city, counter_data=None, per_capita=False):
+    """
+    It computes the value used to paint each district of a city: its
+    population density, its number of activities or its number of activities
+    per capita.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city to which the csv belongs
+    counter_data : dictionary
+        If supplied, the number of activities of each district, as returned
+        by districts.events_per_district(). Otherwise, the population density
+        of the districts is used.
+    per_capita : boolean
+        If true, and if counter_data is provided, it will give the
+        (Number of activites in a district) / (Population in this district)
+        ratio.
+
+    Returns
+    -------
+    density : dictionary
+        It has districts as keys and their values as items.
+    """
+    if counter_data is None:
+        return distr.read_district_csv(city, "Density")
+
+    if per_capita:
+        population = distr.read_district_csv(city, "Population")
+
+    density = {}
+    for district_name, events_number in counter_data.items():
+        if district_name == "Not Located":
+            continue
+        if per_capita:
+            density[district_name] = events_number / \
+                population[district_name]
+        else:
+            density[district_name] = events_number
+
+    return density
+
+
 def load_districts_layer(city, colorscheme, counter_data=None,
                          opacity=None, invert=False, per_capita=False,
-                         verbose=False):
+                         verbose=False, categories=None, time_interval=None,
+                         mode="linear", zoom=None, max_bytes=None):
     """
     Loads and computes for a given city a layer corresponding to the
     district's population density
@@ -549,42 +982,45 @@ def load_districts_layer(city, colorscheme, counter_data=None,
     verbose : boolean
         If true, it will display the numeric results of the total number of
         events that were found in each district.
+    categories : dictionary of categories
+        If supplied instead of counter_data, the districts are painted
+        according to the number of activities of these categories, read from
+        the aggregate cube of the city (see aggregates.city_district_counts()).
+    time_interval : 2-dimensional tuple
+        Used with categories. Only the activities inside of this time interval
+        are counted.
+    mode : string
+        It defines how the values are normalized before painting them:
+        "linear", "log" or "quantile" (see districts.normalize_values()).
+    zoom : integer
+        If supplied, the layer uses a simplified geometry whose simplification
+        can not be noticed at this zoom level (see simplify.choose_geometry()).
+    max_bytes : integer
+        If supplied instead of zoom, the layer uses the most detailed geometry
+        whose size is within this budget.
 
     Returns
     -------
     gmaps geojson layer for mapping
     """
-    with open('geojson/{}.geojson'.format(city), 'r') as f:
-        districts_geometry = json.load(f)
+    if counter_data is None and categories is not None:
+        counter_data = aggr.city_district_counts(
+            city, [i for i in categories], time_interval)
 
-    population = distr.read_district_csv(city, "Population")
+    geojson_filename = 'geojson/{}.geojson'.format(city)
+    districts_geometry = distr.load_district_geometry(
+        geojson_filename)["geometry"]
 
-    if counter_data is None:
-        density = distr.read_district_csv(city, "Density")
+    population = distr.read_district_csv(city, "Population")
 
-    else:
-        if per_capita:
-            density = {}
-            for district_name, events_number in counter_data.items():
-                if district_name == "Not Located":
-                    continue
-                density[district_name] = events_number / \
-                    population[district_name]
-        else:
-            density = {}
-            for district_name, events_number in counter_data.items():
-                if district_name == "Not Located":
-                    continue
-                density[district_name] = events_number
-                # density = counter_data
+    density = get_district_values(city, counter_data, per_capita)
 
-    colors = []
-    district_colors = distr.calculate_color(density, colorscheme,
-                                            invert=invert)
+    # Colors are cached, so only the first map of each style computes them
+    colors = list(distr.get_district_style(geojson_filename, density,
+                                           colorscheme, invert, mode))
 
-    for elem in districts_geometry['features']:
-        current_name = elem['properties'].get('name')
-        colors.append(district_colors[current_name])
+    # The simplified variants have the same features in the same order
+    layer_geometry = smpl.choose_geometry(geojson_filename, zoom, max_bytes)
 
     # set opacity if no argument given
     if opacity is None:
@@ -597,7 +1033,7 @@ def load_districts_layer(city, colorscheme, counter_data=None,
                   counter_data[district_name]) +
                   "  |  Population: {}".format(population[district_name]))
 
-    return gmaps.geojson_layer(districts_geometry, fill_color=colors,
+    return gmaps.geojson_layer(layer_geometry, fill_color=colors,
                                stroke_color=colors, fill_opacity=opacity)
 
 
@@ -620,8 +1056,8 @@ def print_city_districts(city, opacity=None):
         in a Jupyter Notebook.
     """
     my_map = gmaps.figure()
-    with open('geojson/{}.geojson'.format(city), 'r') as f:
-        districts_geometry = json.load(f)
+    districts_geometry = distr.load_district_geometry(
+        'geojson/{}.geojson'.format(city))["geometry"]
     my_map.add_layer(gmaps.geojson_layer(districts_geometry,
                                          stroke_color='black',
                                          fill_opacity=(opacity or
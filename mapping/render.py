@@ -0,0 +1,500 @@
+# To read the options of the command line
+import argparse
+
+# To finish the script with an error code when some image failed
+import sys
+
+# To create file directories
+import os
+
+# To render several images at the same time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# To work with arrays
+import numpy as np
+
+# To draw the maps without a display, pyplot is not used
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from matplotlib.patches import PathPatch
+from matplotlib.collections import PatchCollection
+
+# Import local libraries
+from . import mapping as mp
+from . import districts as distr
+from . import aggregates as aggr
+from . import constants as co
+
+# Import the default lists of categories and cities
+from meetup.categories import categories as local_categories
+from meetup.cities import cities as local_cities
+
+
+def get_ring_path(coordinates):
+    """
+    It builds the vertices and codes of a closed ring of a geojson polygon.
+
+    Parameters
+    ----------
+    coordinates : list of lists of floats
+        (longitude, latitude) of each vertex of the ring.
+
+    Returns
+    -------
+    vertices : N x 2 array of floats
+        Vertices of the ring.
+    codes : array of integers
+        Matplotlib path codes of the vertices.
+    """
+    vertices = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    codes = np.full(len(vertices), Path.LINETO, dtype=Path.code_type)
+    if len(codes) > 0:
+        codes[0] = Path.MOVETO
+        codes[-1] = Path.CLOSEPOLY
+    return vertices, codes
+
+
+def get_feature_paths(districts_geometry):
+    """
+    It converts every feature of a geojson FeatureCollection to a matplotlib
+    path. Holes are kept, as each polygon is a compound path.
+
+    Parameters
+    ----------
+    districts_geometry : dictionary
+        A geojson FeatureCollection.
+
+    Returns
+    -------
+    paths : list of matplotlib paths
+        One path per feature, in the order of the file.
+    """
+    paths = []
+
+    for feature in districts_geometry['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == "Polygon":
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == "MultiPolygon":
+            polygons = geometry['coordinates']
+        else:
+            polygons = []
+
+        rings = [get_ring_path(ring) for polygon in polygons
+                 for ring in polygon if len(ring) > 0]
+
+        if len(rings) == 0:
+            paths.append(Path(np.zeros((0, 2))))
+            continue
+
+        paths.append(Path(np.concatenate([vertices for vertices, _ in rings]),
+                          np.concatenate([codes for _, codes in rings])))
+
+    return paths
+
+
+def new_map_figure(paths, width=co.RENDER_WIDTH):
+    """
+    It creates an empty figure that fits the districts of a city. The
+    longitude is shrunk by the cosine of the latitude, as in the maps.
+
+    Parameters
+    ----------
+    paths : list of matplotlib paths
+        Paths of the districts, as returned by get_feature_paths().
+    width : float
+        Width of the figure, in inches.
+
+    Returns
+    -------
+    figure : matplotlib figure
+        The new figure.
+    axes : matplotlib axes
+        The axes where the map is drawn.
+    """
+    vertices = np.concatenate([path.vertices for path in paths])
+    west, south = vertices.min(axis=0)
+    east, north = vertices.max(axis=0)
+    aspect = 1 / np.cos(np.radians((north + south) / 2))
+
+    height = width * (north - south) * aspect / max(east - west, 1e-9)
+
+    figure = Figure(figsize=(width, max(height, 1)))
+    axes = figure.add_axes((0, 0, 1, 1))
+    axes.set_xlim(west, east)
+    axes.set_ylim(south, north)
+    axes.set_aspect(aspect)
+    axes.set_axis_off()
+
+    return figure, axes
+
+
+def draw_districts(axes, paths, fill_colors="none", edge_color="black",
+                   opacity=1.):
+    """
+    It draws the districts of a city on some axes.
+
+    Parameters
+    ----------
+    axes : matplotlib axes
+        The axes where the districts are drawn.
+    paths : list of matplotlib paths
+        Paths of the districts, as returned by get_feature_paths().
+    fill_colors : either a string or a list of strings
+        Color of all the districts or of each one of them.
+    edge_color : string
+        Color of the borders of the districts.
+    opacity : float
+        Opacity of the districts, in the range of [0,1].
+    """
+    patches = [PathPatch(path) for path in paths]
+    axes.add_collection(PatchCollection(patches, facecolors=fill_colors,
+                                        edgecolors=edge_color,
+                                        linewidths=0.5, alpha=opacity))
+
+
+def save_figure(figure, filename, formats=("png", )):
+    """
+    It saves a figure in several formats.
+
+    Parameters
+    ----------
+    figure : matplotlib figure
+        The figure to save.
+    filename : string
+        Directory and filename of the images. It is formatted with the
+        format of each image as a keyword, e.g. "./renders/Madrid.{format}".
+    formats : list of strings
+        Formats of the images, e.g. "png" or "svg".
+
+    Returns
+    -------
+    filenames : list of strings
+        Filenames of the images that were written.
+    """
+    filenames = []
+
+    for image_format in formats:
+        image_filename = filename.format(format=image_format)
+        os.makedirs(os.path.dirname(image_filename) or '.', exist_ok=True)
+        figure.savefig(image_filename, dpi=co.RENDER_DPI)
+        filenames.append(image_filename)
+
+    return filenames
+
+
+def render_districts(city, filename, categories=None, per_capita=False,
+                     colorscheme=None, invert=False, mode="linear",
+                     time_interval=None, formats=("png", )):
+    """
+    It does the same as mapping.paint_districts() but draws the districts to
+    image files with matplotlib, without gmaps or a browser.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city whose districts we want to paint.
+    filename : string
+        Directory and filename of the images. It is formatted with the format
+        of each image as a keyword, e.g. "./renders/Madrid.{format}".
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    per_capita : boolean
+        If true, the districts are painted according to their number of
+        activities per capita.
+    colorscheme : string
+        It defines the colorscheme that will be used in the painting of the
+        districts. It supports: 'Greys','viridis','inferno and 'plasma'.
+    invert : boolean
+        If true, it inverts the colors of the colorscheme.
+    mode : string
+        It defines how the values are normalized: "linear", "log" or
+        "quantile" (see districts.normalize_values()).
+    time_interval : 2-dimensional tuple
+        If given, only the activities inside of this time interval are
+        counted.
+    formats : list of strings
+        Formats of the images, e.g. "png" or "svg".
+
+    Returns
+    -------
+    filenames : list of strings
+        Filenames of the images that were written.
+    """
+    if categories is None:
+        categories = local_categories
+
+    geojson_filename = './geojson/{}.geojson'.format(city)
+    districts_geometry = distr.load_district_geometry(
+        geojson_filename)["geometry"]
+
+    counter = aggr.city_district_counts(city, [i for i in categories],
+                                        time_interval)
+    density = mp.get_district_values(city, counter, per_capita)
+    colors = list(distr.get_district_style(geojson_filename, density,
+                                           colorscheme, invert, mode))
+
+    paths = get_feature_paths(districts_geometry)
+    figure, axes = new_map_figure(paths)
+    draw_districts(axes, paths, colors, edge_color="white")
+
+    return save_figure(figure, filename, formats)
+
+
+def render_points(city, filename, categories=None, color_patterns=None,
+                  time_interval=None, formats=("png", )):
+    """
+    It does the same as mapping.map_activities() but draws the location of
+    each activity to image files with matplotlib, over the borders of the
+    districts of the city, without gmaps or a browser.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city whose activities we want to draw.
+    filename : string
+        Directory and filename of the images. It is formatted with the format
+        of each image as a keyword, e.g. "./renders/Madrid.{format}".
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+        Each category is drawn with its own color.
+    color_patterns : either a string or a list of strings
+        Color patterns of the categories, as in mapping.map_activities(). The
+        strongest color of each pattern is used.
+    time_interval : 2-dimensional tuple
+        If given, only the activities inside of this time interval are drawn.
+    formats : list of strings
+        Formats of the images, e.g. "png" or "svg".
+
+    Returns
+    -------
+    filenames : list of strings
+        Filenames of the images that were written.
+    """
+    if categories is None:
+        categories = local_categories
+
+    districts_geometry = distr.load_district_geometry(
+        './geojson/{}.geojson'.format(city))["geometry"]
+
+    paths = get_feature_paths(districts_geometry)
+    figure, axes = new_map_figure(paths)
+    draw_districts(axes, paths, edge_color="gray")
+
+    parsed_color_patterns = mp.color_patterns_parser(color_patterns)
+    counter = 0
+
+    for category_id in categories:
+        events_data = mp.load_city_events(city, [category_id, ],
+                                          time_interval)
+        if type(events_data) is list:
+            locations = np.array(mp.locations_parser(events_data),
+                                 dtype=np.float64).reshape(-1, 2)
+        else:
+            locations = mp.store_locations_parser(events_data)
+
+        if len(locations) == 0:
+            continue
+
+        gradient = parsed_color_patterns[counter] or co.HEATMAP_GRADIENT
+        red, green, blue, alpha = gradient[-1]
+        axes.scatter(locations[:, 1], locations[:, 0], s=co.RENDER_POINT_SIZE,
+                     color=(red / 255, green / 255, blue / 255, alpha),
+                     linewidths=0)
+
+        counter = mp.cyclic_iteration(counter,
+                                      len(parsed_color_patterns) - 1)
+
+    return save_figure(figure, filename, formats)
+
+
+def get_render_filename(template, kind, city, category_label):
+    """
+    It builds the filename of an image of the rendering grid. The format is
+    left as a keyword to be formatted by save_figure().
+
+    Parameters
+    ----------
+    template : string
+        Template with the keywords {kind}, {category}, {city} and {format}.
+    kind : string
+        Kind of the image: "activities_of_districts",
+        "activities_per_capita_of_districts" or "points".
+    city : string
+        Name of the city. Its spaces are removed, as in report/images.
+    category_label : string
+        Label of the category, or None for all the categories.
+
+    Returns
+    -------
+    filename : string
+        Filename with only the {format} keyword left.
+    """
+    category = "all" if category_label is None else \
+        category_label.replace("/", "-")
+    return template.format(kind=kind, category=category,
+                           city=city.replace(" ", ""), format="{format}")
+
+
+def render_job(job):
+    """
+    It renders one image of the rendering grid. It is run by the workers of
+    render_grid(), so it reports errors instead of raising them.
+
+    Parameters
+    ----------
+    job : dictionary
+        It has the keys "kind", "city", "category", "template", "formats"
+        and "colorscheme".
+
+    Returns
+    -------
+    result : dictionary
+        The job plus the keys "filenames" and "error".
+    """
+    result = dict(job, filenames=[], error=None)
+
+    filename = get_render_filename(job["template"], job["kind"], job["city"],
+                                   job["category"])
+    try:
+        categories = None
+        if job["category"] is not None:
+            categories = mp.get_categories_subset(job["category"])
+            # Otherwise an empty image would be saved under its name
+            if not categories:
+                result["error"] = "Unknown category: {}".format(
+                    job["category"])
+                return result
+
+        if job["kind"] == "points":
+            result["filenames"] = render_points(job["city"], filename,
+                                                categories,
+                                                formats=job["formats"])
+        else:
+            result["filenames"] = render_districts(
+                job["city"], filename, categories,
+                per_capita=(job["kind"] ==
+                            "activities_per_capita_of_districts"),
+                colorscheme=job["colorscheme"], formats=job["formats"])
+
+    except Exception as error:
+        result["error"] = "{}: {}".format(type(error).__name__, error)
+
+    return result
+
+
+def render_grid(city_list=None, category_labels=(None, ),
+                kinds=("activities_of_districts",
+                       "activities_per_capita_of_districts"),
+                template=co.RENDER_FILENAME, formats=("png", ),
+                colorscheme=None, workers=None):
+    """
+    It renders every combination of cities, categories and kinds of image in
+    a pool of processes.
+
+    Parameters
+    ----------
+    city_list : list of strings
+        Names of the cities. By default, all the cities in meetup.cities.
+    category_labels : list of strings
+        Labels of the categories. None stands for all the categories.
+    kinds : list of strings
+        Kinds of image: "activities_of_districts",
+        "activities_per_capita_of_districts" and "points".
+    template : string
+        Template of the filenames (see get_render_filename()).
+    formats : list of strings
+        Formats of the images, e.g. "png" or "svg".
+    colorscheme : string
+        Colorscheme of the districts.
+    workers : integer
+        Number of processes. By default, the number of processors.
+
+    Returns
+    -------
+    results : list of dictionaries
+        Results of all the jobs, as returned by render_job().
+    """
+    if city_list is None:
+        city_list = list(local_cities.keys())
+
+    jobs = [{"kind": kind, "city": city, "category": category_label,
+             "template": template, "formats": tuple(formats),
+             "colorscheme": colorscheme}
+            for city in city_list
+            for category_label in category_labels
+            for kind in kinds]
+
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_job, job) for job in jobs]
+
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+
+            message = "[{}/{}] {} {} {}: ".format(
+                done, len(futures), result["city"], result["kind"],
+                result["category"] or "all")
+            if result["error"] is None:
+                message += ", ".join(result["filenames"])
+            else:
+                message += "failed ({})".format(result["error"])
+            print(message)
+
+    return results
+
+
+def main(argv=None):
+    """
+    It is the command line entry point of the headless rendering:
+        python -m mapping.render [--cities ...] [--categories ...]
+                                 [--kinds ...] [--formats png svg]
+                                 [--template T] [--workers N]
+
+    Parameters
+    ----------
+    argv : list of strings
+        Arguments of the command line. By default, sys.argv is used.
+
+    Returns
+    -------
+    exit_code : integer
+        0 if all the images were rendered, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        description="Render district and activity maps to image files.")
+    parser.add_argument("--cities", nargs="+",
+                        help="cities to render (default: meetup.cities)")
+    parser.add_argument("--categories", nargs="+", default=[None],
+                        help="category labels, each one rendered apart " +
+                             "(default: all the categories together)")
+    parser.add_argument("--kinds", nargs="+",
+                        default=["activities_of_districts",
+                                 "activities_per_capita_of_districts"],
+                        choices=["activities_of_districts",
+                                 "activities_per_capita_of_districts",
+                                 "points"])
+    parser.add_argument("--formats", nargs="+", default=["png"])
+    parser.add_argument("--template", default=co.RENDER_FILENAME,
+                        help="filenames, with the keywords {kind}, " +
+                             "{category}, {city} and {format}")
+    parser.add_argument("--colorscheme", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    arguments = parser.parse_args(argv)
+
+    results = render_grid(arguments.cities, arguments.categories,
+                          arguments.kinds, arguments.template,
+                          arguments.formats, arguments.colorscheme,
+                          arguments.workers)
+
+    failed = [result for result in results if result["error"] is not None]
+    print("Rendered {} of {} maps".format(len(results) - len(failed),
+                                          len(results)))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,329 @@
+# To work with json formatted files
+import json
+
+# To check the modification time of the geojson files
+import os
+
+# To cache the simplified geometries
+from functools import lru_cache
+
+# To work with arrays
+import numpy as np
+
+# To simplify polygons
+import shapely
+from shapely.geometry import mapping, shape
+
+# Import local libraries
+from . import districts as distr
+from . import constants as co
+
+
+def simplify_geometry(districts_geometry, tolerance,
+                      decimals=co.QUANTIZE_DECIMALS):
+    """
+    It simplifies the districts of a geojson FeatureCollection and quantizes
+    their coordinates. When the districts do not overlap, the borders that
+    they share are simplified together, so no gaps appear between them.
+    Otherwise, each district is simplified on its own, keeping it valid.
+
+    Parameters
+    ----------
+    districts_geometry : dictionary
+        It is the parsed content of a geojson file with the districts of a
+        city.
+    tolerance : float
+        Simplification tolerance, in degrees. Details of the borders smaller
+        than about this size are removed.
+    decimals : integer
+        Number of decimals of the coordinates. 5 decimals are about 1 meter.
+
+    Returns
+    -------
+    simplified_geometry : dictionary
+        A geojson FeatureCollection with the same features and properties.
+    """
+    features = districts_geometry['features']
+    geometries = np.array([shape(feature['geometry']) for feature in features],
+                          dtype=object)
+
+    simplified = None
+    if len(geometries) > 0 and shapely.coverage_is_valid(geometries):
+        try:
+            simplified = shapely.coverage_simplify(geometries, tolerance)
+        except shapely.errors.GEOSException:
+            # Degenerate rings can not be simplified as a coverage
+            simplified = None
+
+    if simplified is None:
+        simplified = shapely.simplify(geometries, tolerance,
+                                      preserve_topology=True)
+
+    # Snapping to the grid keeps the polygons valid, and rounding afterwards
+    # keeps the numbers short when they are written
+    simplified = shapely.set_precision(simplified, 10. ** -decimals)
+    simplified = shapely.transform(simplified,
+                                   lambda coords: np.round(coords, decimals))
+
+    # Districts smaller than the tolerance keep their original shape
+    empty = shapely.is_empty(simplified)
+    simplified[empty] = geometries[empty]
+
+    simplified_features = []
+    for feature, geometry in zip(features, simplified):
+        simplified_feature = dict(feature)
+        simplified_feature['geometry'] = mapping(geometry)
+        simplified_features.append(simplified_feature)
+
+    simplified_geometry = dict(districts_geometry)
+    simplified_geometry['features'] = simplified_features
+
+    # shapely returns tuples, which are converted to lists as in a json file
+    return json.loads(json.dumps(simplified_geometry))
+
+
+def get_geometry_size(districts_geometry):
+    """
+    It computes the size of a geojson FeatureCollection once serialized,
+    which is what is sent to the map widget.
+
+    Parameters
+    ----------
+    districts_geometry : dictionary
+        A geojson FeatureCollection.
+
+    Returns
+    -------
+    size : integer
+        Number of bytes of the serialized geometry.
+    """
+    return len(json.dumps(districts_geometry, separators=(',', ':')))
+
+
+def get_variant_filename(geojson_filename, tolerance,
+                         directory=co.SIMPLIFIED_DIRECTORY):
+    """
+    It returns the filename of a simplified variant of a geojson file.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to the original geojson file.
+    tolerance : float
+        Tolerance of the variant.
+    directory : string
+        Directory where the variants are written.
+
+    Returns
+    -------
+    filename : string
+        Directory and filename of the variant.
+    """
+    name = os.path.splitext(os.path.basename(geojson_filename))[0]
+    return os.path.join(directory, "{}.{:g}.geojson".format(name, tolerance))
+
+
+def write_simplified_geometries(geojson_filename,
+                                tolerances=co.SIMPLIFY_TOLERANCES,
+                                directory=co.SIMPLIFIED_DIRECTORY):
+    """
+    It writes down the simplified variants of a geojson file, one for each
+    tolerance, so they are not computed again in later sessions.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to the original geojson file.
+    tolerances : list of floats
+        Tolerances of the variants, in degrees.
+    directory : string
+        Directory where the variants are written.
+
+    Returns
+    -------
+    sizes : dictionary
+        It has the tolerances as keys and the size in bytes of each variant
+        as items.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    sizes = {}
+    for tolerance in tolerances:
+        simplified_geometry = load_simplified_geometry(geojson_filename,
+                                                       tolerance, directory)
+        filename = get_variant_filename(geojson_filename, tolerance, directory)
+        with open(filename, 'w') as f:
+            json.dump(simplified_geometry, f, separators=(',', ':'))
+        sizes[tolerance] = get_geometry_size(simplified_geometry)
+
+    return sizes
+
+
+def load_simplified_geometry(geojson_filename, tolerance,
+                             directory=co.SIMPLIFIED_DIRECTORY):
+    """
+    It loads a simplified variant of a geojson file. It is read from the
+    directory of variants if it is newer than the original file, otherwise it
+    is computed. The result is cached by the path and the modification time
+    of the original file.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to the original geojson file.
+    tolerance : float
+        Tolerance of the variant, in degrees.
+    directory : string
+        Directory where the variants are written.
+
+    Returns
+    -------
+    simplified_geometry : dictionary
+        A geojson FeatureCollection. It is shared between callers, so it must
+        not be modified.
+    """
+    geojson_filename = os.path.abspath(geojson_filename)
+    mtime = os.path.getmtime(geojson_filename)
+    return _load_simplified_geometry(geojson_filename, mtime, tolerance,
+                                     os.path.abspath(directory))
+
+
+@lru_cache(maxsize=co.VARIANT_CACHE_SIZE)
+def _load_simplified_geometry(geojson_filename, mtime, tolerance, directory):
+    """
+    Cached implementation of load_simplified_geometry(). The modification
+    time is only used as part of the cache key.
+    """
+    filename = get_variant_filename(geojson_filename, tolerance, directory)
+
+    if os.path.isfile(filename) and os.path.getmtime(filename) >= mtime:
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    districts_geometry = distr.load_district_geometry(
+        geojson_filename)["geometry"]
+
+    return simplify_geometry(districts_geometry, tolerance)
+
+
+def load_geometry_size(geojson_filename, tolerance=None,
+                       directory=co.SIMPLIFIED_DIRECTORY):
+    """
+    It computes the serialized size of the original geometry of a geojson
+    file or of one of its simplified variants (see get_geometry_size()). The
+    result is cached by the path and the modification time of the original
+    file, so the geometries are only serialized once.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to the original geojson file.
+    tolerance : float
+        Tolerance of the variant, in degrees. If it is None, the size of the
+        original geometry is computed.
+    directory : string
+        Directory where the variants are written.
+
+    Returns
+    -------
+    size : integer
+        Number of bytes of the serialized geometry.
+    """
+    geojson_filename = os.path.abspath(geojson_filename)
+    mtime = os.path.getmtime(geojson_filename)
+    return _load_geometry_size(geojson_filename, mtime, tolerance,
+                               os.path.abspath(directory))
+
+
+@lru_cache(maxsize=None)
+def _load_geometry_size(geojson_filename, mtime, tolerance, directory):
+    """
+    Cached implementation of load_geometry_size(). The modification time is
+    only used as part of the cache key. Only integers are kept, so the cache
+    is not bounded.
+    """
+    if tolerance is None:
+        districts_geometry = distr.load_district_geometry(
+            geojson_filename)["geometry"]
+    else:
+        districts_geometry = _load_simplified_geometry(
+            geojson_filename, mtime, tolerance, directory)
+
+    return get_geometry_size(districts_geometry)
+
+
+def get_zoom_tolerance(zoom, tolerances=co.SIMPLIFY_TOLERANCES):
+    """
+    It chooses the biggest tolerance whose simplification is hardly seen at
+    a zoom level, i.e. it is smaller than half a pixel of the map. Simplified
+    borders can move a few times the tolerance, so a whole pixel is not used.
+
+    Parameters
+    ----------
+    zoom : integer
+        Zoom level of the map, as in Google Maps.
+    tolerances : list of floats
+        Tolerances of the variants, in degrees.
+
+    Returns
+    -------
+    tolerance : float
+        The chosen tolerance, or None if the original geometry is needed.
+    """
+    # Degrees of longitude covered by a pixel of a 256 pixels wide tile
+    pixel_size = 360. / (256 * 2 ** zoom)
+
+    fitting = [tolerance for tolerance in tolerances
+               if tolerance <= pixel_size / 2]
+
+    return max(fitting) if fitting else None
+
+
+def choose_geometry(geojson_filename, zoom=None, max_bytes=None,
+                    tolerances=co.SIMPLIFY_TOLERANCES):
+    """
+    It chooses the geometry that is sent to the map: the original one or a
+    simplified variant. With a zoom level, the biggest tolerance smaller than
+    half a pixel is used. With a size budget, the most detailed geometry
+    within the budget is used, or the coarsest variant if none fits (see
+    load_geometry_size()). The district of the events is always found with
+    the original geometry.
+
+    Parameters
+    ----------
+    geojson_filename : string
+        It is the direction to the original geojson file.
+    zoom : integer
+        Zoom level of the map, as in Google Maps.
+    max_bytes : integer
+        Maximum size of the serialized geometry.
+    tolerances : list of floats
+        Tolerances of the variants, in degrees.
+
+    Returns
+    -------
+    districts_geometry : dictionary
+        A geojson FeatureCollection with the features in the same order as
+        the original file. It must not be modified.
+    """
+    original_geometry = distr.load_district_geometry(
+        geojson_filename)["geometry"]
+
+    if zoom is not None:
+        tolerance = get_zoom_tolerance(zoom, tolerances)
+        if tolerance is None:
+            return original_geometry
+        return load_simplified_geometry(geojson_filename, tolerance)
+
+    if max_bytes is not None:
+        if load_geometry_size(geojson_filename) <= max_bytes:
+            return original_geometry
+        simplified_geometry = original_geometry
+        for tolerance in sorted(tolerances):
+            simplified_geometry = load_simplified_geometry(geojson_filename,
+                                                           tolerance)
+            if load_geometry_size(geojson_filename, tolerance) <= max_bytes:
+                return simplified_geometry
+        return simplified_geometry
+
+    return original_geometry
@@ -1 +1,2 @@
 from . import mu_requests
+from . import event_store
@@ -0,0 +1,511 @@
+# To work with arrays and to save them to disk
+import numpy as np
+
+# To create file directories
+import os
+
+# To replace the memory-mapped event files atomically
+import tempfile
+
+# Default location of the event stores and of the aggregate cubes (see
+# mapping.aggregates), next to the custom csv files
+STORE_FILENAME = "./csv/{}.npz"
+MEMMAP_DIRECTORY = "./csv/{}.mmap"
+CUBE_FILENAME = "./csv/{}.cube.npz"
+
+# Files of the memory-mapped event stores, in the order they are written.
+# events.npy is the last one, so it is never older than the others in a
+# complete store.
+MEMMAP_FILENAMES = ("strings.npy", "categories.npy", "events.npy")
+
+# Fixed width record of an event in the memory-mapped event files. Strings
+# are (start, end) offsets into a separate utf-8 encoded array of bytes.
+EVENT_DTYPE = np.dtype([("latitude", "<f8"), ("longitude", "<f8"),
+                        ("date", "<i8"), ("category", "<i2"),
+                        ("name_start", "<i8"), ("name_end", "<i8"),
+                        ("id_start", "<i8"), ("id_end", "<i8")])
+
+# Values used when an event has no coordinates or no date
+MISSING_COORDINATE = np.nan
+MISSING_DATE = -1
+
+
+def build_event_columns(events_by_category, num_activities):
+    """
+    It arranges the events of a city in typed columns. The events are grouped
+    by their category, so all the events of a category are a contiguous slice
+    of each column, and sorted by date inside of each category, so time
+    ranges can be found by binary search (see get_time_slice()). The
+    following arrays are built:
+        latitude, longitude:    float64 (NaN when unknown)
+        date:                   int64 epoch in milliseconds (-1 when unknown)
+        category:               int16 category id
+        name_index, id_index:   int32 positions in the names and ids arrays
+        names, ids:             unique strings
+        category_ids:           int16 ids of the categories in the file
+        category_offsets:       int64 start of each category in the columns,
+                                with an extra item with the number of events
+        num_activities:         total number of activities of the city
+        date_sorted:            true, the categories are sorted by date
+
+    Parameters
+    ----------
+    events_by_category : dictionary of lists of dictionaries
+        It has category ids as keys and the events of each category as items.
+        Events are dictionaries with the format returned by
+        mu_requests.data_parser():
+            keys:   ["coordinates", "date", "name", "id"]
+            values: [(float, float), integer, string, string]
+    num_activities : integer
+        Total number of activities that were found in that city.
+
+    Returns
+    -------
+    columns : dictionary of arrays
+        It contains all the arrays described above.
+    """
+    latitudes = []
+    longitudes = []
+    dates = []
+    event_categories = []
+    names = []
+    ids = []
+    category_ids = []
+    category_offsets = [0]
+
+    for category_id, events in events_by_category.items():
+        # Events without date go first, as their date is MISSING_DATE
+        events = sorted(events, key=lambda event: MISSING_DATE
+                        if event["date"] is None else event["date"])
+        for event in events:
+            latitude, longitude = event["coordinates"]
+            latitudes.append(MISSING_COORDINATE if latitude is None
+                             else latitude)
+            longitudes.append(MISSING_COORDINATE if longitude is None
+                              else longitude)
+            dates.append(MISSING_DATE if event["date"] is None
+                         else event["date"])
+            event_categories.append(category_id)
+            # Line breaks are removed as in the custom csv files
+            names.append("" if event["name"] is None
+                         else event["name"].replace('\n', ' '))
+            ids.append("" if event["id"] is None else event["id"])
+        category_ids.append(category_id)
+        category_offsets.append(len(dates))
+
+    unique_names, name_index = np.unique(np.array(names, dtype=str),
+                                         return_inverse=True)
+    unique_ids, id_index = np.unique(np.array(ids, dtype=str),
+                                     return_inverse=True)
+
+    columns = {"latitude": np.array(latitudes, dtype=np.float64),
+               "longitude": np.array(longitudes, dtype=np.float64),
+               "date": np.array(dates, dtype=np.int64),
+               "category": np.array(event_categories, dtype=np.int16),
+               "name_index": name_index.astype(np.int32),
+               "id_index": id_index.astype(np.int32),
+               "names": unique_names,
+               "ids": unique_ids,
+               "category_ids": np.array(category_ids, dtype=np.int16),
+               "category_offsets": np.array(category_offsets, dtype=np.int64),
+               "num_activities": np.int64(num_activities),
+               "date_sorted": np.bool_(True)}
+
+    return columns
+
+
+def write_event_store(filename, events_by_category, num_activities):
+    """
+    It writes down the events of a city to a binary columnar file (.npz). See
+    build_event_columns() for the arrays that are saved.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the file that is going to be written.
+    events_by_category : dictionary of lists of dictionaries
+        It has category ids as keys and the events of each category as items,
+        with the format returned by mu_requests.data_parser().
+    num_activities : integer
+        Total number of activities that were found in that city.
+
+    Returns
+    -------
+    columns : dictionary of arrays
+        It contains all the arrays that were saved.
+    """
+    columns = build_event_columns(events_by_category, num_activities)
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, **columns)
+
+    return columns
+
+
+def read_event_store(filename):
+    """
+    It reads a binary columnar file written by write_event_store().
+
+    Parameters
+    ----------
+    filename : string
+        It tells the directory where to search for the event store.
+
+    Returns
+    -------
+    store : dictionary
+        It contains all the arrays of the file plus a "category_index"
+        dictionary, which has category ids as keys and (start, end) tuples
+        with the slice of the columns of each category as items.
+    """
+    with np.load(filename) as data:
+        store = {key: data[key] for key in data.files}
+
+    offsets = store["category_offsets"]
+    store["category_index"] = {int(category_id): (int(offsets[i]),
+                                                  int(offsets[i + 1]))
+                               for i, category_id in
+                               enumerate(store["category_ids"])}
+    store["num_activities"] = int(store["num_activities"])
+    # Stores written before the events were sorted by date
+    store["date_sorted"] = bool(store.get("date_sorted", False))
+
+    return store
+
+
+def get_time_slice(dates, start, end, time_range):
+    """
+    It finds the events of a category that are inside of a time range by
+    binary search, so only O(log n) dates are read.
+
+    Parameters
+    ----------
+    dates : array of integers
+        Dates of the events of a store, in epoch milliseconds.
+    start : integer
+        Position of the first event of the category in the store.
+    end : integer
+        Position after the last event of the category in the store.
+    time_range : 2-dimensional tuple of integers
+        First and last epoch in milliseconds of the range, both included.
+
+    Returns
+    -------
+    events_slice : slice
+        Positions in the store of the events inside of the time range.
+    """
+    category_dates = dates[start:end]
+    first = np.searchsorted(category_dates, time_range[0], side='left')
+    last = np.searchsorted(category_dates, time_range[1], side='right')
+    return slice(start + int(first), start + int(last))
+
+
+def get_category_slices(category_index, dates, category_list,
+                        time_range=None, date_sorted=True):
+    """
+    It finds the slices of a store with the events that belong to some
+    categories and, optionally, to a time range.
+
+    Parameters
+    ----------
+    category_index : dictionary
+        It has category ids as keys and (start, end) tuples as items.
+    dates : array of integers
+        Dates of the events of the store, in epoch milliseconds.
+    category_list : list of integers
+        These describe all the category ids whose activities we want to get.
+    time_range : 2-dimensional tuple of integers
+        First and last epoch in milliseconds of the range, both included.
+    date_sorted : boolean
+        If false, the store is not sorted by date and the time range is
+        ignored here, so it must be applied afterwards.
+
+    Returns
+    -------
+    slices : list of slices
+        One slice per category found in the store.
+    """
+    slices = []
+
+    for category_id in category_list:
+        if category_id not in category_index:
+            continue
+        start, end = category_index[category_id]
+        if time_range is not None and date_sorted:
+            slices.append(get_time_slice(dates, start, end, time_range))
+        else:
+            slices.append(slice(start, end))
+
+    return slices
+
+
+def unique_event_mask(keys, known):
+    """
+    It finds the first occurrence of each event among the events of several
+    categories, so an event that belongs to more than one of them is only
+    counted once.
+
+    Parameters
+    ----------
+    keys : array
+        Key of the id of each event, e.g. its position in the ids array.
+    known : array of booleans
+        True for the events with an id. Events without id can not be told
+        apart, so all of them are kept.
+
+    Returns
+    -------
+    mask : array of booleans
+        True for the events that are kept.
+    """
+    mask = ~known
+    _, first = np.unique(keys[known], return_index=True)
+    mask[np.flatnonzero(known)[first]] = True
+    return mask
+
+
+def get_category_events(store, category_list, time_range=None):
+    """
+    It retrieves the columns of the events that belong to some categories.
+    Each category is a slice of the store, so no scan over the whole file is
+    needed. A time range is also found by binary search inside of each slice.
+    An event that belongs to several of the categories is retrieved once.
+
+    Parameters
+    ----------
+    store : dictionary
+        Event store as returned by read_event_store().
+    category_list : list of integers
+        These describe all the category ids whose activities we want to get.
+    time_range : 2-dimensional tuple of integers
+        If given, only the events from the first to the last epoch in
+        milliseconds of the range, both included, are retrieved.
+
+    Returns
+    -------
+    events : dictionary of arrays
+        It has the keys "latitude", "longitude", "date", "category", "name"
+        and "id". Each array contains one item per event.
+    """
+    slices = get_category_slices(store["category_index"], store["date"],
+                                 category_list, time_range,
+                                 store["date_sorted"])
+
+    columns = {"latitude": store["latitude"],
+               "longitude": store["longitude"],
+               "date": store["date"],
+               "category": store["category"],
+               "name_index": store["name_index"],
+               "id_index": store["id_index"]}
+
+    if len(slices) == 1:
+        columns = {key: column[slices[0]] for key, column in columns.items()}
+    else:
+        columns = {key: np.concatenate([column[s] for s in slices] or
+                                       [column[:0]])
+                   for key, column in columns.items()}
+
+    if time_range is not None and not store["date_sorted"]:
+        dates = columns["date"]
+        in_range = (dates >= time_range[0]) & (dates <= time_range[1])
+        columns = {key: column[in_range] for key, column in columns.items()}
+
+    if len(slices) > 1:
+        known = store["ids"][columns["id_index"]] != ""
+        unique = unique_event_mask(columns["id_index"], known)
+        columns = {key: column[unique] for key, column in columns.items()}
+
+    events = {key: columns[key] for key in
+              ("latitude", "longitude", "date", "category")}
+    events["name"] = store["names"][columns["name_index"]]
+    events["id"] = store["ids"][columns["id_index"]]
+
+    return events
+
+
+def write_event_memmap(directory, store):
+    """
+    It writes down the events of a city as fixed width records that can be
+    memory-mapped (see open_event_memmap()). Three files are created in the
+    directory:
+        events.npy:     one EVENT_DTYPE record per event
+        strings.npy:    utf-8 encoded bytes of the names and ids
+        categories.npy: (category id, start, end, date sorted) of the
+                        records of each category
+    Each file is written to a temporary file and then renamed, in the order
+    of MEMMAP_FILENAMES, so readers never see a file half written and an
+    interrupted run leaves events.npy older than the other files (see
+    get_memmap_filenames()).
+
+    Parameters
+    ----------
+    directory : string
+        Directory where the files are going to be written.
+    store : dictionary of arrays
+        Event columns as returned by build_event_columns() or
+        read_event_store().
+    """
+    # Every unique string is written once and shared by all its events
+    encoded_strings = [string.encode("utf-8") for string in
+                       np.concatenate((store["names"], store["ids"]))]
+    lengths = np.array([len(string) for string in encoded_strings],
+                       dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    strings = np.frombuffer(b"".join(encoded_strings), dtype=np.uint8)
+
+    id_offset = len(store["names"])
+
+    events = np.zeros(len(store["date"]), dtype=EVENT_DTYPE)
+    for key in ("latitude", "longitude", "date", "category"):
+        events[key] = store[key]
+    events["name_start"] = starts[store["name_index"]]
+    events["name_end"] = ends[store["name_index"]]
+    events["id_start"] = starts[id_offset + store["id_index"]]
+    events["id_end"] = ends[id_offset + store["id_index"]]
+
+    offsets = store["category_offsets"]
+    date_sorted = np.full(len(store["category_ids"]),
+                          bool(store.get("date_sorted", False)),
+                          dtype=np.int64)
+    categories = np.column_stack((store["category_ids"].astype(np.int64),
+                                  offsets[:-1], offsets[1:], date_sorted))
+
+    os.makedirs(directory, exist_ok=True)
+    arrays = {"events.npy": events, "strings.npy": strings,
+              "categories.npy": categories}
+    for filename in MEMMAP_FILENAMES:
+        descriptor, temporary_filename = tempfile.mkstemp(dir=directory,
+                                                          suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as f:
+                np.save(f, arrays[filename])
+            os.replace(temporary_filename, os.path.join(directory, filename))
+        except BaseException:
+            os.remove(temporary_filename)
+            raise
+
+
+def get_memmap_filenames(directory):
+    """
+    It returns the paths of the files written by write_event_memmap(). The
+    files belong to the same store only if the last one, events.npy, is not
+    older than the others.
+
+    Parameters
+    ----------
+    directory : string
+        Directory where the files were written.
+
+    Returns
+    -------
+    filenames : list of strings
+        Paths of the files, in the order of MEMMAP_FILENAMES.
+    """
+    return [os.path.join(directory, filename) for filename in
+            MEMMAP_FILENAMES]
+
+
+def open_event_memmap(directory):
+    """
+    It opens the files written by write_event_memmap() as memory-mapped
+    arrays, so nothing is read from disk until it is accessed.
+
+    Parameters
+    ----------
+    directory : string
+        Directory where the files were written.
+
+    Returns
+    -------
+    memmap_store : dictionary
+        It has the keys "events" (memory-mapped EVENT_DTYPE records),
+        "strings" (memory-mapped bytes), "category_index" (dictionary with
+        category ids as keys and (start, end) tuples as items) and
+        "date_sorted" (true if the records of each category are sorted by
+        date).
+    """
+    categories = np.load(os.path.join(directory, "categories.npy"))
+
+    # Files written before the events were sorted by date have no fourth
+    # column
+    date_sorted = (categories.shape[1] > 3 and
+                   bool(np.all(categories[:, 3])))
+
+    return {"events": np.load(os.path.join(directory, "events.npy"),
+                              mmap_mode='r'),
+            "strings": np.load(os.path.join(directory, "strings.npy"),
+                               mmap_mode='r'),
+            "category_index": {int(row[0]): (int(row[1]), int(row[2]))
+                               for row in categories},
+            "date_sorted": date_sorted}
+
+
+def get_memmap_category_events(memmap_store, category_list,
+                               time_range=None):
+    """
+    It retrieves the records of the events that belong to some categories. A
+    single category is returned as a view of the memory-mapped file, without
+    copying it. A time range is found by binary search inside of each
+    category, so only the records inside of it are read. An event that
+    belongs to several of the categories is retrieved once.
+
+    Parameters
+    ----------
+    memmap_store : dictionary
+        Memory-mapped events as returned by open_event_memmap().
+    category_list : list of integers
+        These describe all the category ids whose activities we want to get.
+    time_range : 2-dimensional tuple of integers
+        If given, only the events from the first to the last epoch in
+        milliseconds of the range, both included, are retrieved.
+
+    Returns
+    -------
+    events : array of EVENT_DTYPE records
+        Their fields can be accessed as columns, e.g. events["latitude"].
+    """
+    events = memmap_store["events"]
+    slices = get_category_slices(memmap_store["category_index"],
+                                 events["date"], category_list, time_range,
+                                 memmap_store["date_sorted"])
+
+    if len(slices) == 1:
+        events = events[slices[0]]
+    else:
+        events = np.concatenate([events[s] for s in slices] or [events[:0]])
+
+    if time_range is not None and not memmap_store["date_sorted"]:
+        events = events[(events["date"] >= time_range[0]) &
+                        (events["date"] <= time_range[1])]
+
+    if len(slices) > 1:
+        # The same id is always stored at the same position of the strings
+        events = events[unique_event_mask(events["id_start"],
+                                          events["id_end"] >
+                                          events["id_start"])]
+
+    return events
+
+
+def get_memmap_string(memmap_store, start, end):
+    """
+    It decodes a name or an id of a memory-mapped event.
+
+    Parameters
+    ----------
+    memmap_store : dictionary
+        Memory-mapped events as returned by open_event_memmap().
+    start : integer
+        Value of the "name_start" or "id_start" field of the event.
+    end : integer
+        Value of the "name_end" or "id_end" field of the event.
+
+    Returns
+    -------
+    string : string
+        The decoded string.
+    """
+    return memmap_store["strings"][start:end].tobytes().decode("utf-8")
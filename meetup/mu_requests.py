@@ -1,155 +1,430 @@
-from time import sleep
-import requests
+from time import sleep, monotonic, time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
+import json
+from network.session import PooledSession, is_retryable
 from .cities import cities
 from .categories import categories as local_categories
+from .event_store import (STORE_FILENAME, MEMMAP_DIRECTORY, CUBE_FILENAME,
+                          write_event_store, write_event_memmap)
 
 max_elems_per_page = 200
-params = {'sign': 'true', 'page': max_elems_per_page}
 
+# Number of (city, category) searches that are fetched at the same time
+max_workers = 4
 
-def add_key(mu_key):
+# Requests per second allowed by the rate limiter and maximum burst
+requests_per_second = 1
+max_burst_requests = 4
+
+# Journal with the checkpoints of the runs that fetch and save events
+journal_filename = "./csv/ingestion.journal.jsonl"
+
+
+class RateLimiter(object):
     """
-    Add key to the MeetUp's parameter dictionary
+    Token bucket that limits the requests made to the MeetUp API. It is shared
+    by all the threads that fetch events, so the whole process respects the
+    same limit. The throttling headers of the MeetUp responses are also
+    honoured: when no requests remain, all the threads wait until the limit
+    is reset.
 
     Parameters
     ----------
-    mu_key : string
-        This is the MeetUp API key
+    rate : float
+        Number of requests per second.
+    capacity : integer
+        Maximum number of requests that can be made in a burst.
     """
-    params['key'] = mu_key
 
+    def __init__(self, rate=requests_per_second, capacity=max_burst_requests):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = self.updated
+        self.lock = Lock()
 
-def restore_meetup_params():
-    """
-    """
-    global params
-    mu_key = params["key"]
-    params = {'sign': 'true', 'page': max_elems_per_page, 'key': mu_key}
+    def acquire(self):
+        """
+        It waits until a new request can be made.
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now,
+                           (1 - self.tokens) / self.rate)
+            sleep(wait)
 
+    def update(self, headers):
+        """
+        It adjusts the limiter according to the throttling headers of a
+        MeetUp response.
 
-def get_open_events():
+        Parameters
+        ----------
+        headers : dictionary
+            Headers of the response. X-RateLimit-Remaining tells how many
+            requests are left and X-RateLimit-Reset how many seconds are left
+            until the limit is reset.
+        """
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+
+        with self.lock:
+            if remaining <= 0:
+                self.tokens = 0
+                self.blocked_until = max(self.blocked_until,
+                                         monotonic() + reset)
+            else:
+                self.tokens = min(self.tokens, remaining)
+
+
+rate_limiter = RateLimiter()
+
+
+def is_json_response(response):
     """
-    This function makes a request to the MeetUp API in order to obtain open
-    events according to the parameters previously defined in params dictionary.
-    In case that something goes wrong when reading the request answer during
-    the json translation, the function calls itself in order to try to get
-    the requested data again.
-    These error readings are usually detected in this process but, after
-    several attempts, the function is able to get the right data from MeetUp.
+    It checks that a MeetUp answer can be read, so the session retries the
+    request otherwise.
+
+    Parameters
+    ----------
+    response : response object
+        It is the answer of the MeetUp API.
 
     Returns
     -------
-    json : JSON formatted list
-        This JSON formated list contains information of the requested events.
+    valid : boolean
+        True if the answer is a valid json.
     """
-    r = requests.get("http://api.meetup.com/2/open_events", params=params)
+    if not is_retryable(response):
+        return False
     try:
-        json = r.json()
-        if 'code' in json:
-            if "key" in params:
-                print(" Client throttled, " +
-                      "use another key or try it again later")
-            else:
-                print("MeetUp key required. Add it by calling add_key() " +
-                      "function")
-            sys.exit(0)
-        return json
-    except Exception:
+        response.json()
+    except ValueError:
         print(" Reading error, trying again")
-        return get_open_events()
+        return False
+    return True
 
 
-def get_categories():
+class MeetupClient(object):
     """
-    This function makes a request to the MeetUp API in order to obtain a list
-    of the available categories for all the MeetUp activities.
-    In case that something goes wrong when reading the request answer during
-    the json translation, the function calls itself in order to try to get
-    the requested data again.
-    These error readings are not detected in this process very often but, after
-    several attempts, the function is able to get the right data from MeetUp.
-
-    Returns
-    -------
-    json : JSON formatted list
-        This JSON formated list contains all the available categories.
+    Client of the MeetUp API. Each client has its own HTTP session, key and
+    rate limiter, and every request is made with its own copy of the
+    parameters, so a client can be shared by several threads and several
+    clients can fetch different cities at the same time.
 
+    Parameters
+    ----------
+    key : string
+        This is the MeetUp API key.
+    limiter : RateLimiter
+        Rate limiter of the requests. If it is not given, the client gets its
+        own one.
+    session : PooledSession
+        HTTP session of the requests. If it is not given, the client gets its
+        own one.
     """
-    categories = []
-    r = requests.get("http://api.meetup.com/2/categories", params=params)
-    try:
-        json = r.json()
+
+    def __init__(self, key=None, limiter=None, session=None):
+        self.key = key
+        self.session = session if session is not None else PooledSession()
+        self.limiter = limiter if limiter is not None else RateLimiter()
+
+    def get_params(self):
+        """
+        It returns a new dictionary with the parameters shared by all the
+        requests.
+
+        Returns
+        -------
+        params : dictionary
+            Parameters for the MeetUp API.
+        """
+        params = {'sign': 'true', 'page': max_elems_per_page}
+        if self.key is not None:
+            params['key'] = self.key
+        return params
+
+    def get_json(self, url, request_params):
+        """
+        It makes a request to the MeetUp API and translates its answer.
+        In case that something goes wrong when reading the request answer
+        during the json translation, the request is made again with a bounded
+        backoff, as long as the retry budget of the session allows it.
+
+        Parameters
+        ----------
+        url : string
+            Address of the MeetUp API method.
+        request_params : dictionary
+            Parameters of the request.
+
+        Returns
+        -------
+        json : JSON formatted list
+            The answer of the MeetUp API.
+        """
+        r = self.session.get(url, params=request_params,
+                             validate=is_json_response, limiter=self.limiter)
+        try:
+            json = r.json()
+        except ValueError:
+            print(" Reading error, no more retries are allowed")
+            raise
         if 'code' in json:
-            if "key" in params:
+            if self.key is not None:
                 print(" Client throttled, " +
                       "use another key or try it again later")
             else:
-                print("MeetUp key required. Add it by calling add_key() " +
-                      "function")
+                print("MeetUp key required. Add it by calling " +
+                      "add_key() function")
             sys.exit(0)
-        categories.extend(json['results'])
-        return categories
-    except Exception:
-        print(" Reading error, trying again")
-        return get_categories()
+        return json
+
+    def get_open_events(self, request_params=None):
+        """
+        This function makes a request to the MeetUp API in order to obtain
+        open events according to the parameters given.
+        These error readings are usually detected in this process but, after
+        several attempts, the function is able to get the right data from
+        MeetUp.
+
+        Parameters
+        ----------
+        request_params : dictionary
+            Parameters of the request. By default, the ones of get_params().
+
+        Returns
+        -------
+        json : JSON formatted list
+            This JSON formated list contains information of the requested
+            events.
+        """
+        if request_params is None:
+            request_params = self.get_params()
+        return self.get_json("http://api.meetup.com/2/open_events",
+                             request_params)
+
+    def get_categories(self):
+        """
+        This function makes a request to the MeetUp API in order to obtain a
+        list of the available categories for all the MeetUp activities.
+        These error readings are not detected in this process very often but,
+        after several attempts, the function is able to get the right data
+        from MeetUp.
+
+        Returns
+        -------
+        json : JSON formatted list
+            This JSON formated list contains all the available categories.
+        """
+        json = self.get_json("http://api.meetup.com/2/categories",
+                             self.get_params())
+        return list(json['results'])
+
+    def get_open_events_of_city(self, city, code_list, category_id=None,
+                                time_range=None):
+        """
+        It returns a list of all the available MeetUp events in a city.
+
+        Arguments
+        ---------
+        city : string
+            Name of the city where we want to perform the search
+        code_list : either string or list of strings
+            It is a string that contains the country code where the city
+            belongs to. In case of cities from United States, a state code is
+            also mandatory. Then, code_list is defined as a list of strings
+            made up of the country code and the state code.
+        category_id : integer
+            It is the id that defines a MeetUp category. If it is given, the
+            functino will only return events related with this category. If it
+            is not given, the function will return all the events without
+            filtering by their category.
+        time_range : string
+            If given, only events scheduled within this range are returned.
+            It has the format of the "time" parameter of the MeetUp API, e.g.
+            "1510585200000," for all the events from that epoch in
+            milliseconds.
+
+        Returns
+        -------
+        results : JSON formatted list
+            It includes information about the events found in a city.
+        """
+        results = []
+        for _, page, _ in self.iter_open_events_of_city(city, code_list,
+                                                        category_id,
+                                                        time_range):
+            results.extend(page)
+        return results
+
+    def iter_open_events_of_city(self, city, code_list, category_id=None,
+                                 time_range=None, offset=0):
+        """
+        It does the same as get_open_events_of_city() but yields the events
+        page by page, as soon as each page arrives, so they do not have to be
+        kept in memory.
+
+        Arguments
+        ---------
+        city, code_list, category_id, time_range :
+            See get_open_events_of_city().
+        offset : integer
+            Number of the first page that is requested. Earlier pages are
+            skipped, which allows resuming an interrupted search.
+
+        Yields
+        ------
+        offset : integer
+            Number of the page.
+        page : JSON formatted list
+            The events of the page.
+        last : boolean
+            True if it is the last page of the search.
+        """
+        # Defining initial parameters to call MeetUp API
+        request_params = self.get_params()
+        request_params['city'] = city
+        if type(code_list) is tuple:
+            request_params['country'] = code_list[0]
+            request_params['state'] = code_list[1]
+        else:
+            request_params['country'] = code_list
+        if category_id is not None:
+            request_params['category'] = category_id
+        if time_range is not None:
+            request_params['time'] = time_range
+
+        # Declaring some initial variable before the loop
+        number_results = max_elems_per_page
+
+        # Entering into the loop to retrieve all events in the city. A page
+        # that is not full is the last one. The rate limiter avoids throttling
+        # the client
+        while (number_results == max_elems_per_page):
+            request_params['offset'] = offset
+            data = self.get_open_events(request_params)
+            number_results = data['meta']['count']
+            # The results are taken out of data, so the generator does not
+            # keep the page alive while the caller processes it
+            yield (offset, data.pop('results'),
+                   number_results != max_elems_per_page)
+            offset += 1
+
+    def fetch_events(self, jobs, workers=max_workers):
+        """
+        It retrieves the events of several (city, category) searches at the
+        same time. All of them share the rate limiter of the client.
+
+        Parameters
+        ----------
+        jobs : list of tuples
+            Each tuple contains the arguments of get_open_events_of_city():
+            (city, code_list, category_id) or
+            (city, code_list, category_id, time_range).
+        workers : integer
+            Maximum number of searches that are run at the same time.
+
+        Returns
+        -------
+        futures : list of Future objects
+            One Future for each job, in the same order. The result of each
+            Future is the list returned by get_open_events_of_city().
+        executor : ThreadPoolExecutor
+            The executor running the jobs. It must be shut down by the caller.
+        """
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(self.get_open_events_of_city, *job)
+                   for job in jobs]
+        return futures, executor
+
+    def stream_events(self, jobs, workers=max_workers):
+        """
+        It does the same as fetch_events() but each search writes its events
+        to a part file as they arrive (see stream_category_events()).
 
+        Parameters
+        ----------
+        jobs : list of tuples
+            Each tuple contains the arguments of stream_category_events()
+            that come after the client: (city, code_list, category_id,
+            part_filename, write_date, write_name, write_id, journal).
+        workers : integer
+            Maximum number of searches that are run at the same time.
 
-def get_open_events_of_city(city, code_list, category_id=None):
+        Returns
+        -------
+        futures : list of Future objects
+            One Future for each job, in the same order. The result of each
+            Future is the number of events written to the part file.
+        executor : ThreadPoolExecutor
+            The executor running the jobs. It must be shut down by the caller.
+        """
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(stream_category_events, self, *job)
+                   for job in jobs]
+        return futures, executor
+
+
+# Client used by the module functions below, with its own session so its
+# retry budget is not spent by the Wikipedia requests
+client = MeetupClient(limiter=rate_limiter)
+
+
+def add_key(mu_key):
     """
-    It returns a list of all the available MeetUp events in a city.
+    Add key to the MeetUp client used by the module functions
 
-    Arguments
-    ---------
-    city : string
-        Name of the city where we want to perform the search
-    code_list : either string or list of strings
-        It is a string that contains the country code where the city belongs
-        to. In case of cities from United States, a state code is also
-        mandatory. Then, code_list is defined as a list of strings made up of
-        the country code and the state code.
-    category_id : integer
-        It is the id that defines a MeetUp category. If it is given, the
-        functino will only return events related with this category. If it is
-        not given, the function will return all the events without filtering
-        by their category.
+    Parameters
+    ----------
+    mu_key : string
+        This is the MeetUp API key
+    """
+    client.key = mu_key
 
-    Returns
-    -------
-    results : JSON formatted list
-        It includes information about the events found in a city.
-    """
-    # Defining initial parameters to call MeetUp API
-    params['city'] = city
-    if type(code_list) is tuple:
-        params['country'] = code_list[0]
-        params['state'] = code_list[1]
-    else:
-        params['country'] = code_list
-    if category_id is not None:
-        params['category'] = category_id
 
-    # Declaring some initial variable before the loop
-    number_results = max_elems_per_page
-    results = []
-    offset = 0
+def get_open_events(request_params=None):
+    """
+    See MeetupClient.get_open_events(). It uses the module client.
+    """
+    return client.get_open_events(request_params)
 
-    # Entering into the loop to retrieve all events in the city
-    while (number_results != 0):
-        params['offset'] = offset
-        data = get_open_events()
-        number_results = data['meta']['count']
-        results.extend(data['results'])
-        offset += 1
 
-        # To avoid throttling the client
-        sleep(1)
+def get_categories():
+    """
+    See MeetupClient.get_categories(). It uses the module client.
+    """
+    return client.get_categories()
 
-    # The parameters dictionary must be restored to its initial state
-    restore_meetup_params()
 
-    return results
+def get_open_events_of_city(city, code_list, category_id=None,
+                            time_range=None):
+    """
+    See MeetupClient.get_open_events_of_city(). It uses the module client.
+    """
+    return client.get_open_events_of_city(city, code_list, category_id,
+                                          time_range)
+
+
+def fetch_events(jobs, workers=max_workers):
+    """
+    See MeetupClient.fetch_events(). It uses the module client.
+    """
+    return client.fetch_events(jobs, workers)
 
 
 def data_parser(data, write_date, write_name, write_id):
@@ -285,14 +560,337 @@ def write_data(city, parsed_data, category_id, f):
     """
     f.write("#{}\n".format(category_id))
     for event in parsed_data:
-        parsed_name = name_parser(event["name"])
-        f.write("{};{};{};{};{}\n".format(event["coordinates"][0],
-                                          event["coordinates"][1],
-                                          event["date"], parsed_name,
-                                          event["id"]))
+        f.write(event_line(event))
     f.write("!#\n")
 
 
+def event_line(event):
+    """
+    It formats an event as a line of the custom csv file.
+
+    Parameters
+    ----------
+    event : dictionary
+        Parsed event as returned by data_parser().
+
+    Returns
+    -------
+    line : string
+        The line of the event, including the line break.
+    """
+    parsed_name = name_parser(event["name"])
+    return "{};{};{};{};{}\n".format(event["coordinates"][0],
+                                     event["coordinates"][1],
+                                     event["date"], parsed_name, event["id"])
+
+
+def line_event(line):
+    """
+    It parses a line of the custom csv file back into an event. It is the
+    inverse of event_line().
+
+    Parameters
+    ----------
+    line : string
+        Line of an event.
+
+    Returns
+    -------
+    event : dictionary
+        Parsed event with the format returned by data_parser().
+    """
+    # Missing values are written as "None"
+    fields = [None if field == "None" else field
+              for field in line.rstrip('\n').split(";")]
+    return {"coordinates": tuple(None if field is None else float(field)
+                                 for field in fields[:2]),
+            "date": None if fields[2] is None else int(fields[2]),
+            "name": fields[3],
+            "id": fields[4]}
+
+
+def get_part_filename(filename, category_id):
+    """
+    It returns the filename of the part file where the events of a category
+    are written while they are fetched.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the custom csv file of the city.
+    category_id : integer
+        Id of the category.
+
+    Returns
+    -------
+    part_filename : string
+        Directory and filename of the part file.
+    """
+    return "{}.{}.part".format(filename, category_id)
+
+
+class IngestionJournal(object):
+    """
+    Journal of the checkpoints of an ingestion run. Each checkpoint is
+    appended as a line of a JSONL file and synced to disk, so it survives a
+    crash or a throttled client, and the next run picks up where the last one
+    stopped:
+        - the cities whose custom csv file was already saved are skipped
+        - the categories that were finished are not fetched again
+        - the category in progress is resumed from its last complete page
+    The last line of each (city, category) pair is the one that counts. The
+    journal is shared by all the threads of the run.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the journal. It is read if it exists.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.checkpoints = {}
+        self.saved_cities = set()
+
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete after a crash
+                        continue
+                    self.load_entry(entry)
+
+    def load_entry(self, entry):
+        """
+        It applies a line of the journal to the state of the run.
+
+        Parameters
+        ----------
+        entry : dictionary
+            A line of the journal. It has a "city" key and either a "saved"
+            key or the "category" of a checkpoint (see get_checkpoint()).
+        """
+        if entry.get("saved"):
+            self.saved_cities.add(entry["city"])
+        else:
+            checkpoint = dict(entry)
+            key = (checkpoint.pop("city"), checkpoint.pop("category"))
+            self.checkpoints[key] = checkpoint
+
+    def append(self, entry):
+        """
+        It appends a line to the journal and waits until it is on disk.
+
+        Parameters
+        ----------
+        entry : dictionary
+            See load_entry().
+        """
+        with self.lock:
+            directory = os.path.dirname(self.filename)
+            os.makedirs(directory or '.', exist_ok=True)
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.load_entry(entry)
+
+    def get_checkpoint(self, city, category_id):
+        """
+        It returns the last checkpoint of a search.
+
+        Parameters
+        ----------
+        city : string
+            Name of the city.
+        category_id : integer
+            Id of the category.
+
+        Returns
+        -------
+        checkpoint : dictionary
+            It has the keys "offset", the next page that has to be requested,
+            "size", the number of bytes of the part file that are complete,
+            "count", the number of events in those bytes, and "done", true if
+            the search is finished. None if there is no checkpoint.
+        """
+        with self.lock:
+            return self.checkpoints.get((city, category_id))
+
+    def write_checkpoint(self, city, category_id, checkpoint):
+        """
+        It records the checkpoint of a search.
+
+        Parameters
+        ----------
+        city : string
+            Name of the city.
+        category_id : integer
+            Id of the category.
+        checkpoint : dictionary
+            See get_checkpoint().
+        """
+        entry = {"city": city, "category": category_id}
+        entry.update(checkpoint)
+        self.append(entry)
+
+    def is_saved(self, city):
+        """
+        It tells whether the custom csv file of a city was already saved in
+        this run.
+
+        Parameters
+        ----------
+        city : string
+            Name of the city.
+
+        Returns
+        -------
+        saved : boolean
+            True if the city does not have to be fetched again.
+        """
+        with self.lock:
+            return city in self.saved_cities
+
+    def mark_saved(self, city):
+        """
+        It records that the custom csv file of a city was saved.
+
+        Parameters
+        ----------
+        city : string
+            Name of the city.
+        """
+        self.append({"city": city, "saved": True})
+
+    def clear(self):
+        """
+        It removes the journal, so the next run starts from scratch.
+        """
+        with self.lock:
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+            self.checkpoints = {}
+            self.saved_cities = set()
+
+
+def stream_category_events(meetup_client, city, code_list, category_id,
+                           part_filename, write_date=True, write_name=True,
+                           write_id=True, journal=None):
+    """
+    It fetches the events of a category of a city and writes them to a part
+    file page by page: each page is parsed and written as soon as it arrives,
+    and then released, so the memory used does not depend on the number of
+    events. The same event can be returned in more than one page, so the ids
+    that were written are kept in a set and repeated events are skipped. If
+    a journal is given, a checkpoint is recorded after each page, and a
+    search with a checkpoint cuts the part file back to its last complete
+    page and is resumed from the next one.
+
+    Parameters
+    ----------
+    meetup_client : MeetupClient
+        Client used to fetch the events.
+    city, code_list, category_id :
+        See MeetupClient.get_open_events_of_city().
+    part_filename : string
+        Directory and filename of the part file.
+    write_date, write_name, write_id :
+        See data_parser().
+    journal : IngestionJournal
+        Journal of the checkpoints of the run.
+
+    Returns
+    -------
+    count : integer
+        Number of events written to the part file.
+    """
+    checkpoint = None
+    if journal is not None and os.path.isfile(part_filename):
+        checkpoint = journal.get_checkpoint(city, category_id)
+    if checkpoint is None:
+        checkpoint = {"offset": 0, "size": 0, "count": 0, "done": False}
+
+    if checkpoint["done"]:
+        return checkpoint["count"]
+
+    with open(part_filename, 'a+') as f:
+        # Lines written after the last checkpoint belong to an unfinished page
+        f.truncate(checkpoint["size"])
+        f.seek(0)
+        seen_ids = set(line_fields(line)[1] for line in f)
+        seen_ids.discard("None")
+
+        pages = meetup_client.iter_open_events_of_city(
+            city, code_list, category_id, offset=checkpoint["offset"])
+        for offset, page, last in pages:
+            parsed_data = []
+            for event in data_parser(page, write_date, write_name, write_id):
+                if event["id"] is not None:
+                    if event["id"] in seen_ids:
+                        continue
+                    seen_ids.add(event["id"])
+                parsed_data.append(event)
+            del page
+            f.writelines(event_line(event) for event in parsed_data)
+            f.flush()
+            os.fsync(f.fileno())
+            checkpoint = {"offset": offset + 1, "size": f.tell(),
+                          "count": checkpoint["count"] + len(parsed_data),
+                          "done": last}
+            if journal is not None:
+                journal.write_checkpoint(city, category_id, checkpoint)
+
+    return checkpoint["count"]
+
+
+def reference_lines(lines, written_ids):
+    """
+    It replaces the lines of the events that were already written to a custom
+    csv file, under another category, by a reference to their id: "@"
+    followed by the id. Each event is written once, and each category keeps
+    the list of all its events.
+
+    Parameters
+    ----------
+    lines : iterable of strings
+        Lines of the events of a category.
+    written_ids : set of strings
+        Ids of the events that were already written. The ids of the new
+        events are added to it.
+
+    Yields
+    ------
+    line : string
+        Either the line of the event or its reference, including the line
+        break.
+    """
+    for line in lines:
+        event_id = line_fields(line)[1]
+        if event_id != "None":
+            if event_id in written_ids:
+                yield "@{}\n".format(event_id)
+                continue
+            written_ids.add(event_id)
+        yield line
+
+
+def remove_part_file(part_filename):
+    """
+    It removes a part file, if it exists.
+
+    Parameters
+    ----------
+    part_filename : string
+        Directory and filename of the part file.
+    """
+    if os.path.isfile(part_filename):
+        os.remove(part_filename)
+
+
 def categories_parser(categories):
     """
     It creates a dictionary by parsing the JSON format coming from the MeetUp
@@ -316,9 +914,141 @@ def categories_parser(categories):
     return categories_parsed
 
 
+def get_city_code_list(city, code_list=None):
+    """
+    It returns the code_list of a city, looking for it in the cities list when
+    it is not given.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    code_list : either string or list of strings
+        It is a string that contains the country code where the city belongs
+        to. In case of cities from United States, a state code is also
+        mandatory. Then, code_list is defined as a list of strings made up of
+        the country code and the state code.
+
+    Returns
+    -------
+    code_list : either string or list of strings
+        The code_list of the city.
+    """
+    if code_list is None:
+        if city in cities:
+            code_list = cities[city]
+        else:
+            print("{} is not in the cities list. A code_list for this city" +
+                  "must be specified in the function parameters")
+            sys.exit(0)
+    return code_list
+
+
+def save_city_events(city, category_results, filename="./csv/{}.csv",
+                     store_filename=STORE_FILENAME,
+                     memmap_directory=MEMMAP_DIRECTORY):
+    """
+    It joins the part files of the categories of a city into its custom csv
+    file, as they become available. Categories are written in the order of
+    category_results, so the file is the same no matter in which order they
+    were fetched. The file is written to a temporary file first and replaced
+    at the end, so an interrupted run never leaves a truncated file, and the
+    part files are only removed once the file is complete. Events that belong
+    to several categories are written once (see reference_lines()), and the
+    total number of activities counts each of them once.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    category_results : dictionary of Future objects
+        It has category ids as keys and Future objects returned by
+        stream_events() as items.
+    filename, store_filename, memmap_directory :
+        See get_and_save_city_events().
+    """
+    city_filename = filename.format(city)
+    temporary_filename = city_filename + ".tmp"
+    with open(temporary_filename, 'w') as f:
+        num_activities = 0
+        written_ids = set()
+        for category_id, future in category_results.items():
+            future.result()
+            f.write("#{}\n".format(category_id))
+            with open(get_part_filename(city_filename, category_id),
+                      'r') as part:
+                for line in reference_lines(part, written_ids):
+                    if not line.startswith("@"):
+                        num_activities += 1
+                    f.write(line)
+            f.write("!#\n")
+        write_num_activities(city, num_activities, f)
+    os.replace(temporary_filename, city_filename)
+
+    for category_id in category_results:
+        remove_part_file(get_part_filename(city_filename, category_id))
+
+    print("Saved a custom csv file saved in" +
+          "\'{}\'".format(city_filename))
+
+    save_city_store(city, num_activities, filename, store_filename,
+                    memmap_directory)
+
+
+def save_city_store(city, num_activities, filename="./csv/{}.csv",
+                    store_filename=STORE_FILENAME,
+                    memmap_directory=MEMMAP_DIRECTORY,
+                    cube_filename=CUBE_FILENAME):
+    """
+    It builds the event store, the memory-mapped event files and the
+    aggregate cube of a city from its custom csv file, which must have just
+    been written.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    num_activities : integer
+        Total number of activities of the city.
+    filename, store_filename, memmap_directory :
+        See get_and_save_city_events().
+    cube_filename : string
+        If given, the aggregate cube of the city is written to this file (see
+        mapping.aggregates.write_city_cube()).
+    """
+    city_filename = filename.format(city)
+
+    if store_filename is not None:
+        # The event store is built from the csv file that was just written,
+        # instead of keeping the events in memory while they are fetched
+        events_by_category = {category_id: [line_event(line)
+                                            for line in lines]
+                              for category_id, lines in
+                              read_city_sections(city_filename).items()}
+        columns = write_event_store(store_filename.format(city),
+                                    events_by_category, num_activities)
+        print("Saved an event store in " +
+              "\'{}\'".format(store_filename.format(city)))
+
+        if memmap_directory is not None:
+            write_event_memmap(memmap_directory.format(city), columns)
+            print("Saved memory-mapped event files in " +
+                  "\'{}\'".format(memmap_directory.format(city)))
+
+    if cube_filename is not None:
+        # mapping imports this module, so it is only imported when needed
+        from mapping import aggregates
+        aggregates.write_city_cube(city, filename=cube_filename,
+                                   csv_filename=filename)
+
+
 def get_and_save_city_events(city, filename="./csv/{}.csv", code_list=None,
                              categories=None, write_date=True, write_name=True,
-                             write_id=True):
+                             write_id=True, store_filename=STORE_FILENAME,
+                             memmap_directory=MEMMAP_DIRECTORY,
+                             workers=max_workers, meetup_client=None,
+                             journal_filename=journal_filename,
+                             resume=True):
     """'r'
     It retrieves all the events of a city and arrange them by their categories.
     It can also retrieve information about the date and the description of the
@@ -348,32 +1078,317 @@ def get_and_save_city_events(city, filename="./csv/{}.csv", code_list=None,
     write_id : boolean
         When set to true, it will write down the id for each event to the csv
         file.
+    store_filename : string
+        If given, the events are also written to a binary columnar file with
+        this directory and filename (see event_store.write_event_store()).
+    memmap_directory : string
+        If given, the events are also written as memory-mapped files to this
+        directory (see event_store.write_event_memmap()). By default, the
+        directory that mapping.load_city_events() reads first, the same one
+        as in refresh_city_events().
+    workers : integer
+        Maximum number of categories that are fetched at the same time.
+    meetup_client : MeetupClient
+        Client used to fetch the events. By default, the module client.
+    journal_filename : string
+        Directory and filename of the journal with the checkpoints of the run
+        (see IngestionJournal). It is removed when the run is finished. If it
+        is None, an interrupted run can not be resumed.
+    resume : boolean
+        When set to true, the run resumes from the journal left by an
+        interrupted run, if any. Otherwise, it starts from scratch.
     """
+    get_and_save_cities_events([city], filename=filename,
+                               code_lists={city: code_list},
+                               categories=categories, write_date=write_date,
+                               write_name=write_name, write_id=write_id,
+                               store_filename=store_filename,
+                               memmap_directory=memmap_directory,
+                               workers=workers, meetup_client=meetup_client,
+                               journal_filename=journal_filename,
+                               resume=resume)
+
+
+def get_and_save_cities_events(city_list=None, filename="./csv/{}.csv",
+                               code_lists=None, categories=None,
+                               write_date=True, write_name=True,
+                               write_id=True, store_filename=STORE_FILENAME,
+                               memmap_directory=MEMMAP_DIRECTORY,
+                               workers=max_workers, meetup_client=None,
+                               journal_filename=journal_filename,
+                               resume=True):
+    """
+    It does the same as get_and_save_city_events() for several cities. The
+    (city, category) searches of all the cities are fetched at the same time,
+    sharing the same rate limiter. Each search writes its events to a part
+    file page by page, and each city is written down as soon as all its
+    categories are available. If the run is interrupted, the part files are
+    kept and the journal tells the next run which cities were saved, which
+    categories were finished and from which page the others go on.
+
+    Parameters
+    ----------
+    city_list : list of strings
+        Names of the cities. By default, all the cities in the cities list.
+    code_lists : dictionary
+        It has city names as keys and their code_list as items. Cities that are
+        not in it are looked for in the cities list.
+    workers : integer
+        Maximum number of searches that are fetched at the same time.
+    meetup_client : MeetupClient
+        Client used to fetch the events. By default, the module client.
+    filename, categories, write_date, write_name, write_id, store_filename,
+    memmap_directory, journal_filename, resume :
+        See get_and_save_city_events().
+    """
+    if city_list is None:
+        city_list = list(cities)
+
+    if code_lists is None:
+        code_lists = {}
+
     # Retrieve the required information if not given in the parameters input
-    if code_list is None:
-        if city in cities:
-            code_list = cities[city]
-        else:
-            print("{} is not in the cities list. A code_list for this city" +
-                  "must be specified in the function parameters")
-            sys.exit(0)
+    code_lists = {city: get_city_code_list(city, code_lists.get(city))
+                  for city in city_list}
 
     if categories is None:
         categories = local_categories
 
-    # Start data request
-    print("Searching for all the events in {}".format(city))
+    journal = None
+    if journal_filename is not None:
+        journal = IngestionJournal(journal_filename)
+        if not resume:
+            journal.clear()
+        for city in city_list:
+            if journal.is_saved(city):
+                print("{} was already saved, skipping it".format(city))
+        city_list = [city for city in city_list if not journal.is_saved(city)]
+
+    # Start data request. Each search writes its events to a part file next
+    # to the custom csv file of its city
+    jobs = [(city, code_lists[city], category_id,
+             get_part_filename(filename.format(city), category_id),
+             write_date, write_name, write_id, journal)
+            for city in city_list for category_id in categories]
+    if meetup_client is None:
+        meetup_client = client
+
+    for directory in set(os.path.dirname(job[3]) for job in jobs):
+        os.makedirs(directory or '.', exist_ok=True)
+
+    futures, executor = meetup_client.stream_events(jobs, workers)
+    futures_by_job = {(job[0], job[2]): future
+                      for job, future in zip(jobs, futures)}
+
+    try:
+        for city in city_list:
+            print("Searching for all the events in {}".format(city))
+            category_results = {category_id: futures_by_job[(city,
+                                                             category_id)]
+                                for category_id in categories}
+            save_city_events(city, category_results, filename=filename,
+                             store_filename=store_filename,
+                             memmap_directory=memmap_directory)
+            if journal is not None:
+                journal.mark_saved(city)
+    finally:
+        # Pending searches are not needed anymore if something went wrong
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+    # The run is complete, so the next one starts from scratch
+    if journal is not None:
+        journal.clear()
+
+
+def read_city_sections(filename):
+    """
+    It reads the category sections of a custom csv file, keeping the lines of
+    the events untouched.
+
+    Parameters
+    ----------
+    filename : string
+        It tells the directory where to search for the custom csv file.
+
+    Returns
+    -------
+    sections : dictionary of lists of strings
+        It has category ids as keys and the lines of their events, including
+        the line breaks, as items. References to events of other categories
+        (see reference_lines()) are replaced by the lines of the events, and
+        references to events that are not written earlier in the file are
+        skipped. The total number of activities (#0) is not included.
+    """
+    sections = {}
+    lines_by_id = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith("#"):
+                category_id = int(line.strip("#").strip())
+                lines = sections.setdefault(category_id, [])
+                line = next(f)
+                while not line.startswith("!#"):
+                    if line.startswith("@"):
+                        event_id = line[1:].rstrip('\n')
+                        # A reference to an event that is not written
+                        # earlier in the file can not be resolved
+                        if event_id not in lines_by_id:
+                            print("Skipped the unknown event " +
+                                  "\'{}\' in \'{}\'".format(event_id,
+                                                              filename))
+                            line = next(f)
+                            continue
+                        line = lines_by_id[event_id]
+                    elif category_id != 0:
+                        lines_by_id[line_fields(line)[1]] = line
+                    lines.append(line)
+                    line = next(f)
+    sections.pop(0, None)
+    return sections
+
+
+def line_fields(line):
+    """
+    It gets the date and the id of an event line of a custom csv file.
+
+    Parameters
+    ----------
+    line : string
+        Line of an event.
+
+    Returns
+    -------
+    date : integer
+        Date of the event in epoch milliseconds, or None if it is unknown.
+    event_id : string
+        Id of the event.
+    """
+    fields = line.rstrip('\n').split(";")
+    try:
+        date = int(fields[2])
+    except ValueError:
+        date = None
+    return date, fields[-1]
+
+
+def refresh_city_events(city, filename="./csv/{}.csv", code_list=None,
+                        categories=None, workers=max_workers,
+                        meetup_client=None, store_filename=STORE_FILENAME,
+                        memmap_directory=MEMMAP_DIRECTORY):
+    """
+    It updates the custom csv file of a city instead of fetching all its
+    events again. For each category:
+        - the events that already took place are dropped
+        - only the events scheduled from the last date found in the file are
+          fetched, and the ones whose id is already in the file are skipped
+        - if nothing changed, its lines are written back untouched
+    Events without date are kept, categories without any dated event in the
+    file are fetched completely, and the categories that are not refreshed
+    are written back untouched. Events that were created after the last
+    refresh but are scheduled before the last date found are not retrieved,
+    so a complete fetch is still needed from time to time. The event store of
+    the city is built again from the new file (see save_city_store()).
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    filename : string
+        It tells the directory where to search for the custom csv file. If it
+        does not exist, all the events are fetched.
+    code_list : either string or list of strings
+        See get_and_save_city_events().
+    categories : dictionary of categories
+        This dictionary has category ids as keys and category labels as items.
+    workers : integer
+        Maximum number of categories that are fetched at the same time.
+    meetup_client : MeetupClient
+        Client used to fetch the events. By default, the module client.
+    store_filename, memmap_directory :
+        See get_and_save_city_events().
+
+    Returns
+    -------
+    changed : list of integers
+        Ids of the categories whose events changed.
+    """
+    code_list = get_city_code_list(city, code_list)
+
+    if categories is None:
+        categories = local_categories
+
+    if meetup_client is None:
+        meetup_client = client
+
+    sections = {}
+    if os.path.isfile(filename.format(city)):
+        sections = read_city_sections(filename.format(city))
+
+    now = int(time() * 1000)
+
+    # Drop expired events and look for the last date of each category. The
+    # sections of the other categories are kept as they are.
+    kept_sections = dict(sections)
+    jobs = []
+    for category_id in categories:
+        kept = []
+        last_date = None
+        for line in sections.get(category_id, []):
+            date, event_id = line_fields(line)
+            # Events without date can not expire, so they are kept and the
+            # last date is found among the other events
+            if date is None:
+                kept.append(line)
+            elif date >= now:
+                kept.append(line)
+                last_date = date if last_date is None else max(last_date,
+                                                               date)
+        kept_sections[category_id] = kept
+        time_range = None if last_date is None else "{},".format(last_date)
+        jobs.append((city, code_list, category_id, time_range))
+
+    print("Refreshing the events in {}".format(city))
+    futures, executor = meetup_client.fetch_events(jobs, workers)
+
+    changed = []
+    try:
+        for (_, _, category_id, _), future in zip(jobs, futures):
+            lines = kept_sections[category_id]
+            known_ids = set(line_fields(line)[1] for line in lines)
+            for event in data_parser(future.result(), True, True, True):
+                if event["id"] not in known_ids:
+                    known_ids.add(event["id"])
+                    lines.append(event_line(event))
+            if lines != sections.get(category_id, []):
+                changed.append(category_id)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+    # Write to a temporary file first, so the old file is kept if something
+    # goes wrong
     os.makedirs(os.path.dirname(filename.format(city)), exist_ok=True)
-    with open(filename.format(city), 'w') as f:
+    temporary_filename = filename.format(city) + ".tmp"
+    with open(temporary_filename, 'w') as f:
         num_activities = 0
-        for category_id, category_label in categories.items():
-            results = get_open_events_of_city(city, code_list,
-                                              category_id=category_id)
-            parsed_data = data_parser(results, write_date, write_name,
-                                      write_id)
-            num_activities += len(parsed_data)
-            write_data(city, parsed_data, category_id, f)
+        written_ids = set()
+        for category_id, lines in kept_sections.items():
+            f.write("#{}\n".format(category_id))
+            for line in reference_lines(lines, written_ids):
+                if not line.startswith("@"):
+                    num_activities += 1
+                f.write(line)
+            f.write("!#\n")
         write_num_activities(city, num_activities, f)
+    os.replace(temporary_filename, filename.format(city))
 
-    print("Saved a custom csv file saved in" +
+    print("Refreshed {} categories in ".format(len(changed)) +
           "\'{}\'".format(filename.format(city)))
+
+    save_city_store(city, num_activities, filename, store_filename,
+                    memmap_directory)
+
+    return changed
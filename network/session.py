@@ -0,0 +1,246 @@
+# Import requests package to make the HTTP requests
+import requests
+from requests.adapters import HTTPAdapter
+
+# To measure latencies and wait between retries
+from time import monotonic, sleep
+import random
+
+# To share the session between threads
+from threading import Lock
+
+# To get the host of each url
+from urllib.parse import urlsplit
+
+# Connections kept alive for each host
+POOL_SIZE = 10
+
+# Maximum number of retries of a single request
+MAX_RETRIES = 5
+
+# Exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Retry budget: retries allowed in the whole session, as a fixed amount plus a
+# ratio of the requests made
+MIN_RETRY_BUDGET = 10
+RETRY_RATIO = 0.2
+
+# Default (connect, read) timeout of each request, in seconds
+TIMEOUT = (5, 30)
+
+# HTTP status codes that are worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def is_retryable(response):
+    """
+    Default check of PooledSession.get(): a response is accepted unless its
+    status code is in RETRY_STATUS.
+
+    Parameters
+    ----------
+    response : response object
+        It is the response to check.
+
+    Returns
+    -------
+    valid : boolean
+        False if the request should be retried.
+    """
+    return response.status_code not in RETRY_STATUS
+
+
+class PooledSession(object):
+    """
+    HTTP session that keeps connections alive between requests and retries
+    failed ones with a bounded exponential backoff with jitter. The number of
+    retries of the whole session is limited by a retry budget, so a failing
+    service cannot keep a long run busy forever. Per-host counters of
+    requests, retries, errors and latencies are kept. A session can be shared
+    by several threads.
+
+    Parameters
+    ----------
+    max_retries : integer
+        Maximum number of retries of a single request.
+    backoff_base : float
+        Maximum wait before the first retry, in seconds. It is doubled after
+        each retry.
+    backoff_max : float
+        Maximum wait between two retries, in seconds.
+    min_retry_budget : integer
+        Retries always allowed in the session.
+    retry_ratio : float
+        Additional retries allowed for each request made.
+    pool_size : integer
+        Number of connections kept alive for each host.
+    timeout : float or 2-dimensional tuple of floats
+        Default (connect, read) timeout of each request, in seconds.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, min_retry_budget=MIN_RETRY_BUDGET,
+                 retry_ratio=RETRY_RATIO, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_retry_budget = min_retry_budget
+        self.retry_ratio = retry_ratio
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = Lock()
+        self.requests = 0
+        self.retries = 0
+        self.stats = {}
+
+    def backoff(self, attempt):
+        """
+        It computes the wait before a retry ("full jitter" backoff).
+
+        Parameters
+        ----------
+        attempt : integer
+            Number of the attempt that failed, starting at 0.
+
+        Returns
+        -------
+        wait : float
+            Seconds to wait before the next attempt.
+        """
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
+    def record(self, host, latency=None, retry=False, error=False):
+        """
+        It updates the counters of a host.
+
+        Parameters
+        ----------
+        host : string
+            Host of the request.
+        latency : float
+            Duration of the request in seconds, if it got a response.
+        retry : boolean
+            True if the request is going to be retried.
+        error : boolean
+            True if the request did not get a response.
+        """
+        with self.lock:
+            host_stats = self.stats.setdefault(host, {"requests": 0,
+                                                      "retries": 0,
+                                                      "errors": 0,
+                                                      "latency": 0.0,
+                                                      "max_latency": 0.0})
+            if latency is not None:
+                host_stats["requests"] += 1
+                host_stats["latency"] += latency
+                host_stats["max_latency"] = max(host_stats["max_latency"],
+                                                latency)
+                self.requests += 1
+            if error:
+                host_stats["errors"] += 1
+            if retry:
+                host_stats["retries"] += 1
+                self.retries += 1
+
+    def can_retry(self):
+        """
+        It tells whether the retry budget of the session allows a new retry.
+
+        Returns
+        -------
+        allowed : boolean
+            True if a new retry is allowed.
+        """
+        with self.lock:
+            budget = self.min_retry_budget + self.retry_ratio * self.requests
+            return self.retries < budget
+
+    def get(self, url, validate=is_retryable, limiter=None, **kwargs):
+        """
+        It makes a GET request, retrying it when it fails.
+
+        Parameters
+        ----------
+        url : string
+            Address to request.
+        validate : function
+            It receives the response and returns False when the request must
+            be retried.
+        limiter : object
+            If given, its acquire() method is called before each attempt and
+            its update() method with the response headers after it.
+        kwargs :
+            Additional arguments of requests.Session.get(). The timeout of
+            the session is used unless a timeout is given.
+
+        Returns
+        -------
+        response : response object
+            The first valid response or, when no more retries are allowed, the
+            last one received.
+
+        Raises
+        ------
+        requests.RequestException
+            When no more retries are allowed and the last attempt did not get
+            any response.
+        """
+        host = urlsplit(url).netloc
+        attempt = 0
+        kwargs.setdefault("timeout", self.timeout)
+
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+
+            start = monotonic()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException:
+                response = None
+                if attempt >= self.max_retries or not self.can_retry():
+                    self.record(host, error=True)
+                    raise
+                self.record(host, error=True, retry=True)
+            else:
+                self.record(host, latency=monotonic() - start)
+                if limiter is not None:
+                    limiter.update(response.headers)
+                if validate(response):
+                    return response
+                if attempt >= self.max_retries or not self.can_retry():
+                    return response
+                self.record(host, retry=True)
+
+            sleep(self.backoff(attempt))
+            attempt += 1
+
+    def get_stats(self):
+        """
+        It returns the counters of each host.
+
+        Returns
+        -------
+        stats : dictionary of dictionaries
+            It has hosts as keys. Each item has the number of "requests",
+            "retries" and "errors" and the "mean_latency" and "max_latency"
+            in seconds.
+        """
+        with self.lock:
+            stats = {}
+            for host, host_stats in self.stats.items():
+                stats[host] = dict(host_stats)
+                stats[host]["mean_latency"] = (host_stats["latency"] /
+                                               max(1, host_stats["requests"]))
+                del stats[host]["latency"]
+            return stats
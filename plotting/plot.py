@@ -1,24 +1,97 @@
-from mapping import mapping
-from meetup import categories, cities
-from population_density import population_density_of_whole_city
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pygal
 
+from mapping import aggregates, mapping
+from meetup import categories, cities
+from plotting.population_density import population_density_of_whole_city
+
 category_list = categories.categories
 category_ids = [id for id, name in category_list.items()]
 category_names = [name for id, name in category_list.items()]
 city_list = cities.cities
 population_density_dict = population_density_of_whole_city
 
-activities_per_category = {}
-for city in city_list:
-    activities_per_category[city] = {}
-    for category_id, category_name in category_list.items():
-        activities_per_category[city][category_name] = max(0.000000000000000000000000000000000000000001, len(
-            mapping.read_custom_csv('../csv/{}.csv'.format(city), {category_id: category_name})[0]))
-        activities_per_category[city]['all'] = \
-            mapping.read_custom_csv('../csv/{}.csv'.format(city), {category_id: category_name})[1] or 0
+# Files are read relative to the root of the repository, charts are written
+# next to this module
+CSV_FILENAME = './csv/{}.csv'
+OUTPUT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HASHES_FILENAME = os.path.join(OUTPUT_DIRECTORY, 'chart_hashes.json')
+
+# Value used instead of 0 activities, so every category gets a bar
+MIN_ACTIVITIES = 0.000000000000000000000000000000000000000001
+
+
+def get_city_counts(city, csv_filename=CSV_FILENAME):
+    """
+    It counts the activities of each category of a city. The aggregate cube
+    of the city is used if it is up to date (see
+    aggregates.get_category_counts()). Otherwise, the custom csv file is read.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    csv_filename : string
+        It tells the directory where to search for the custom csv file.
+
+    Returns
+    -------
+    category_counts : dictionary
+        It has category ids as keys and their number of activities as items.
+    num_activities : integer
+        Total number of activities of the city.
+    """
+    cube = aggregates.load_city_cube(city, csv_filename=csv_filename)
+    if cube is not None:
+        return (aggregates.get_category_counts(cube),
+                int(cube['num_activities']))
+
+    events_by_category, num_activities = mapping.load_custom_csv(
+        csv_filename.format(city))
+    return ({category_id: len(events) for category_id, events
+             in events_by_category.items()}, num_activities or 0)
+
+
+def get_activities_per_category(citylist=None):
+    """
+    It builds the number of activities of each category and city that the
+    charts show.
+
+    Parameters
+    ----------
+    citylist : list of strings
+        Names of the cities. By default, all the cities in meetup.cities.
+        Cities without a custom csv file are left out.
+
+    Returns
+    -------
+    activities_per_category : dictionary of dictionaries
+        It has city names as keys. The inner dictionaries have category names
+        as keys, plus 'all' for the total, and numbers of activities as items.
+        An activity of several categories is counted in each of them, but
+        only once in 'all'.
+    """
+    if citylist is None:
+        citylist = city_list
+
+    activities_per_category = {}
+    for city in citylist:
+        if not os.path.isfile(CSV_FILENAME.format(city)):
+            print(f'No custom csv file was found for {city}')
+            continue
+        category_counts, num_activities = get_city_counts(city)
+        activities_per_category[city] = {
+            category_name: max(MIN_ACTIVITIES,
+                               category_counts.get(category_id, 0))
+            for category_id, category_name in category_list.items()}
+        activities_per_category[city]['all'] = num_activities
 
-print(activities_per_category)
+    return activities_per_category
 
 
 def plot(data, city, categories=None):
@@ -30,53 +103,276 @@ def plot(data, city, categories=None):
     barchart.render_to_png('plot.png')
 
 
-def plot_categories_for_city(data, city, per_capita=False):
-    barchart = pygal.HorizontalBar(legend_at_bottom=True, print_values=False, print_labels=True, print_zeros=True)
-    barchart.title = f'Number of Open Events per Million Capita in {city}' if per_capita else f'Number of Open Events in {city}'
+def get_categories_chart(data, city, per_capita=False):
+    """
+    It describes the chart with the activities of each category of a city.
+
+    Parameters
+    ----------
+    data : dictionary of dictionaries
+        As returned by get_activities_per_category().
+    city : string
+        Name of the city.
+    per_capita : boolean
+        If true, activities are given per million inhabitants.
+
+    Returns
+    -------
+    chart : dictionary
+        It has the keys "title", "bars" (list of label and value pairs),
+        "options" (pygal options) and "filename" (path without extension,
+        relative to the output directory, with the {} format placeholder).
+    """
     inhabitants = 1
+    bars = []
     for category in category_names:
         if per_capita:
             inhabitants = population_density_dict[city] / 1000000
         if data[city][category]:
-            barchart.add(category, data[city][category] / float(inhabitants))
-    # barchart.render_in_browser()
+            bars.append((category, data[city][category] / float(inhabitants)))
 
     infix = '_per_capita' if per_capita else ''
 
-    barchart.render_to_png(f'pngs/categories{infix}/{city}.png')
-    barchart.render_to_file(f'svgs/categories{infix}/{city}.svg')
+    return {'title': f'Number of Open Events per Million Capita in {city}' if per_capita else f'Number of Open Events in {city}',
+            'bars': bars,
+            'options': {'legend_at_bottom': True, 'print_values': False, 'print_labels': True, 'print_zeros': True},
+            'filename': os.path.join('{}', f'categories{infix}', city)}
 
 
-def plot_all_cities(data, citylist=None, category=None, per_capita=False):
-    barchart = pygal.HorizontalBar(print_values=False, print_labels=True, print_zeros=True)
+def get_all_cities_chart(data, citylist=None, category=None, per_capita=False):
+    """
+    It describes the chart with the activities of a category in each city.
+
+    Parameters
+    ----------
+    data : dictionary of dictionaries
+        As returned by get_activities_per_category().
+    citylist : list of strings
+        Names of the cities. By default, all the cities in data.
+    category : string
+        Name of the category, or 'all' for all the activities.
+    per_capita : boolean
+        If true, activities are given per million inhabitants.
+
+    Returns
+    -------
+    chart : dictionary
+        As returned by get_categories_chart().
+    """
     if category is None:
         category = 'all'
     if citylist is None:
         citylist = city_list
-    barchart.title = f'Number of Open Events per Million Capita in City; Category: {category}' if per_capita else f'Number of Open Events per City; Category: {category}'
     inhabitants = 1
+    bars = []
     for city in citylist:
+        if city not in data:
+            continue
         if per_capita:
             inhabitants = population_density_dict[city] / 1000000
         if data[city][category]:
-            barchart.add(city, data[city][category] / float(inhabitants))
-    # barchart.render_in_browser()
+            bars.append((city, data[city][category] / float(inhabitants)))
 
     infix = '_per_capita' if per_capita else ''
 
-    barchart.render_to_png(f'pngs/activities_per_city{infix}/{category}.png')
-    barchart.render_to_file(f'svgs/activities_per_city{infix}/{category}.svg')
+    return {'title': f'Number of Open Events per Million Capita in City; Category: {category}' if per_capita else f'Number of Open Events per City; Category: {category}',
+            'bars': bars,
+            'options': {'print_values': False, 'print_labels': True, 'print_zeros': True},
+            'filename': os.path.join('{}', f'activities_per_city{infix}', category)}
+
+
+def get_chart_hash(chart):
+    """
+    It computes a hash of everything that a chart shows, so it is only
+    rendered again when its data changes.
+
+    Parameters
+    ----------
+    chart : dictionary
+        As returned by get_categories_chart().
+
+    Returns
+    -------
+    digest : string
+        Hexadecimal sha256 digest.
+    """
+    return hashlib.sha256(json.dumps(chart, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_chart_filenames(chart, output_directory=OUTPUT_DIRECTORY):
+    """
+    It returns the png and svg filenames of a chart.
+
+    Parameters
+    ----------
+    chart : dictionary
+        As returned by get_categories_chart().
+    output_directory : string
+        Directory where the pngs and svgs directories are.
+
+    Returns
+    -------
+    filenames : 2-dimensional tuple of strings
+        Filenames of the png and the svg images.
+    """
+    filename = os.path.join(output_directory, chart['filename'])
+    return filename.format('pngs') + '.png', filename.format('svgs') + '.svg'
+
+
+def render_chart(chart, output_directory=OUTPUT_DIRECTORY):
+    """
+    It renders a chart to an svg image and converts it to a png image with
+    cairosvg, as pygal does in render_to_png().
+
+    Parameters
+    ----------
+    chart : dictionary
+        As returned by get_categories_chart().
+    output_directory : string
+        Directory where the pngs and svgs directories are.
+
+    Returns
+    -------
+    filenames : 2-dimensional tuple of strings
+        Filenames of the png and the svg images.
+    """
+    barchart = pygal.HorizontalBar(**chart['options'])
+    barchart.title = chart['title']
+    for label, value in chart['bars']:
+        barchart.add(label, value)
+
+    png_filename, svg_filename = get_chart_filenames(chart, output_directory)
+    os.makedirs(os.path.dirname(png_filename), exist_ok=True)
+    os.makedirs(os.path.dirname(svg_filename), exist_ok=True)
+
+    svg = barchart.render()
+    with open(svg_filename, 'wb') as f:
+        f.write(svg)
+
+    # cairosvg is only needed for the png images, as in pygal
+    import cairosvg
+    cairosvg.svg2png(bytestring=svg, write_to=png_filename)
+
+    return png_filename, svg_filename
+
+
+def plot_categories_for_city(data, city, per_capita=False):
+    render_chart(get_categories_chart(data, city, per_capita))
+
+
+def plot_all_cities(data, citylist=None, category=None, per_capita=False):
+    render_chart(get_all_cities_chart(data, citylist, category, per_capita))
+
+
+def get_all_charts(data, citylist=None):
+    """
+    It describes every chart of the plotting directory: the categories of
+    each city and the cities of each category, both in total and per capita.
+
+    Parameters
+    ----------
+    data : dictionary of dictionaries
+        As returned by get_activities_per_category().
+    citylist : list of strings
+        Names of the cities. By default, all the cities in data.
+
+    Returns
+    -------
+    charts : list of dictionaries
+        As returned by get_categories_chart().
+    """
+    if citylist is None:
+        citylist = list(data.keys())
+
+    charts = []
+    for per_capita in (False, True):
+        for city in citylist:
+            charts.append(get_categories_chart(data, city, per_capita))
+        for category in ['all'] + category_names:
+            charts.append(get_all_cities_chart(data, citylist, category, per_capita))
+
+    return charts
+
+
+def render_charts(charts, workers=None, force=False,
+                  output_directory=OUTPUT_DIRECTORY,
+                  hashes_filename=HASHES_FILENAME):
+    """
+    It renders several charts in a pool of processes. Charts whose data did
+    not change since they were last rendered, and whose images still exist,
+    are skipped.
+
+    Parameters
+    ----------
+    charts : list of dictionaries
+        As returned by get_categories_chart().
+    workers : integer
+        Number of processes. By default, the number of processors.
+    force : boolean
+        If true, all the charts are rendered.
+    output_directory : string
+        Directory where the pngs and svgs directories are.
+    hashes_filename : string
+        File with the hash of the data of each rendered chart.
+
+    Returns
+    -------
+    rendered : integer
+        Number of charts that were rendered.
+    """
+    hashes = {}
+    if os.path.isfile(hashes_filename) and not force:
+        with open(hashes_filename, 'r') as f:
+            hashes = json.load(f)
+
+    pending = []
+    for chart in charts:
+        digest = get_chart_hash(chart)
+        filenames = get_chart_filenames(chart, output_directory)
+        if hashes.get(chart['filename']) == digest and all(os.path.isfile(filename) for filename in filenames):
+            continue
+        pending.append((chart, digest))
+
+    print(f'Rendering {len(pending)} of {len(charts)} charts')
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(render_chart, chart, output_directory): (chart, digest)
+                       for chart, digest in pending}
+            for future in as_completed(futures):
+                chart, digest = futures[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    print(f"Unable to render {chart['filename'].format('')}: {error}")
+                    continue
+                hashes[chart['filename']] = digest
+
+        with open(hashes_filename, 'w') as f:
+            json.dump(hashes, f, indent=1, sort_keys=True)
+
+    return len(pending)
+
+
+def main(argv=None):
+    """
+    It is the command line entry point, run from the root of the repository:
+        python -m plotting.plot [--cities ...] [--workers N] [--force]
 
+    Parameters
+    ----------
+    argv : list of strings
+        Arguments of the command line. By default, sys.argv is used.
+    """
+    parser = argparse.ArgumentParser(description='Render the charts of open events per city and category.')
+    parser.add_argument('--cities', nargs='+', help='cities to plot (default: meetup.cities)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--force', action='store_true', help='render the charts even if their data did not change')
+    arguments = parser.parse_args(argv)
 
-# plot(activities_per_category, 'Berlin', category_names)
+    activities_per_category = get_activities_per_category(arguments.cities)
+    render_charts(get_all_charts(activities_per_category), arguments.workers, arguments.force)
 
-# plot_all_cities(activities_per_category, citylist=city_list, per_capita=False)
-# plot_all_cities(activities_per_category, citylist=city_list, per_capita=True)
-#
-# for category_name in category_names:
-#     plot_all_cities(activities_per_category, category=category_name, citylist=city_list, per_capita=False)
-#     plot_all_cities(activities_per_category, category=category_name, citylist=city_list, per_capita=True)
 
-for city in city_list:
-    plot_categories_for_city(activities_per_category, city, per_capita=False)
-    plot_categories_for_city(activities_per_category, city, per_capita=True)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1 +1,3 @@
 from . import wikipedia
+from . import cache
+from . import batch
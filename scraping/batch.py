@@ -0,0 +1,160 @@
+# To read the options of the command line
+import argparse
+
+# To finish the script with an error code when some city failed
+import sys
+
+# To measure the time spent on each city
+import time
+
+# To scrap several cities at the same time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Import the default list of cities
+from meetup.cities import cities
+
+# Import local constants file
+from . import constants as co
+
+# Import the functions that scrap and write the districts of a city
+from .wikipedia import (DistrictsNotFoundError, scrap_districts_population,
+                        write_csv)
+
+# Import the switch of the offline mode of the cache
+from .cache import set_offline
+
+
+def scrap_city_districts(city, filename="./districts/{}.csv"):
+    """
+    It scraps the districts of a city and writes them down to a csv file. No
+    exception is raised: failures are reported in the returned status.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    filename : string
+        Directory and filename of the file that is going to be written.
+
+    Returns
+    -------
+    status : dictionary
+        It has the following format:
+            keys:   ["status", "districts", "time", "error"]
+            values: ["ok", "not found" or "failed", integer, float, string]
+    """
+    start = time.perf_counter()
+    status = {"status": "ok", "districts": 0, "time": 0., "error": None}
+
+    try:
+        district_data = scrap_districts_population(city)
+        write_csv(city, district_data, filename)
+        status["districts"] = sum(len(data) for data in district_data)
+
+    except DistrictsNotFoundError as error:
+        status["status"] = "not found"
+        status["error"] = str(error)
+
+    except Exception as error:
+        status["status"] = "failed"
+        status["error"] = "{}: {}".format(type(error).__name__, error)
+
+    status["time"] = time.perf_counter() - start
+
+    return status
+
+
+def scrap_cities_districts(city_list=None, filename="./districts/{}.csv",
+                           workers=co.CITY_WORKERS):
+    """
+    It scraps the districts of several cities at the same time and writes
+    each of them down to its own csv file. A city that fails does not stop
+    the others.
+
+    Parameters
+    ----------
+    city_list : list of strings
+        Names of the cities. By default, all the cities in meetup.cities.
+    filename : string
+        Directory and filename of the files that are going to be written. It
+        is formatted with the name of each city.
+    workers : integer
+        Maximum number of cities that are scraped at the same time.
+
+    Returns
+    -------
+    statuses : dictionary of dictionaries
+        It has city names as keys, in the same order as city_list, and the
+        status returned by scrap_city_districts() as items.
+    """
+    if city_list is None:
+        city_list = list(cities.keys())
+
+    statuses = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(scrap_city_districts, city, filename): city
+                   for city in city_list}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            city = futures[future]
+            status = future.result()
+            statuses[city] = status
+
+            message = "[{}/{}] {}: {}".format(done, len(futures), city,
+                                              status["status"])
+            if status["error"] is None:
+                message += ", {} districts".format(status["districts"])
+            else:
+                message += " ({})".format(status["error"])
+            print(message + " in {:.2f} s".format(status["time"]))
+
+    return {city: statuses[city] for city in city_list}
+
+
+def main(argv=None):
+    """
+    It is the command line entry point of the batch scraping:
+        python -m scraping.batch [city ...] [--workers N] [--filename F]
+                                 [--offline]
+
+    Parameters
+    ----------
+    argv : list of strings
+        Arguments of the command line. By default, sys.argv is used.
+
+    Returns
+    -------
+    exit_code : integer
+        0 if all the cities were scraped, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        description="Scrap the population of the districts of several " +
+                    "cities from Wikipedia.")
+    parser.add_argument("cities", nargs="*",
+                        help="cities to scrap (default: meetup.cities)")
+    parser.add_argument("--workers", type=int, default=co.CITY_WORKERS,
+                        help="cities scraped at the same time")
+    parser.add_argument("--filename", default="./districts/{}.csv",
+                        help="output file, formatted with the city name")
+    parser.add_argument("--offline", action="store_true",
+                        help="only use the cached Wikipedia responses")
+    arguments = parser.parse_args(argv)
+
+    if arguments.offline:
+        set_offline()
+
+    statuses = scrap_cities_districts(arguments.cities or None,
+                                      arguments.filename, arguments.workers)
+
+    failed = [city for city, status in statuses.items()
+              if status["status"] != "ok"]
+    print("Scraped {} of {} cities".format(len(statuses) - len(failed),
+                                           len(statuses)) +
+          (". Failed: {}".format(", ".join(failed)) if failed else ""))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
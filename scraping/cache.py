@@ -0,0 +1,244 @@
+# Import requests exceptions to imitate the responses of requests
+from requests.exceptions import HTTPError
+
+# Import the pooled session to make url requests
+from network.session import PooledSession
+
+# To build the content addresses
+import hashlib
+
+# To save the cache index
+import json
+import os
+import tempfile
+from time import time
+
+# Import local constants file
+from . import constants as co
+
+# Session of the Wikipedia requests, with its own retry budget
+session = PooledSession()
+
+# When True, responses are only read from the cache and Wikipedia is never
+# requested
+offline = False
+
+
+def set_offline(enabled=True):
+    """
+    It enables or disables the offline mode. In offline mode, only the cached
+    responses are used, and the urls that are not in the cache are answered
+    as not found.
+
+    Parameters
+    ----------
+    enabled : boolean
+        True to enable the offline mode.
+    """
+    global offline
+    offline = enabled
+
+
+class CachedResponse(object):
+    """
+    Response read from the cache. It has the attributes of a requests
+    response that are used by the scraping functions.
+
+    Parameters
+    ----------
+    url : string
+        Address of the response.
+    status_code : integer
+        HTTP status code of the response.
+    content : bytes
+        Body of the response.
+    headers : dictionary
+        Headers of the response.
+    """
+
+    def __init__(self, url, status_code, content, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        """
+        It raises an HTTPError if the status code is an error.
+        """
+        if self.status_code >= 400:
+            raise HTTPError("{} Error for url: {}".format(self.status_code,
+                                                          self.url),
+                            response=self)
+
+
+def get_key(url):
+    """
+    It computes the name of the cache entry of a url. Wikipedia urls are
+    made of the language, the search path and the city, so each entry
+    corresponds to one (language, search path, city).
+
+    Parameters
+    ----------
+    url : string
+        Address of the response.
+
+    Returns
+    -------
+    key : string
+        Name of the cache entry.
+    """
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def read_entry(key, directory):
+    """
+    It reads the index entry and the body of a cached response.
+
+    Parameters
+    ----------
+    key : string
+        Name of the cache entry.
+    directory : string
+        Directory of the cache.
+
+    Returns
+    -------
+    entry : dictionary
+        The index entry, with "url", "status_code", "etag", "last_modified",
+        "object" and "fetched" keys, or None if there is no entry.
+    content : bytes
+        Body of the response, or None if there is no entry.
+    """
+    try:
+        with open(os.path.join(directory, "index", key + ".json"), 'r') as f:
+            entry = json.load(f)
+        with open(os.path.join(directory, "objects", entry["object"]),
+                  'rb') as f:
+            content = f.read()
+    except (OSError, ValueError, KeyError):
+        return None, None
+    return entry, content
+
+
+def write_file(filename, data, mode='w'):
+    """
+    It writes a file atomically, so other threads or processes never read it
+    half written.
+
+    Parameters
+    ----------
+    filename : string
+        Directory and filename of the file.
+    data : either string or bytes
+        Content of the file.
+    mode : string
+        'w' for strings or 'wb' for bytes.
+    """
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    # Each write gets its own temporary file, even within the same process
+    descriptor, temporary_filename = tempfile.mkstemp(dir=directory,
+                                                      suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, mode) as f:
+            f.write(data)
+        os.replace(temporary_filename, filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
+
+
+def write_entry(key, url, response, directory):
+    """
+    It saves a response to the cache. Bodies are saved by the hash of their
+    content, so equal pages are only stored once.
+
+    Parameters
+    ----------
+    key : string
+        Name of the cache entry.
+    url : string
+        Address of the response.
+    response : response object
+        It is the response to save.
+    directory : string
+        Directory of the cache.
+
+    Returns
+    -------
+    entry : dictionary
+        The index entry that was written.
+    """
+    object_name = hashlib.sha256(response.content).hexdigest()
+    object_filename = os.path.join(directory, "objects", object_name)
+    if not os.path.isfile(object_filename):
+        write_file(object_filename, response.content, 'wb')
+
+    entry = {"url": url,
+             "status_code": response.status_code,
+             "etag": response.headers.get("ETag"),
+             "last_modified": response.headers.get("Last-Modified"),
+             "object": object_name,
+             "fetched": time()}
+    write_file(os.path.join(directory, "index", key + ".json"),
+               json.dumps(entry))
+    return entry
+
+
+def get_cached_response(url, headers=None, directory=co.CACHE_DIRECTORY,
+                        ttl=co.CACHE_TTL):
+    """
+    It gets a response from the cache or, if it is not there or it is too
+    old, from the web. Old responses are revalidated with their ETag and
+    Last-Modified headers, so unchanged pages are not downloaded again.
+    Not found pages are also cached.
+
+    Parameters
+    ----------
+    url : string
+        Address to request.
+    headers : dictionary
+        Headers of the request.
+    directory : string
+        Directory of the cache.
+    ttl : float
+        Seconds during which a cached response is used without revalidating
+        it.
+
+    Returns
+    -------
+    response : CachedResponse
+        The response. In offline mode, urls that are not in the cache get a
+        504 status code.
+    """
+    key = get_key(url)
+    entry, content = read_entry(key, directory)
+
+    if entry is not None and (offline or time() - entry["fetched"] < ttl):
+        return CachedResponse(url, entry["status_code"], content)
+
+    if offline:
+        return CachedResponse(url, 504, b"")
+
+    request_headers = dict(headers or {})
+    if entry is not None:
+        if entry["etag"] is not None:
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+    response = session.get(url, headers=request_headers)
+
+    if entry is not None and response.status_code == 304:
+        entry["fetched"] = time()
+        write_file(os.path.join(directory, "index", key + ".json"),
+                   json.dumps(entry))
+        return CachedResponse(url, entry["status_code"], content)
+
+    # Server errors are not cached, so they are requested again next time
+    if response.status_code < 500:
+        write_entry(key, url, response, directory)
+
+    return CachedResponse(url, response.status_code, response.content,
+                          response.headers)
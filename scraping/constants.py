@@ -35,3 +35,16 @@ DENSITY_LIST = {LANGUAGES[0]: ("Density", "Population density"),
 AREA_LIST = {LANGUAGES[0]: ("Area", "Size", "Land"),
              LANGUAGES[1]: ("Superficie", ),
              LANGUAGES[2]: ("Fläche", )}
+
+# Local cache of the Wikipedia responses
+CACHE_DIRECTORY = "./cache/wikipedia"
+
+# Seconds during which a cached response is used without asking Wikipedia
+CACHE_TTL = 7 * 24 * 3600
+
+# Maximum number of Wikipedia pages that are probed at the same time
+PROBE_WORKERS = 8
+
+# Maximum number of cities that are scraped at the same time by
+# batch.scrap_cities_districts(). Each city probes up to PROBE_WORKERS pages.
+CITY_WORKERS = 4
@@ -0,0 +1,247 @@
+# Import lxml to parse html
+from lxml import etree
+
+# To parse the content of a page incrementally
+from io import BytesIO
+
+# To describe the cells of a table
+from collections import namedtuple
+
+# A cell of a table. row is the row where the cell starts and first_column and
+# last_column are the columns that it covers.
+TableCell = namedtuple("TableCell", ["element", "tag", "row", "first_column",
+                                     "last_column"])
+
+# Class of the tables with data in a Wikipedia page
+WIKITABLE_CLASS = "wikitable"
+
+
+def is_wikitable(element):
+    """
+    It tells whether an element is a Wikipedia table with data.
+
+    Parameters
+    ----------
+    element : lxml element
+        It is an element of a page.
+
+    Returns
+    -------
+    wikitable : boolean
+        True if it is a table with the "wikitable" class.
+    """
+    return (element.tag == "table" and
+            WIKITABLE_CLASS in element.get("class", "").split())
+
+
+def find_wikitables(content, encoding="utf-8"):
+    """
+    It parses an html page incrementally with lxml and returns its Wikipedia
+    tables. The page still has to be read from start to end, but only the
+    tables with the "wikitable" class are kept as trees. Every other element
+    is discarded as soon as it is closed, so the tree of the rest of the
+    article is never kept in memory.
+
+    Parameters
+    ----------
+    content : bytes
+        It is the html content of a page.
+    encoding : string
+        Encoding of the content. Wikipedia pages are always utf-8.
+
+    Returns
+    -------
+    list_of_tables : list of lxml elements
+        It is a list containing all the tables with the "wikitable" class.
+    """
+    if not content.strip():
+        return []
+
+    list_of_tables = []
+    # Depth inside of the outermost open wikitable, whose elements are kept
+    depth = 0
+    for event, element in etree.iterparse(BytesIO(content),
+                                          events=("start", "end"),
+                                          html=True, encoding=encoding):
+        if event == "start":
+            # Tables are listed in the order they are opened, as in the page
+            if element.tag == "table" and is_wikitable(element):
+                list_of_tables.append(element)
+                depth += 1
+            elif depth > 0:
+                depth += 1
+            continue
+
+        if depth > 0:
+            depth -= 1
+            # The outermost table is detached, so its ancestors can be
+            # discarded
+            if depth == 0 and element.getparent() is not None:
+                element.getparent().remove(element)
+            continue
+
+        element.clear()
+        # Earlier siblings were already closed and discarded
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+
+    return list_of_tables
+
+
+def get_span(element, attribute):
+    """
+    It reads the colspan or rowspan attribute of a cell.
+
+    Parameters
+    ----------
+    element : lxml element
+        It is a cell of a table.
+    attribute : string
+        Either "colspan" or "rowspan".
+
+    Returns
+    -------
+    span : integer
+        Number of columns or rows covered by the cell.
+    """
+    try:
+        return max(1, int(element.get(attribute, 1)))
+    except ValueError:
+        return 1
+
+
+def build_table_grid(table):
+    """
+    It builds the grid of a table: one list per row with the cell that covers
+    each column. Cells spanning several columns or rows appear in all the
+    slots they cover.
+
+    Parameters
+    ----------
+    table : lxml element
+        It is a table of an html page.
+
+    Returns
+    -------
+    grid : list of lists of TableCell
+        Each row has one item per column. Columns not covered by any cell are
+        None.
+    """
+    grid = []
+    # Columns covered by cells from the rows above: column -> (cell, rows)
+    pending = {}
+
+    for nrow, row in enumerate(table.xpath("./tr|./*/tr")):
+        slots = {}
+        next_pending = {}
+        ncol = 0
+
+        for element in row.xpath("./th|./td"):
+            while ncol in pending:
+                ncol += 1
+            colspan = get_span(element, "colspan")
+            rowspan = get_span(element, "rowspan")
+            cell = TableCell(element, element.tag, nrow, ncol,
+                             ncol + colspan - 1)
+            for column in range(ncol, ncol + colspan):
+                slots[column] = cell
+                if rowspan > 1:
+                    next_pending[column] = (cell, rowspan - 1)
+            ncol += colspan
+
+        for column, (cell, rows_left) in pending.items():
+            slots[column] = cell
+            if rows_left > 1:
+                next_pending[column] = (cell, rows_left - 1)
+
+        pending = next_pending
+        width = max(slots) + 1 if slots else 0
+        grid.append([slots.get(column) for column in range(width)])
+
+    return grid
+
+
+def get_row_cells(grid, nrow, tag=None, own=False):
+    """
+    It returns the different cells of a row of the grid, from left to right.
+
+    Parameters
+    ----------
+    grid : list of lists of TableCell
+        Grid as returned by build_table_grid().
+    nrow : integer
+        Number of the row.
+    tag : string
+        If given, only the cells with this tag ("th" or "td") are returned.
+    own : boolean
+        If true, the cells coming from the rows above are not returned.
+
+    Returns
+    -------
+    cells : list of TableCell
+        The cells of the row.
+    """
+    cells = []
+    for cell in grid[nrow]:
+        if cell is None or (cells and cells[-1] is cell):
+            continue
+        if tag is not None and cell.tag != tag:
+            continue
+        if own and cell.row != nrow:
+            continue
+        cells.append(cell)
+    return cells
+
+
+def cell_text(cell):
+    """
+    It returns the text of a cell.
+
+    Parameters
+    ----------
+    cell : TableCell
+        It is a cell of a table.
+
+    Returns
+    -------
+    text : string
+        All the text inside of the cell.
+    """
+    return cell.element.xpath("string()")
+
+
+def cell_spaced_text(cell):
+    """
+    It returns the text of a cell, with a space wherever there was a tag, so
+    numbers in different tags are not merged.
+
+    Parameters
+    ----------
+    cell : TableCell
+        It is a cell of a table.
+
+    Returns
+    -------
+    text : string
+        All the text inside of the cell.
+    """
+    return " ".join(cell.element.itertext())
+
+
+def cell_html(cell):
+    """
+    It returns the html of a cell.
+
+    Parameters
+    ----------
+    cell : TableCell
+        It is a cell of a table.
+
+    Returns
+    -------
+    html : string
+        The html of the cell, including its tags.
+    """
+    return etree.tostring(cell.element, encoding=str, with_tail=False)
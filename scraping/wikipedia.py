@@ -1,5 +1,4 @@
-# Import requests package to make url requests to Wikipedia
-import requests
+# Import requests exceptions to handle not found pages
 from requests.exceptions import HTTPError
 
 # Import sys package to finish the script when required
@@ -14,8 +13,8 @@ import csv
 # Import re to parse strings
 import re
 
-# To copy variables
-import copy
+# To probe several Wikipedia pages at the same time
+from concurrent.futures import ThreadPoolExecutor
 
 # Import BeautifulSoup to parse html
 from bs4 import BeautifulSoup
@@ -23,10 +22,24 @@ from bs4 import BeautifulSoup
 # Import local constants file
 from . import constants as co
 
+# Import the local cache of Wikipedia responses
+from .cache import get_cached_response
+
+# Import the lxml table extraction functions
+from .tables import (find_wikitables, build_table_grid, get_row_cells,
+                     cell_text, cell_spaced_text, cell_html)
+
+
+class DistrictsNotFoundError(Exception):
+    """
+    It is raised when no Wikipedia page with the districts of a city is found.
+    """
+
 
 def get_wikipedia_response(search_key, language="en"):
     """
-    It attempts to get a response from a Wikipedia url.
+    It attempts to get a response from a Wikipedia url. Responses are read
+    from the local cache when possible (see cache.get_cached_response()).
 
     Parameters
     ----------
@@ -38,11 +51,11 @@ def get_wikipedia_response(search_key, language="en"):
 
     Returns
     -------
-    response : response object
+    response : CachedResponse
         It is the html response of the web address searched.
     """
     url = (co.WIKIPEDIA_URL.format(language) + search_key).replace(" ", "_")
-    response = requests.get(url, headers=co.HEADERS)
+    response = get_cached_response(url, headers=co.HEADERS)
     return response
 
 
@@ -231,7 +244,7 @@ def get_population_tables(city, language, search_path):
 
     Returns
     -------
-    list_of_tables : list of BeautifulSoup objects
+    list_of_tables : list of lxml elements
         This list contains all the tables that were found in this Wikipedia
         page.
     """
@@ -244,44 +257,19 @@ def get_population_tables(city, language, search_path):
     except HTTPError:
         return None
 
-    parsed_response = parse_http_response(response)
-    list_of_tables = get_wikipedia_tables(parsed_response)
+    list_of_tables = find_wikitables(response.content)
 
     return list_of_tables
 
 
-def search_colspan(html_fragment):
-    """
-    It looks for multiple cells and computes how many columns it is made of.
-
-    Parameters
-    ----------
-    html_fragment : BeautifulSoup object
-        It is a html fragment corresponding to a cell of a table.
-
-    Returns
-    -------
-    width : integer
-        It is the width of this cell expressed as the number of columns it
-        contains.
-    """
-    html_fragment = str(html_fragment)
-    if "colspan=\"" in html_fragment:
-        html_fragment = html_fragment.split("colspan=\"")[1]
-        html_fragment = html_fragment.split("\"")[0]
-        return int(html_fragment)
-    else:
-        return 1
-
-
 def string_parser(string):
     """
     It parses the content of a cell that was identified as a string.
 
     Parameters
     ----------
-    string : BeautifulSoup object
-        It is a html fragment corresponding to the content of a cell.
+    string : string
+        It is the text content of a cell.
 
     Returns
     -------
@@ -301,8 +289,8 @@ def float_parser(string, language):
 
     Parameters
     ----------
-    string : BeautifulSoup object
-        It is a html fragment corresponding to the content of a cell.
+    string : string
+        It is the text content of a cell.
     language : string
         It is the language abbreviation that decides in which language this
         cell was written.
@@ -342,15 +330,53 @@ def float_parser(string, language):
     return float(string)
 
 
+def find_subcategory_column(grid, nrow, category, keyword):
+    """
+    It looks for a keyword in the subcategories of a category that spans
+    several columns, e.g. the "km" of an area expressed in several units.
+
+    Parameters
+    ----------
+    grid : list of lists of TableCell
+        Grid of the table, as returned by tables.build_table_grid().
+    nrow : integer
+        Row of the subcategories.
+    category : TableCell
+        Header cell of the category.
+    keyword : string
+        Text to search for in the html of the subcategories.
+
+    Returns
+    -------
+    column : integer
+        Column of the first subcategory containing the keyword, or None if
+        none of them contains it.
+    """
+    if nrow >= len(grid):
+        return None
+
+    for column in range(category.first_column, category.last_column + 1):
+        if column >= len(grid[nrow]):
+            break
+        subcategory = grid[nrow][column]
+        if subcategory is not None and subcategory.tag == 'th' and \
+                subcategory.row == nrow and keyword in cell_html(subcategory):
+            return column
+
+    return None
+
+
 def table_parser(table, language):
     """
     It parses a Wikipedia table with the aim to retrieve population data for
-    all the districts of a city.
+    all the districts of a city. The table is first arranged in a grid, so
+    cells spanning several columns or rows are placed in all the columns and
+    rows they cover.
 
     Parameters
     ----------
-    table : BeautifulSoup object
-        It is the html table parsed by BeautifulSoup.
+    table : lxml element
+        It is the html table found by tables.find_wikitables().
     language : string
         It is the language abbreviation that decides in which language this
         cell was written.
@@ -363,7 +389,7 @@ def table_parser(table, language):
             keys:   [district name]
             values: {"Population": float, "Density": float, "Area": float}
     """
-    rows = table.findChildren('tr')
+    grid = build_table_grid(table)
 
     name_col = None
     population_col = None
@@ -374,90 +400,64 @@ def table_parser(table, language):
 
     nths = 0
 
-    for nrow, row in enumerate(rows):
-        categories = row.findChildren('th')
+    for nrow in range(len(grid)):
+        categories = get_row_cells(grid, nrow, tag='th', own=True)
         nths += 1
 
         if nrow >= 1 and len(categories) <= 1:
             break
 
-        ncell = 0
-
-        for ncol, category in enumerate(categories):
-            current_span = search_colspan(category)
-            ncell += current_span
+        for category in categories:
+            current_span = category.last_column - category.first_column + 1
+            text = cell_text(category)
 
-            if category.text.startswith(co.NAME_LIST[language]) and \
+            if text.startswith(co.NAME_LIST[language]) and \
                     (name_col is None):
-                name_col = ncell - 1
+                name_col = category.last_column
                 continue
 
-            elif category.text.startswith(co.POPULATION_LIST[language]) and \
+            elif text.startswith(co.POPULATION_LIST[language]) and \
                     (population_col is None):
-                population_col = ncell - 1
+                population_col = category.last_column
                 continue
 
-            elif category.text.startswith(co.AREA_LIST[language]) and \
+            elif text.startswith(co.AREA_LIST[language]) and \
                     (area_col is None):
                 if (current_span > 1):
-                    subcategories = rows[nrow + 1].findChildren('th')
-                    if len(subcategories) >= ncell:
-                        subcategories = subcategories[
-                            (ncell - current_span):ncell]
-                        for nsubcell, subcategory in enumerate(subcategories):
-                            subcategory = str(subcategory)
-                            if "km" in subcategory:
-                                area_col = ncell - current_span + nsubcell
-                                break
-                        continue
+                    area_col = find_subcategory_column(grid, nrow + 1,
+                                                       category, "km")
                 else:
-                    area_col = ncell - 1
-                    continue
+                    area_col = category.last_column
+                continue
 
-            elif category.text.startswith(co.DENSITY_LIST[language]) and \
+            elif text.startswith(co.DENSITY_LIST[language]) and \
                     (density_col is None):
                 if (current_span > 1):
-                    subcategories = rows[nrow + 1].findChildren('th')
-                    if len(subcategories) >= ncell:
-                        subcategories = subcategories[
-                            (ncell - current_span):ncell]
-                        for nsubcell, subcategory in enumerate(subcategories):
-                            subcategory = str(subcategory)
-                            if "km" in subcategory:
-                                density_col = ncell - current_span + nsubcell
-                                break
-                        continue
+                    density_col = find_subcategory_column(grid, nrow + 1,
+                                                          category, "km")
                 else:
-                    density_col = ncell - 1
-                    continue
-
-        # print("categories: ", categories)
-        # print("cols: ", name_col, population_col, density_col, area_col)
+                    density_col = category.last_column
+                continue
 
     distr_name = None
     distr_population = None
     distr_density = None
     distr_area = None
 
-    for row in rows[(nths - 1):]:
-        if str(row.findChildren()[0]).startswith("<th>"):
-            ncell = 1
-        else:
-            ncell = 0
-
-        cols = row.findChildren('td')
-        for col in cols:
-            ncell += search_colspan(col)
-            if search_colspan(col) > 2:
+    for nrow in range(max(0, nths - 1), len(grid)):
+        for col in get_row_cells(grid, nrow, tag='td'):
+            ncell = col.last_column + 1
+            if col.last_column - col.first_column + 1 > 2:
                 continue
             elif name_col is not None and ncell == (name_col + 1):
-                distr_name = string_parser(col.text)
+                distr_name = string_parser(cell_text(col))
             elif population_col is not None and ncell == (population_col + 1):
-                distr_population = float_parser(col, language)
+                distr_population = float_parser(cell_spaced_text(col),
+                                                language)
             elif density_col is not None and ncell == (density_col + 1):
-                distr_density = float_parser(col, language)
+                distr_density = float_parser(cell_spaced_text(col), language)
             elif area_col is not None and ncell == (area_col + 1):
-                distr_area = float_parser(col, language)
+                distr_area = float_parser(cell_spaced_text(col), language)
 
         district_data[distr_name] = {"Population": distr_population,
                                      "Density": distr_density,
@@ -494,11 +494,72 @@ def conversion(district_data):
     return district_data
 
 
+def get_candidate_pages(source_of_paths=co.SEARCH_PATHS,
+                        source_of_languages=co.LANGUAGES):
+    """
+    It lists all the Wikipedia pages that may contain the districts of a
+    city, from the highest to the lowest priority: languages in the order of
+    source_of_languages and, for each language, search paths in the order of
+    source_of_paths.
+
+    Parameters
+    ----------
+    source_of_paths : dictionary of keyword lists
+        See scrap_districts_population().
+    source_of_languages : list of language abbreviations
+        See scrap_districts_population().
+
+    Returns
+    -------
+    candidates : list of tuples
+        Each tuple contains a language abbreviation and a search path.
+    """
+    return [(language, search_path) for language in source_of_languages
+            for search_path in source_of_paths.get(language, [])]
+
+
+def probe_candidate_page(city, language, search_path):
+    """
+    It fetches a candidate page and parses all its tables.
+
+    Parameters
+    ----------
+    city : string
+        Name of the city.
+    language : string
+        It is the language abbreviation of the page.
+    search_path : string
+        This is the Wikipedia url direction, with a placeholder for the city.
+
+    Returns
+    -------
+    data_list : list of dictionaries of dictionaries
+        The population data of all the tables with useful information (see
+        scrap_districts_population()), or None if the page does not exist.
+    """
+    list_of_tables = get_population_tables(city, language, search_path)
+
+    if list_of_tables is None:
+        return None
+
+    data_list = []
+    for table in list_of_tables:
+        district_data = table_parser(table, language)
+        if len(district_data) > 0 and \
+                list(district_data.keys())[0] is not None:
+            data_list.append(district_data)
+
+    return data_list
+
+
 def scrap_districts_population(city, source_of_paths=co.SEARCH_PATHS,
-                               source_of_languages=co.LANGUAGES):
+                               source_of_languages=co.LANGUAGES,
+                               workers=co.PROBE_WORKERS):
     """
     It is the main function to scrap the population data from Wikipedia for all
-    the districts of a city.
+    the districts of a city. All the candidate pages are fetched and parsed
+    at the same time, and the one with the highest priority that contains
+    useful tables is chosen (see get_candidate_pages()).
 
     Parameters
     ----------
@@ -512,6 +573,8 @@ def scrap_districts_population(city, source_of_paths=co.SEARCH_PATHS,
     source_of_languages : list of language abbreviations
         It is a list containing the language abbreviations for all the
         languages whose Wikipedia pages we want to search into.
+    workers : integer
+        Maximum number of pages that are probed at the same time.
 
     Returns
     -------
@@ -520,39 +583,39 @@ def scrap_districts_population(city, source_of_paths=co.SEARCH_PATHS,
         of a city. The format of the inner dictionaries is the following:
             keys:   [district name]
             values: {"Population": float, "Density": float, "Area": float}
+
+    Raises
+    ------
+    DistrictsNotFoundError
+        If none of the candidate pages has useful tables.
     """
-    list_of_tables = None
-    search_paths = copy.deepcopy(source_of_paths)
-    languages = copy.deepcopy(source_of_languages)
-    language = languages[0]
+    candidates = get_candidate_pages(source_of_paths, source_of_languages)
 
-    while ((list_of_tables is None) and (len(languages) != 0 or
-           len(search_paths[language]) != 0)):
-        while (len(search_paths[language]) == 0) and (len(languages) != 0):
-            language = languages.pop(0)
+    data_list = []
 
-        if len(search_paths[language]) != 0:
-            search_path = search_paths[language].pop(0)
-            list_of_tables = get_population_tables(city, language, search_path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(probe_candidate_page, city, language,
+                                   search_path)
+                   for language, search_path in candidates]
 
-    data_list = []
+        # Pages are checked in order of priority, waiting for each one
+        for (language, search_path), future in zip(candidates, futures):
+            data_list = future.result()
+            if data_list is None:
+                data_list = []
+                continue
+            if len(data_list) > 0:
+                break
+            print(" No useful information found here, looking somewhere " +
+                  "else...")
 
-    if list_of_tables is not None:
-        for table in list_of_tables:
-            district_data = table_parser(table, language)
-            if list(district_data.keys())[0] is not None:
-                data_list.append(district_data)
+        # The remaining pages are not needed anymore
+        for future in futures:
+            future.cancel()
 
     if len(data_list) == 0:
-        print(" No useful information found here, looking somewhere else...")
-
-        if (len(languages) > 0) or (len(search_paths[language]) > 0):
-            data_list = scrap_districts_population(city,
-                                                   search_paths,
-                                                   languages)
-        else:
-            sys.exit("Unable to find districts of {}".format(city) +
-                     " in Wikipedia database")
+        raise DistrictsNotFoundError("Unable to find districts of " +
+                                     "{} in Wikipedia database".format(city))
 
     if language == "es":
         for data in data_list: